@@ -0,0 +1,389 @@
+"""Throughput benchmark of the ETL.
+
+Runs the real ETL runtime (extractor, transformer, batch store, loader) over a pre-generated stream of Kafka
+records. Kafka is replaced by an in-process consumer and, unless --clickhouse is given, ClickHouse by a client
+that only counts what it is sent, so the numbers show the cost of the ETL itself. Every scenario runs in a fresh
+process, which keeps the peak RSS of one scenario from leaking into the next.
+
+    python etl/benchmarks/etl_benchmark.py --messages 200000 --batch-sizes 100,1000,10000 --mixes views,mixed
+    python etl/benchmarks/etl_benchmark.py --clickhouse localhost:9000 --json results.json
+
+A real server is set up without ON CLUSTER DDL and with plain MergeTree tables, unless --cluster names the cluster
+it belongs to. Rows are counted as the inserts the server acknowledged.
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import random
+import resource
+import sys
+import tempfile
+import time
+from collections.abc import Iterator
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any
+from uuid import uuid4
+
+import orjson
+from clickhouse_driver import Client
+from kafka import TopicPartition
+from kafka.consumer.fetcher import ConsumerRecord
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+# Shares of views, events and malformed messages in the stream
+MIXES = {
+    "views": (1.0, 0.0, 0.0),
+    "events": (0.0, 1.0, 0.0),
+    "mixed": (0.8, 0.19, 0.01),
+}
+PARTITIONS = 6
+FETCH_RECORDS = 500
+
+
+class SourceExhausted(BaseException):
+    """Raised by the fake consumer once the stream is consumed; not an Exception, so the ETL does not swallow it."""
+
+
+class FakeConsumer:
+    """KafkaConsumer stand-in serving pre-generated records of every partition in fetch-sized chunks."""
+
+    def __init__(self, records: list[ConsumerRecord], **kwargs: Any) -> None:
+        self.records = records
+        self.index = 0
+        self.listener: Any = None
+        self.committed: dict[TopicPartition, int] = {}
+        self.positions: dict[TopicPartition, int] = {}
+        self.end: dict[TopicPartition, int] = {}
+        for record in records:
+            self.end[TopicPartition(record.topic, record.partition)] = record.offset + 1
+
+    def subscribe(self, topics: list[str], listener: Any = None) -> None:
+        if self.listener is None and listener is not None:
+            self.listener = listener
+            listener.on_partitions_assigned(set(self.end))
+
+    def fetch(self, max_records: int) -> list[ConsumerRecord]:
+        if self.index >= len(self.records):
+            raise SourceExhausted
+        start, self.index = self.index, min(self.index + max_records, len(self.records))
+        chunk = self.records[start:self.index]
+        for record in chunk:
+            self.positions[TopicPartition(record.topic, record.partition)] = record.offset + 1
+        return chunk
+
+    def __iter__(self) -> Iterator[ConsumerRecord]:
+        while True:
+            yield from self.fetch(FETCH_RECORDS)
+
+    def poll(self, timeout_ms: int = 0, max_records: int | None = None) -> dict[TopicPartition, list[ConsumerRecord]]:
+        fetched: dict[TopicPartition, list[ConsumerRecord]] = {}
+        for record in self.fetch(max_records or FETCH_RECORDS):
+            fetched.setdefault(TopicPartition(record.topic, record.partition), []).append(record)
+        return fetched
+
+    def position(self, tp: TopicPartition) -> int:
+        return self.positions.get(tp, 0)
+
+    def highwater(self, tp: TopicPartition) -> int:
+        return self.end[tp]
+
+    def assignment(self) -> set[TopicPartition]:
+        return set(self.end)
+
+    def paused(self) -> set[TopicPartition]:
+        return set()
+
+    def pause(self, *partitions: TopicPartition) -> None:
+        pass
+
+    def resume(self, *partitions: TopicPartition) -> None:
+        pass
+
+    def commit(self, offsets: dict[TopicPartition, Any]) -> None:
+        self.committed.update({tp: offset.offset for tp, offset in offsets.items()})
+
+    def close(self, autocommit: bool = True) -> None:
+        pass
+
+
+def insert_rows(params: Any, columnar: bool) -> int:
+    """Rows of an INSERT's data, 0 for queries without data."""
+    if not isinstance(params, list) or not params:
+        return 0
+    return len(params[0]) if columnar else len(params)
+
+
+class RecordingClient:
+    """clickhouse_driver Client stand-in that accepts every query and counts inserted rows and columns."""
+
+    rows = 0
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        pass
+
+    def execute(self, query: str, params: Any = None, columnar: bool = False, **kwargs: Any) -> Any:
+        rows = insert_rows(params, columnar)
+        if not rows:
+            # DDL and lookups such as the partition key of system.tables find nothing
+            return []
+        RecordingClient.rows += rows
+        return rows
+
+    def disconnect(self) -> None:
+        pass
+
+
+class CountingClient(Client):
+    """clickhouse_driver Client counting the rows of the inserts the server accepted, into RecordingClient.rows."""
+
+    def execute(self, query: str, params: Any = None, *args: Any, columnar: bool = False, **kwargs: Any) -> Any:
+        result = super().execute(query, params, *args, columnar=columnar, **kwargs)
+        if query.lstrip().upper().startswith("INSERT"):
+            RecordingClient.rows += insert_rows(params, columnar)
+        return result
+
+
+class FakeRedis:
+    """In-memory stand-in for the Redis commands of the ETL's checkpoints, trending films and resume positions."""
+
+    def __init__(self) -> None:
+        self.values: dict[str, Any] = {}
+        self.results: list[Any] = []
+
+    def pipeline(self, transaction: bool = True) -> "FakeRedis":
+        return self
+
+    def set(self, key: str, value: Any, ex: int | None = None) -> None:
+        self.values[key] = value
+        self.results.append(True)
+
+    def mget(self, keys: list[str]) -> list[Any]:
+        return [self.values.get(key) for key in keys]
+
+    def hgetall(self, key: str) -> None:
+        self.results.append(dict(self.values.get(key, {})))
+
+    def hset(self, key: str, mapping: dict[bytes, bytes]) -> None:
+        self.values.setdefault(key, {}).update(mapping)
+        self.results.append(len(mapping))
+
+    def hdel(self, key: str, *names: bytes) -> None:
+        hash_ = self.values.setdefault(key, {})
+        self.results.append(sum(hash_.pop(name, None) is not None for name in names))
+
+    def delete(self, key: str) -> None:
+        self.results.append(int(self.values.pop(key, None) is not None))
+
+    def expire(self, key: str, seconds: int) -> None:
+        self.results.append(key in self.values)
+
+    def zadd(self, key: str, mapping: dict[str, float]) -> None:
+        self.values.setdefault(key, {}).update(mapping)
+        self.results.append(len(mapping))
+
+    def zremrangebyscore(self, key: str, low: float, high: float) -> None:
+        zset = self.values.setdefault(key, {})
+        removed = [member for member, score in zset.items() if low <= score <= high]
+        for member in removed:
+            del zset[member]
+        self.results.append(len(removed))
+
+    def zrange(self, key: str, start: int, end: int) -> None:
+        zset = self.values.get(key, {})
+        self.results.append([member.encode() for member in sorted(zset, key=zset.__getitem__)])
+
+    def zunionstore(self, key: str, keys: list[str]) -> None:
+        union: dict[str, float] = {}
+        for source in keys:
+            for member, score in self.values.get(source, {}).items():
+                union[member] = union.get(member, 0) + score
+        self.values[key] = union
+        self.results.append(len(union))
+
+    def register_script(self, script: str) -> Any:
+        def set_if_newer(keys: list[str], args: list[Any], client: "FakeRedis") -> None:
+            value, current = f"{args[0]}:{args[1]}", client.values.get(keys[0])
+            newer = current is None or int(current.rsplit(":", 1)[1]) <= args[1]
+            if newer:
+                client.values[keys[0]] = value
+            client.results.append(int(newer))
+
+        return set_if_newer
+
+    def execute(self) -> list[Any]:
+        results, self.results = self.results, []
+        return results
+
+    def close(self) -> None:
+        pass
+
+
+@dataclass(frozen=True)
+class Scenario:
+    runtime: str
+    mix: str
+    batch_size: int
+    messages: int
+    wire: str = "text"
+    clickhouse: str | None = None
+    cluster: str = ""
+
+
+@dataclass(frozen=True)
+class Result:
+    runtime: str
+    mix: str
+    wire: str
+    batch_size: int
+    messages: int
+    kafka_bytes: int
+    rows: int
+    seconds: float
+    messages_per_second: float
+    cpu_us_per_message: float
+    peak_rss_mb: float
+
+
+def generate(
+    mix: str, messages: int, topics: tuple[str, str], binary: bool = False, seed: int = 42
+) -> list[ConsumerRecord]:
+    import wire
+
+    views_share, events_share, _ = MIXES[mix]
+    rng = random.Random(seed)
+    users = [uuid4() for _ in range(1000)]
+    films = [uuid4() for _ in range(200)]
+    offsets: dict[tuple[str, int], int] = {}
+    records = []
+    now_ms = int(time.time() * 1000)
+    for _ in range(messages):
+        draw = rng.random()
+        user, film = rng.choice(users), rng.choice(films)
+        if draw < views_share:
+            topic, key, value = topics[0], f"{user}:{film}".encode(), str(rng.randrange(1, 10_000)).encode()
+            if binary:
+                key, value = wire.encode_key(user, film), wire.encode_view(now_ms, rng.randrange(1, 10_000))
+        elif draw < views_share + events_share:
+            event_type = rng.randrange(3)
+            topic, key = topics[1], f"{user}:{film}:{event_type}".encode()
+            value = orjson.dumps({"position": rng.randrange(10_000), "quality": "1080p"})
+            if binary:
+                key, value = wire.encode_key(user, film), wire.encode_event(now_ms, event_type, value)
+        else:
+            topic, key, value = topics[0], b"not-a-key", b"not-a-number"
+        tp = (topic, rng.randrange(PARTITIONS))
+        offset = offsets.get(tp, 0)
+        offsets[tp] = offset + 1
+        records.append(
+            ConsumerRecord(topic, tp[1], offset, now_ms, 0, key, value, [], None, len(key), len(value), -1)
+        )
+    return records
+
+
+def run_scenario(scenario: Scenario) -> Result:
+    import clickhouse_loader
+    import kafka_extractor
+    from config import config
+
+    logging.disable(logging.CRITICAL)
+    topics = (config.kafka.views_topic, config.kafka.events_topic)
+    records = generate(scenario.mix, scenario.messages, topics, binary=scenario.wire == "binary")
+    kafka_extractor.KafkaConsumer = lambda **kwargs: FakeConsumer(records, **kwargs)
+    if scenario.clickhouse:
+        config.clickhouse.shards = scenario.clickhouse
+        # A standalone server has no cluster to run ON CLUSTER DDL on, nor the macros of replicated tables
+        config.clickhouse.cluster = scenario.cluster
+        config.clickhouse.replicated = bool(scenario.cluster)
+        clickhouse_loader.Client = CountingClient
+    else:
+        clickhouse_loader.Client = RecordingClient
+    config.batch_size = scenario.batch_size
+    # Scenarios compare fixed batch sizes
+    config.tuning.enabled = False
+    config.runtime = scenario.runtime
+    config.metrics_port = 0
+    config.spool.path = ""
+    config.dead_letter.backend = "file"
+    config.dead_letter.path = str(Path(tempfile.mkdtemp()) / "dead_letter.jsonl")
+
+    from main import create_etl
+
+    etl = create_etl()
+    etl.store.inflight.redis = FakeRedis()  # type: ignore[union-attr]
+    if etl.store.sessionizer is not None:  # type: ignore[union-attr]
+        etl.store.sessionizer.redis = FakeRedis()  # type: ignore[union-attr]
+    if etl.store.trending is not None:  # type: ignore[union-attr]
+        etl.store.trending.redis = FakeRedis()  # type: ignore[union-attr]
+    if etl.store.positions is not None:  # type: ignore[union-attr]
+        etl.store.positions.redis = FakeRedis()  # type: ignore[union-attr]
+        etl.store.positions.set_if_newer = etl.store.positions.redis.register_script("")  # type: ignore[union-attr]
+
+    started, cpu_started = time.perf_counter(), time.process_time()
+    try:
+        etl.start()
+    except SourceExhausted:
+        pass
+    finally:
+        etl.close()
+    seconds, cpu_seconds = time.perf_counter() - started, time.process_time() - cpu_started
+
+    return Result(
+        runtime=scenario.runtime,
+        mix=scenario.mix,
+        wire=scenario.wire,
+        batch_size=scenario.batch_size,
+        messages=scenario.messages,
+        kafka_bytes=sum(len(record.key) + len(record.value) for record in records),
+        rows=RecordingClient.rows,
+        seconds=round(seconds, 3),
+        messages_per_second=round(scenario.messages / seconds),
+        cpu_us_per_message=round(cpu_seconds / scenario.messages * 1_000_000, 2),
+        # ru_maxrss is in kilobytes on Linux
+        peak_rss_mb=round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Measure ETL throughput against in-process Kafka and ClickHouse")
+    parser.add_argument("--messages", type=int, default=200_000)
+    parser.add_argument("--batch-sizes", default="100,1000,10000")
+    parser.add_argument("--mixes", default="views,mixed", help=f"comma separated, of {', '.join(MIXES)}")
+    parser.add_argument("--runtimes", default="sync,pipelined")
+    parser.add_argument("--wires", default="text,binary", help="message formats: text, binary (wire.py)")
+    parser.add_argument("--clickhouse", help="host:port of a real clickhouse-server to load into")
+    parser.add_argument("--cluster", default="", help="cluster of the --clickhouse server, for ON CLUSTER DDL")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    scenarios = [
+        Scenario(runtime, mix, int(batch_size), args.messages, wire, args.clickhouse, args.cluster)
+        for runtime in args.runtimes.split(",")
+        for mix in args.mixes.split(",")
+        for wire in args.wires.split(",")
+        for batch_size in args.batch_sizes.split(",")
+    ]
+    context = multiprocessing.get_context("spawn")
+    results = []
+    print(
+        f"{'runtime':<10} {'mix':<7} {'wire':<7} {'batch':>6} {'bytes/msg':>10} {'msgs/s':>9} {'cpu us/msg':>11} "
+        f"{'peak RSS MB':>12}"
+    )
+    for scenario in scenarios:
+        with context.Pool(1) as pool:
+            result = pool.apply(run_scenario, (scenario,))
+        results.append(result)
+        print(
+            f"{result.runtime:<10} {result.mix:<7} {result.wire:<7} {result.batch_size:>6} "
+            f"{result.kafka_bytes / result.messages:>10.1f} {result.messages_per_second:>9} "
+            f"{result.cpu_us_per_message:>11} {result.peak_rss_mb:>12}"
+        )
+    if args.json:
+        Path(args.json).write_text(json.dumps([asdict(result) for result in results], indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,336 @@
+"""asyncio runtime of the ETL.
+
+A single event loop fetches with aiokafka while up to `ETLConfig.inflight_batches` batches are being inserted
+through asynch connection pools and checkpointed through redis.asyncio. Batches may finish out of order, but
+offsets are committed strictly in consumption order: a batch's offsets are committed only once it and every
+batch before it are stored.
+
+Failed inserts are handled like in the synchronous BatchStore: batches ClickHouse rejects for their data go to the
+dead letters, and batches hit by an outage are spooled and loaded once ClickHouse is back.
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any
+
+from aiokafka import AIOKafkaConsumer, ConsumerRecord
+from aiokafka.abc import ConsumerRebalanceListener
+from aiokafka.errors import CommitFailedError
+from kafka import TopicPartition
+
+from async_loader import AsyncClickHouseLoader, is_outage
+from batcher import BatchAccumulator, FlushReport
+from clickhouse_loader import ClickHouseLoader
+from config import ETLConfig, config
+from dead_letter import DeadLetterSink, get_dead_letter_sink
+from inflight import AsyncInflightRanges, OffsetRange, dedup_token
+from metrics import CHECKPOINT_SECONDS, CONSUMER_LAG, INSERT_SECONDS, PIPELINE_QUEUE
+from spool import Spool
+from store import Route, account, offset_ranges, partition_chunks, refused, transformed_records
+from transformer import (
+    ColumnBatch,
+    EventColumns,
+    KafkaToClickHouseDataTransformer,
+    RejectedMessage,
+    ViewColumns,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncBatchStore:
+    """BatchStore for the asyncio runtime; several batches of one partition can be stored concurrently.
+
+    The in-flight record of a partition therefore lists the ranges of every batch stored since the last commit,
+    not only the latest one, so a restarted consumer can repeat all of them with the same cuts.
+    """
+
+    def __init__(
+        self,
+        config: ETLConfig,
+        transformer: KafkaToClickHouseDataTransformer,
+        loader: AsyncClickHouseLoader,
+        dead_letters: DeadLetterSink,
+        inflight: AsyncInflightRanges,
+        spool: Spool | None = None,
+    ) -> None:
+        self.loader = loader
+        self.dead_letters = dead_letters
+        self.inflight = inflight
+        self.routes: dict[str, Route] = {
+            config.kafka.views_topic: Route(transformer.transform, loader.load, ViewColumns),
+            config.kafka.events_topic: Route(transformer.transform_events, loader.load_events, EventColumns),
+        }
+        self.spool = spool
+        self.spool_retry_seconds = config.spool.retry_seconds
+        self.spool_retry_at = 0.0
+        # Draining runs in a thread; nothing else may touch the spool meanwhile
+        self.spool_lock = asyncio.Lock()
+        self.replay_cuts: dict[TopicPartition, list[int]] = {}
+        self.uncommitted: dict[TopicPartition, list[OffsetRange]] = {}
+        # Keeps the in-flight records written in the order their batches were handed over
+        self.inflight_lock = asyncio.Lock()
+
+    async def resume(self, positions: dict[TopicPartition, int]) -> dict[TopicPartition, list[OffsetRange]]:
+        unfinished = await self.inflight.unfinished(positions)
+        self.replay_cuts = {tp: [last for _, last in ranges] for tp, ranges in unfinished.items()}
+        self.uncommitted = {tp: list(ranges) for tp, ranges in unfinished.items()}
+        return unfinished
+
+    def committed(self, offsets: dict[TopicPartition, int]) -> None:
+        for tp, offset in offsets.items():
+            self.uncommitted[tp] = [(first, last) for first, last in self.uncommitted.get(tp, []) if last >= offset]
+
+    async def store(self, topic: str, records: list[Any]) -> FlushReport | None:
+        route = self.routes[topic]
+        chunks = partition_chunks(records, self.replay_cuts)
+        started = time.perf_counter()
+        async with self.inflight_lock:
+            ranges = offset_ranges(chunks)
+            for tp, tp_ranges in ranges.items():
+                known = set(self.uncommitted.setdefault(tp, []))
+                self.uncommitted[tp].extend(r for r in tp_ranges if r not in known)
+            with CHECKPOINT_SECONDS.labels("inflight").time():
+                await self.inflight.save({tp: list(self.uncommitted[tp]) for tp in ranges})
+
+        inserts = []
+        rejected: list[RejectedMessage] = []
+        for tp, chunk in chunks:
+            result = route.transform(chunk)
+            rejected.extend(result.rejected)
+            if len(result.columns):
+                token = dedup_token(tp, (chunk[0].offset, chunk[-1].offset))
+                inserts.append(self.insert(topic, route, result.columns, token, transformed_records(chunk, result)))
+        rows = 0
+        for inserted, refused_records in await asyncio.gather(*inserts):
+            rows += inserted
+            rejected.extend(refused_records)
+
+        if rejected:
+            # Rejections are rare, so the blocking sinks are simply run off the event loop
+            await asyncio.to_thread(self.dead_letters.publish, rejected)
+        return account(topic, records, rows, rejected, started)
+
+    async def insert(
+        self, topic: str, route: Route, columns: ColumnBatch, token: str, records: list[Any]
+    ) -> tuple[int, list[RejectedMessage]]:
+        """Insert a chunk and return its inserted rows and, if ClickHouse rejected its data, its dead letters.
+
+        Outages spool the chunk, see BatchStore.load.
+        """
+        if self.spool is not None and len(self.spool) and not await self.drain_spool():
+            await self.park(topic, columns, token)
+            return 0, []
+        try:
+            with INSERT_SECONDS.labels(topic).time():
+                await route.load(columns, token)
+        except Exception as e:
+            if not is_outage(e):
+                return 0, refused(topic, columns, records, e)
+            if self.spool is None:
+                raise
+            logger.error(f"ClickHouse insert failed, spooling {len(columns)} {topic} rows: {e}")
+            await self.park(topic, columns, token)
+            return 0, []
+        return len(columns), []
+
+    async def drain_spool(self) -> bool:
+        assert self.spool is not None
+        if time.monotonic() < self.spool_retry_at:
+            return False
+        loop = asyncio.get_running_loop()
+
+        def load(topic: str, columns: list[list[Any]], token: str | None) -> None:
+            # Called from the draining thread; the insert itself runs on the event loop
+            route = self.routes[topic]
+            try:
+                asyncio.run_coroutine_threadsafe(route.load(route.columns(*columns), token), loop).result()
+            except Exception as e:
+                if is_outage(e):
+                    raise
+                logger.error(f"ClickHouse rejected a spooled {topic} batch {token}, dropping it: {e}")
+
+        async with self.spool_lock:
+            if not len(self.spool):
+                return True
+            try:
+                drained = await asyncio.to_thread(self.spool.drain, load)
+            except Exception as e:
+                self.spool_retry_at = time.monotonic() + self.spool_retry_seconds
+                logger.warning(f"ClickHouse is still failing, {len(self.spool)} batches stay spooled: {e}")
+                return False
+        if drained:
+            logger.info(f"Loaded {drained} spooled batches")
+        return True
+
+    async def park(self, topic: str, columns: ColumnBatch, token: str) -> None:
+        assert self.spool is not None
+        while True:
+            async with self.spool_lock:
+                if self.spool.append(topic, columns, token):
+                    return
+            # Stop consuming rather than drop data; Kafka keeps the messages until there is room again
+            logger.error(f"Spool is full ({self.spool.size} bytes), waiting for ClickHouse")
+            await asyncio.sleep(self.spool_retry_seconds)
+            await self.drain_spool()
+
+    async def close(self) -> None:
+        await asyncio.to_thread(self.dead_letters.close)
+        await self.loader.close()
+        await self.inflight.close()
+        if self.spool is not None:
+            self.spool.close()
+
+
+class AsyncPartitionListener(ConsumerRebalanceListener):
+    def __init__(self, etl: "AsyncETL") -> None:
+        self.etl = etl
+
+    async def on_partitions_revoked(self, revoked: set[TopicPartition]) -> None:
+        if revoked:
+            await self.etl.flush_all()
+        logger.info("Partitions revoked: %s", sorted(revoked))
+
+    async def on_partitions_assigned(self, assigned: set[TopicPartition]) -> None:
+        positions = {tp: await self.etl.consumer.position(tp) for tp in sorted(assigned)}
+        for tp, position in positions.items():
+            logger.info(
+                "Partition %s:%s assigned to %s, resuming from offset %s",
+                tp.topic,
+                tp.partition,
+                config.kafka.client_id,
+                position,
+            )
+        await self.etl.on_assign(positions)
+
+
+class AsyncETL:
+    def __init__(self) -> None:
+        self.consumer = AIOKafkaConsumer(
+            bootstrap_servers=config.kafka.bootstrap_servers,
+            auto_offset_reset=config.kafka.auto_offset_reset,
+            group_id=config.kafka.group_id,
+            client_id=config.kafka.client_id,
+            enable_auto_commit=False,
+        )
+        self.loader = AsyncClickHouseLoader(config.clickhouse)
+        self.store = AsyncBatchStore(
+            config,
+            KafkaToClickHouseDataTransformer(),
+            self.loader,
+            get_dead_letter_sink(config.dead_letter, config.kafka),
+            AsyncInflightRanges(config),
+            Spool(config.spool) if config.spool.path else None,
+        )
+        self.batches: dict[str, BatchAccumulator[ConsumerRecord[bytes, bytes]]] = {
+            topic: BatchAccumulator(batch_size=config.batch_size, max_latency_seconds=config.flush_interval_seconds)
+            for topic in self.store.routes
+        }
+        # Batches being stored, in consumption order, with the offsets to commit once they are done
+        self.pending: deque[tuple[asyncio.Task[FlushReport | None], dict[TopicPartition, int]]] = deque()
+        self.slots = asyncio.Semaphore(config.inflight_batches)
+        self.lag_reported_at = 0.0
+
+    async def on_assign(self, positions: dict[TopicPartition, int]) -> None:
+        unfinished = await self.store.resume(positions)
+        for topic, batch in self.batches.items():
+            batch.boundaries = {tp: ranges[-1][1] for tp, ranges in unfinished.items() if tp.topic == topic}
+        if unfinished:
+            logger.info(f"Repeating unfinished inserts: {unfinished}")
+
+    async def store_batch(self, topic: str, records: list[ConsumerRecord[bytes, bytes]]) -> FlushReport | None:
+        try:
+            return await self.store.store(topic, records) if records else None
+        finally:
+            self.slots.release()
+
+    async def hand_over(self, topic: str) -> None:
+        """Start storing the accumulated batch of a topic, waiting for a free slot if too many are in flight."""
+        batch = self.batches[topic].drain()
+        if not batch.offsets:
+            return
+        await self.slots.acquire()
+        task = asyncio.create_task(self.store_batch(topic, batch.rows))
+        self.pending.append((task, batch.offsets))
+
+    async def commit_stored(self) -> None:
+        """Commit the offsets of the stored batches that are not preceded by a batch still in flight."""
+        offsets: dict[TopicPartition, int] = {}
+        while self.pending and self.pending[0][0].done():
+            task, batch_offsets = self.pending.popleft()
+            # Re-raises a failed store, which stops the runtime before anything later is committed
+            task.result()
+            offsets.update(batch_offsets)
+        if not offsets:
+            return
+        try:
+            with CHECKPOINT_SECONDS.labels("commit").time():
+                await self.consumer.commit(offsets)
+        except CommitFailedError as e:
+            logger.warning("Offsets commit rejected after rebalance: %s", e)
+            return
+        self.store.committed(offsets)
+
+    async def flush_all(self) -> None:
+        """Store everything consumed so far and commit it, e.g. before partitions are revoked."""
+        for topic in self.batches:
+            await self.hand_over(topic)
+        await asyncio.gather(*(task for task, _ in self.pending), return_exceptions=True)
+        await self.commit_stored()
+
+    async def report_lag(self) -> None:
+        now = time.monotonic()
+        if now - self.lag_reported_at < config.metrics_interval_seconds:
+            return
+        self.lag_reported_at = now
+        PIPELINE_QUEUE.set(len(self.pending))
+        for tp in self.consumer.assignment():
+            highwater = self.consumer.highwater(tp)
+            if highwater is not None:
+                CONSUMER_LAG.labels(tp.topic, tp.partition).set(highwater - await self.consumer.position(tp))
+
+    async def run(self) -> None:
+        # DDL stays with the synchronous loader, it runs once per start
+        ClickHouseLoader(config.clickhouse).close()
+        await self.loader.connect()
+        self.consumer.subscribe(
+            [config.kafka.views_topic, config.kafka.events_topic], listener=AsyncPartitionListener(self)
+        )
+        await self.consumer.start()
+        try:
+            while True:
+                fetched = await self.consumer.getmany(timeout_ms=config.poll_timeout_ms)
+                for records in fetched.values():
+                    for message in records:
+                        batch = self.batches[message.topic]
+                        batch.add(message)
+                        batch.track(message.topic, message.partition, message.offset)
+
+                for topic, batch in self.batches.items():
+                    if batch.is_due():
+                        await self.hand_over(topic)
+                await self.commit_stored()
+                await self.report_lag()
+        except Exception as e:
+            logger.exception(f"ETL process stopped with error: {e}")
+        finally:
+            await self.shutdown()
+
+    async def shutdown(self) -> None:
+        """Store what is already consumed and leave the consumer group."""
+        try:
+            await self.flush_all()
+        except BaseException as e:
+            logger.warning(f"Could not store the last batches, they will be consumed again: {e!r}")
+        finally:
+            await self.consumer.stop()
+            await self.store.close()
+            logger.info("ETL process completed")
+
+    def start(self) -> None:
+        asyncio.run(self.run())
+
+    def close(self) -> None:
+        """Nothing to release here, run() shuts everything down when the event loop stops."""
@@ -0,0 +1,101 @@
+import asyncio
+import logging
+from typing import Any
+
+import backoff
+from asynch import create_pool
+from asynch.errors import NetworkError, ServerException, SocketTimeoutError
+from asynch.pool import Pool
+
+from clickhouse_loader import UNAVAILABLE_CODES, split_by_shard
+from config import ClickHouseSettings
+from transformer import ColumnBatch, EventColumns, ViewColumns
+
+logger = logging.getLogger(__name__)
+
+# Errors meaning the node itself is unreachable, so the write can go to another replica
+NODE_DOWN_ERRORS = (NetworkError, SocketTimeoutError, EOFError, OSError, asyncio.TimeoutError)
+
+
+def is_outage(error: BaseException) -> bool:
+    """clickhouse_loader.is_outage for the errors of asynch, which has its own exception classes."""
+    if isinstance(error, NODE_DOWN_ERRORS):
+        return True
+    return isinstance(error, ServerException) and error.code in UNAVAILABLE_CODES
+
+
+class AsyncClickHouseLoader:
+    """ClickHouseLoader over asynch connection pools, so inserts of many batches can be in flight at once.
+
+    Tables are created by the synchronous loader, which the asyncio runtime runs once on start.
+    """
+
+    def __init__(self, config: ClickHouseSettings) -> None:
+        self.config = config
+        self.shards: list[list[Pool]] = []
+
+    @backoff.on_exception(backoff.expo, Exception)
+    async def connect(self) -> None:
+        self.shards = [
+            [
+                await create_pool(
+                    minsize=1,
+                    maxsize=self.config.pool_size,
+                    host=host,
+                    port=port,
+                    user=self.config.user,
+                    password=self.config.password,
+                )
+                for host, port in replicas
+            ]
+            for replicas in self.config.topology()
+        ]
+
+    async def insert(
+        self,
+        table: str,
+        batch: ColumnBatch,
+        settings: dict[str, Any] | None = None,
+        dedup_token: str | None = None,
+    ) -> int:
+        """Send a batch to every shard concurrently, one INSERT per shard."""
+        query = f"INSERT INTO {self.config.database}.{table} ({', '.join(batch.column_names())}) VALUES"
+        inserts = []
+        for shard, columns in enumerate(split_by_shard(batch, len(self.shards))):
+            if not columns or not columns[0]:
+                continue
+            shard_settings = dict(settings or {})
+            if dedup_token is not None:
+                shard_settings["insert_deduplication_token"] = f"{dedup_token}:{shard}"
+            # asynch has no columnar inserts, rows go as tuples
+            inserts.append(self.insert_shard(shard, query, list(zip(*columns)), shard_settings))
+        return sum(await asyncio.gather(*inserts))
+
+    # Bounded, so an outage surfaces to the store, which spools the batch; data errors are not retried at all
+    @backoff.on_exception(backoff.expo, Exception, max_tries=5, giveup=lambda e: not is_outage(e))
+    async def insert_shard(self, shard: int, query: str, rows: list[tuple[Any, ...]], settings: dict[str, Any]) -> int:
+        """Write to the first reachable replica of a shard."""
+        replicas = self.shards[shard]
+        for replica in replicas:
+            try:
+                async with replica.acquire() as connection:
+                    async with connection.cursor() as cursor:
+                        cursor.set_settings(settings)
+                        return await cursor.execute(query, rows)  # type: ignore[no-any-return]
+            except NODE_DOWN_ERRORS as e:
+                logger.warning("ClickHouse shard %s replica is unavailable, failing over: %s", shard, e)
+        raise ConnectionError(f"No reachable replica for shard {shard}")
+
+    async def load(self, batch: ViewColumns, dedup_token: str | None = None) -> int:
+        return await self.insert(self.config.views_table_name, batch, dedup_token=dedup_token)
+
+    async def load_events(self, batch: EventColumns, dedup_token: str | None = None) -> int:
+        return await self.insert(
+            self.config.custom_events_table_name, batch, {"allow_experimental_object_type": 1}, dedup_token
+        )
+
+    async def close(self) -> None:
+        for replicas in self.shards:
+            for pool in replicas:
+                pool.close()
+                await pool.wait_closed()
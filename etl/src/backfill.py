@@ -0,0 +1,181 @@
+"""Reloads a bounded slice of a topic into ClickHouse, e.g. after a schema change or a lost table.
+
+    python backfill.py --topic views --from-time 2024-02-01T00:00 --to-time 2024-02-02T00:00
+    python backfill.py --topic events --from-offset 0 --table events_rebuilt --processes 8
+    python backfill.py --topic views --from-offset 0 --batch-size 1000000 --bulk-dir bulk/
+
+Every partition is read by its own process straight from the given offsets, without joining the live consumer
+group and without committing anything, and is inserted in large batches. Batches are cut at fixed offsets and
+carry deduplication tokens, so running the same backfill twice does not duplicate rows. With --bulk-dir the batches
+go through gzipped RowBinary files streamed over HTTP instead of native inserts (see bulk_loader.py).
+"""
+
+import argparse
+import logging
+import time
+from collections.abc import Callable
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime
+from multiprocessing import get_context
+from typing import Any
+
+from kafka import KafkaConsumer, TopicPartition
+from kafka.consumer.fetcher import ConsumerRecord
+
+from bulk_loader import BulkInserter
+from clickhouse_loader import ClickHouseLoader
+from config import config
+from inflight import dedup_token
+from transformer import ColumnBatch, KafkaToClickHouseDataTransformer, TransformResult
+
+logging.basicConfig(level=logging.INFO)
+
+
+@dataclass(frozen=True)
+class PartitionJob:
+    topic: str
+    partition: int
+    start: int
+    end: int
+    table: str
+    batch_size: int
+    # Load through bulk files in this directory, keeping them afterwards if `keep_files`
+    bulk_dir: str | None = None
+    keep_files: bool = False
+
+
+def to_millis(value: str) -> int:
+    return int(datetime.fromisoformat(value).timestamp() * 1000)
+
+
+def connect() -> KafkaConsumer:
+    return KafkaConsumer(
+        bootstrap_servers=config.kafka.bootstrap_servers,
+        enable_auto_commit=False,
+        fetch_max_bytes=64 * 1024 * 1024,
+        max_partition_fetch_bytes=16 * 1024 * 1024,
+    )
+
+
+def plan(args: argparse.Namespace) -> list[PartitionJob]:
+    """Resolve the requested time or offset bounds to an offset range per partition."""
+    consumer = connect()
+    try:
+        partitions = [TopicPartition(args.topic, p) for p in sorted(consumer.partitions_for_topic(args.topic) or ())]
+        beginning = consumer.beginning_offsets(partitions)
+        end = consumer.end_offsets(partitions)
+
+        starts = dict(beginning)
+        if args.from_offset is not None:
+            starts = {tp: max(args.from_offset, beginning[tp]) for tp in partitions}
+        elif args.from_time is not None:
+            found = consumer.offsets_for_times({tp: to_millis(args.from_time) for tp in partitions})
+            starts = {tp: found[tp].offset if found[tp] else end[tp] for tp in partitions}
+
+        ends = dict(end)
+        if args.to_offset is not None:
+            ends = {tp: min(args.to_offset, end[tp]) for tp in partitions}
+        elif args.to_time is not None:
+            found = consumer.offsets_for_times({tp: to_millis(args.to_time) for tp in partitions})
+            ends = {tp: found[tp].offset if found[tp] else end[tp] for tp in partitions}
+    finally:
+        consumer.close()
+
+    return [
+        PartitionJob(
+            tp.topic, tp.partition, starts[tp], ends[tp], args.table, args.batch_size, args.bulk_dir, args.keep_files
+        )
+        for tp in partitions
+        if starts[tp] < ends[tp]
+    ]
+
+
+def backfill_partition(job: PartitionJob) -> int:
+    tp = TopicPartition(job.topic, job.partition)
+    consumer = connect()
+    consumer.assign([tp])
+    consumer.seek(tp, job.start)
+    loader = ClickHouseLoader(config.clickhouse)
+    target: ClickHouseLoader | BulkInserter = loader
+    if job.bulk_dir:
+        target = BulkInserter(config.clickhouse, f"{job.bulk_dir}/{job.topic}-{job.partition}", job.keep_files)
+    transformer = KafkaToClickHouseDataTransformer()
+    transform: Callable[[list[ConsumerRecord]], TransformResult[Any]] = transformer.transform
+    settings: dict[str, Any] = {}
+    if job.topic == config.kafka.events_topic:
+        transform, settings = transformer.transform_events, {"allow_experimental_object_type": 1}
+
+    loaded = rejected = 0
+    records: list[ConsumerRecord] = []
+    # Chunks always end at start + k * batch_size - 1, so a rerun produces the same dedup tokens
+    chunk_end = job.start + job.batch_size - 1
+    try:
+        while consumer.position(tp) < job.end:
+            for record in consumer.poll(timeout_ms=1000, max_records=job.batch_size).get(tp, []):
+                if record.offset >= job.end:
+                    break
+                if record.offset > chunk_end and records:
+                    result = transform(records)
+                    load(target, job, records, result.columns, settings)
+                    loaded, rejected = loaded + len(result.columns), rejected + len(result.rejected)
+                    records = []
+                while record.offset > chunk_end:
+                    chunk_end += job.batch_size
+                records.append(record)
+        if records:
+            result = transform(records)
+            load(target, job, records, result.columns, settings)
+            loaded, rejected = loaded + len(result.columns), rejected + len(result.rejected)
+    finally:
+        consumer.close()
+        loader.close()
+
+    logging.info(f"Partition {job.topic}:{job.partition} done: {loaded} rows loaded, {rejected} rejected")
+    return loaded
+
+
+def load(
+    loader: ClickHouseLoader | BulkInserter,
+    job: PartitionJob,
+    records: list[ConsumerRecord],
+    columns: ColumnBatch,
+    settings: dict[str, Any],
+) -> None:
+    if len(columns):
+        token = dedup_token(TopicPartition(job.topic, job.partition), (records[0].offset, records[-1].offset))
+        loader.insert(job.table, columns, settings, f"backfill:{job.table}:{token}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Reload a time or offset range of a topic into ClickHouse")
+    parser.add_argument("--topic", default=config.kafka.views_topic)
+    parser.add_argument("--table", help="target table, by default the topic's live table")
+    parser.add_argument("--from-time", help="ISO datetime of the first message")
+    parser.add_argument("--to-time", help="ISO datetime to stop before")
+    parser.add_argument("--from-offset", type=int)
+    parser.add_argument("--to-offset", type=int, help="offset to stop before, in every partition")
+    parser.add_argument("--batch-size", type=int, default=100_000)
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--bulk-dir", help="load through gzipped RowBinary files written to this directory")
+    parser.add_argument("--keep-files", action="store_true", help="keep the bulk files after loading them")
+    args = parser.parse_args()
+    if args.table is None:
+        tables = {
+            config.kafka.views_topic: config.clickhouse.views_table_name,
+            config.kafka.events_topic: config.clickhouse.custom_events_table_name,
+        }
+        args.table = tables[args.topic]
+
+    jobs = plan(args)
+    logging.info(f"Backfilling {sum(job.end - job.start for job in jobs)} messages from {len(jobs)} partitions")
+    started = time.perf_counter()
+    processes = max(1, min(args.processes, len(jobs)))
+    with ProcessPoolExecutor(max_workers=processes, mp_context=get_context("spawn")) as pool:
+        loaded = sum(pool.map(backfill_partition, jobs))
+    seconds = time.perf_counter() - started
+    logging.info(f"Backfilled {loaded} rows into {args.table} in {seconds:.1f}s ({loaded / seconds:.0f} rows/s)")
+
+
+if __name__ == "__main__":
+    main()
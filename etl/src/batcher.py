@@ -0,0 +1,77 @@
+import time
+from dataclasses import dataclass, field
+from typing import Generic, TypeVar
+
+from kafka import TopicPartition
+
+T = TypeVar("T")
+
+
+@dataclass(frozen=True)
+class FlushReport:
+    rows: int
+    seconds: float
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds else float(self.rows)
+
+
+@dataclass
+class Batch(Generic[T]):
+    rows: list[T] = field(default_factory=list)
+    # Next offset to consume per partition, i.e. what to commit once the rows are stored
+    offsets: dict[TopicPartition, int] = field(default_factory=dict)
+
+
+class BatchAccumulator(Generic[T]):
+    """Collects rows until the batch is full or the oldest message waited too long."""
+
+    def __init__(self, batch_size: int, max_latency_seconds: float) -> None:
+        self.batch_size = batch_size
+        self.max_latency_seconds = max_latency_seconds
+        self.batch: Batch[T] = Batch()
+        self.opened_at: float | None = None
+        # Offsets the batch has to reach before it is flushed, to repeat unfinished inserts exactly
+        self.boundaries: dict[TopicPartition, int] = {}
+        self.cut = False
+
+    def __len__(self) -> int:
+        return len(self.batch.rows)
+
+    def track(self, topic: str, partition: int, offset: int) -> None:
+        """Remember that a message was consumed, even if it produced no row."""
+        if self.opened_at is None:
+            self.opened_at = time.monotonic()
+        tp = TopicPartition(topic, partition)
+        self.batch.offsets[tp] = offset + 1
+        if tp in self.boundaries and offset >= self.boundaries[tp]:
+            del self.boundaries[tp]
+            self.cut = not self.boundaries
+
+    def add(self, row: T) -> None:
+        self.batch.rows.append(row)
+
+    def is_due(self) -> bool:
+        if self.opened_at is None:
+            return False
+        if self.cut:
+            return True
+        if self.boundaries:
+            # A smaller batch would not repeat the unfinished inserts, so hold it until every boundary is reached
+            return False
+        if len(self.batch.rows) >= self.batch_size:
+            return True
+        return time.monotonic() - self.opened_at >= self.max_latency_seconds
+
+    def seconds_until_due(self) -> float | None:
+        """How long the batch may keep waiting for messages, None if only new messages can make it due."""
+        if self.opened_at is None or self.boundaries and not self.cut:
+            return None
+        if self.cut or len(self.batch.rows) >= self.batch_size:
+            return 0.0
+        return max(0.0, self.max_latency_seconds - (time.monotonic() - self.opened_at))
+
+    def drain(self) -> Batch[T]:
+        batch, self.batch, self.opened_at, self.cut = self.batch, Batch(), None, False
+        return batch
@@ -0,0 +1,220 @@
+"""Bulk load path: transformed batches are written to gzipped RowBinary files and streamed into ClickHouse over HTTP.
+
+    python bulk_loader.py bulk/             # load every complete file in the directory, deleting loaded ones
+    python bulk_loader.py bulk/ --keep      # load but keep the files, e.g. to replay them into another cluster
+
+A batch becomes one file per shard, rows split by user_id as in ClickHouseLoader.insert. Next to every data file a
+`.json` manifest names the table, the column types, the shard and the deduplication token. The manifest is written
+last, so a file without one is incomplete and is ignored. Each file is sent in a single streamed POST to the HTTP
+interface of its shard, `Content-Encoding: gzip`, and parsed by ClickHouse through `input()`, so event payloads
+arrive as String and are cast to the JSON column there. A failed file is retried on its own and on the next replica,
+and carries its token, so loading a directory twice does not duplicate rows.
+"""
+
+import argparse
+import gzip
+import http.client
+import logging
+import os
+import struct
+import time
+from pathlib import Path
+from typing import Any
+from urllib.parse import urlencode
+
+import backoff
+import orjson
+
+from clickhouse_loader import NODE_DOWN_ERRORS, split_by_shard
+from config import ClickHouseSettings, config
+from transformer import ColumnBatch, EventColumns, SessionColumns, ViewColumns
+from wire import write_varint
+
+DATA_SUFFIX = ".rowbinary.gz"
+MANIFEST_SUFFIX = ".json"
+# Bytes of encoded rows buffered before they go to the compressor
+WRITE_BUFFER = 1024 * 1024
+
+# ClickHouse types of every column batch, in column order
+COLUMN_TYPES: dict[type[ColumnBatch], list[str]] = {
+    ViewColumns: ["UUID", "UUID", "Int32", "DateTime"],
+    EventColumns: ["UUID", "UUID", "String", "String", "DateTime"],
+    SessionColumns: ["UUID", "UUID", "DateTime", "DateTime", "Int32", "UInt32"],
+}
+# RowBinary UUIDs are two little-endian UInt64 halves, the high half first
+UUID_HALVES = struct.Struct("<QQ")
+LOW_HALF = (1 << 64) - 1
+FIXED = {"Int32": struct.Struct("<i"), "UInt32": struct.Struct("<I"), "DateTime": struct.Struct("<I")}
+
+
+class BulkLoadError(Exception):
+    pass
+
+
+def encode_rows(columns: list[list[Any]], types: list[str], out: gzip.GzipFile) -> None:
+    buffer = bytearray()
+    for row in zip(*columns):
+        for value, type_ in zip(row, types):
+            if type_ == "UUID":
+                number = value.int
+                buffer += UUID_HALVES.pack(number >> 64, number & LOW_HALF)
+            elif type_ == "String":
+                data = value.encode()
+                write_varint(len(data), buffer)
+                buffer += data
+            else:
+                buffer += FIXED[type_].pack(value)
+        if len(buffer) >= WRITE_BUFFER:
+            out.write(buffer)
+            buffer.clear()
+    out.write(buffer)
+
+
+class BulkWriter:
+    """Writes batches as complete, fsynced files; the manifest is renamed into place last."""
+
+    def __init__(self, directory: str, shards: int) -> None:
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.shards = shards
+
+    def write(
+        self, table: str, batch: ColumnBatch, dedup_token: str, settings: dict[str, Any] | None = None
+    ) -> list[Path]:
+        """Write a batch as one file per shard and return their manifests."""
+        names = batch.column_names()
+        types = COLUMN_TYPES[type(batch)]
+        manifests = []
+        for shard, columns in enumerate(split_by_shard(batch, self.shards)):
+            if not columns or not columns[0]:
+                continue
+            token = f"{dedup_token}:{shard}"
+            stem = self.directory / token.replace(":", "_").replace("/", "_")
+            data = stem.with_name(stem.name + DATA_SUFFIX)
+            with data.open("wb") as raw:
+                # Level 1: the files are read once and the time goes into writing them
+                with gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=1) as compressed:
+                    encode_rows(columns, types, compressed)
+                raw.flush()
+                os.fsync(raw.fileno())
+            manifest = stem.with_name(stem.name + MANIFEST_SUFFIX)
+            partial = manifest.with_name(manifest.name + ".tmp")
+            partial.write_bytes(
+                orjson.dumps(
+                    {
+                        "table": table,
+                        "columns": [[name, type_] for name, type_ in zip(names, types)],
+                        "shard": shard,
+                        "rows": len(columns[0]),
+                        "data": data.name,
+                        "dedup_token": token,
+                        "settings": settings or {},
+                    }
+                )
+            )
+            os.replace(partial, manifest)
+            manifests.append(manifest)
+        return manifests
+
+
+class BulkLoader:
+    """Streams bulk files into the HTTP interface of their shard's first reachable replica."""
+
+    def __init__(self, settings: ClickHouseSettings) -> None:
+        self.config = settings
+        self.shards = [[host for host, _ in replicas] for replicas in settings.topology()]
+
+    def query(self, manifest: dict[str, Any]) -> str:
+        names = ", ".join(name for name, _ in manifest["columns"])
+        structure = ", ".join(f"{name} {type_}" for name, type_ in manifest["columns"])
+        return (
+            f"INSERT INTO {self.config.database}.{manifest['table']} ({names}) "
+            f"SELECT {names} FROM input('{structure}') FORMAT RowBinary"
+        )
+
+    @backoff.on_exception(backoff.expo, (BulkLoadError, *NODE_DOWN_ERRORS), max_tries=5)
+    def load_file(self, manifest_path: Path) -> int:
+        manifest = orjson.loads(manifest_path.read_bytes())
+        data = manifest_path.with_name(manifest["data"])
+        params = {
+            "query": self.query(manifest),
+            "insert_deduplication_token": manifest["dedup_token"],
+            **manifest["settings"],
+        }
+        headers = {
+            "Content-Encoding": "gzip",
+            "Content-Length": str(data.stat().st_size),
+            "X-ClickHouse-User": self.config.user,
+            "X-ClickHouse-Key": self.config.password,
+        }
+        replicas = self.shards[manifest["shard"]]
+        for host in replicas:
+            connection = http.client.HTTPConnection(host, self.config.http_port, timeout=self.config.http_timeout)
+            try:
+                with data.open("rb") as body:
+                    connection.request("POST", f"/?{urlencode(params)}", body=body, headers=headers)
+                response = connection.getresponse()
+                reply = response.read()
+                if response.status != http.client.OK:
+                    raise BulkLoadError(f"{host} rejected {data.name}: {response.status} {reply.decode()[:500]}")
+                return manifest["rows"]  # type: ignore[no-any-return]
+            except NODE_DOWN_ERRORS as e:
+                logging.warning(f"ClickHouse node {host} is unavailable, failing over: {e}")
+            finally:
+                connection.close()
+        raise BulkLoadError(f"No reachable replica for shard {manifest['shard']}: {replicas}")
+
+    def load_directory(self, directory: str, keep: bool = False) -> int:
+        """Load every complete file, oldest first, removing each one once it is in ClickHouse unless `keep`."""
+        rows = 0
+        for manifest in sorted(Path(directory).glob(f"*{MANIFEST_SUFFIX}"), key=lambda path: path.stat().st_mtime):
+            rows += self.load_file(manifest)
+            if not keep:
+                self.remove(manifest)
+        return rows
+
+    @staticmethod
+    def remove(manifest: Path) -> None:
+        data = manifest.with_name(orjson.loads(manifest.read_bytes())["data"])
+        manifest.unlink()
+        data.unlink(missing_ok=True)
+
+
+class BulkInserter:
+    """ClickHouseLoader.insert through bulk files: every batch is written, streamed in and then removed."""
+
+    def __init__(self, settings: ClickHouseSettings, directory: str, keep: bool = False) -> None:
+        self.writer = BulkWriter(directory, len(settings.topology()))
+        self.loader = BulkLoader(settings)
+        self.keep = keep
+
+    def insert(
+        self,
+        table: str,
+        batch: ColumnBatch,
+        settings: dict[str, Any] | None = None,
+        dedup_token: str | None = None,
+    ) -> int:
+        rows = 0
+        for manifest in self.writer.write(table, batch, dedup_token or f"bulk:{table}:{time.time_ns()}", settings):
+            rows += self.loader.load_file(manifest)
+            if not self.keep:
+                self.loader.remove(manifest)
+        return rows
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Load bulk RowBinary files into ClickHouse")
+    parser.add_argument("directory")
+    parser.add_argument("--keep", action="store_true", help="keep loaded files instead of deleting them")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    started = time.perf_counter()
+    rows = BulkLoader(config.clickhouse).load_directory(args.directory, keep=args.keep)
+    seconds = time.perf_counter() - started
+    logging.info(f"Loaded {rows} rows from {args.directory} in {seconds:.1f}s ({rows / max(seconds, 1e-9):.0f} rows/s)")
+
+
+if __name__ == "__main__":
+    main()
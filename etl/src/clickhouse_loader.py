@@ -1,54 +1,327 @@
 import logging
+import queue
+from collections.abc import Generator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any
 
 import backoff
 from clickhouse_driver import Client
+from clickhouse_driver.errors import ErrorCodes, NetworkError, ServerException, SocketTimeoutError
 
 from config import ClickHouseSettings
-from transformer import FilmViewEventDTO
+from topology import shard_of
+from transformer import ColumnBatch, EventColumns, SessionColumns, ViewColumns
+
+logger = logging.getLogger(__name__)
+
+# Errors meaning the node itself is unreachable, so the write can go to another replica
+NODE_DOWN_ERRORS = (NetworkError, SocketTimeoutError, EOFError, OSError)
+# Server errors that pass by themselves: the node, ZooKeeper or a replica cannot take writes for now
+UNAVAILABLE_CODES = frozenset(
+    {
+        ErrorCodes.ABORTED,
+        ErrorCodes.ALL_CONNECTION_TRIES_FAILED,
+        ErrorCodes.CANNOT_ALLOCATE_MEMORY,
+        ErrorCodes.KEEPER_EXCEPTION,
+        ErrorCodes.MEMORY_LIMIT_EXCEEDED,
+        ErrorCodes.NETWORK_ERROR,
+        ErrorCodes.NO_AVAILABLE_REPLICA,
+        ErrorCodes.NO_ZOOKEEPER,
+        ErrorCodes.NOT_ENOUGH_SPACE,
+        ErrorCodes.READONLY,
+        ErrorCodes.SOCKET_TIMEOUT,
+        ErrorCodes.TABLE_IS_READ_ONLY,
+        ErrorCodes.TIMEOUT_EXCEEDED,
+        ErrorCodes.TOO_LESS_LIVE_REPLICAS,
+        ErrorCodes.TOO_MANY_PARTS,
+        ErrorCodes.TOO_MANY_SIMULTANEOUS_QUERIES,
+        ErrorCodes.UNKNOWN_STATUS_OF_INSERT,
+        ErrorCodes.UNSATISFIED_QUORUM_FOR_PREVIOUS_WRITE,
+    }
+)
+
+# Second copy of the raw rows sorted for per-film scans, picked by the optimizer for `WHERE film_id = ...`
+FILM_PROJECTION = "by_film"
+VIEWS_FILM_PROJECTION = "SELECT * ORDER BY film_id, record_time"
+# The JSON payload stays out of the projection, film-level event queries rarely need it
+EVENTS_FILM_PROJECTION = "SELECT user_id, film_id, event_type, record_time ORDER BY film_id, record_time"
+EVENT_TYPE_INDEX_NAME = "event_type_bloom"
+EVENT_TYPE_INDEX = f"{EVENT_TYPE_INDEX_NAME} event_type TYPE bloom_filter(0.01) GRANULARITY 4"
+
+
+class ClientPool:
+    """Reusable connections to one ClickHouse node; a clickhouse_driver Client serves one query at a time."""
+
+    def __init__(self, config: ClickHouseSettings, host: str, port: int) -> None:
+        self.config = config
+        self.host = host
+        self.port = port
+        self.idle: queue.LifoQueue[Client] = queue.LifoQueue(maxsize=config.pool_size)
+
+    def __repr__(self) -> str:
+        return f"{self.host}:{self.port}"
+
+    @contextmanager
+    def acquire(self) -> Generator[Client, None, None]:
+        try:
+            client = self.idle.get_nowait()
+        except queue.Empty:
+            client = Client(
+                host=self.host, port=self.port, user=self.config.user, password=self.config.password
+            )
+        try:
+            yield client
+        except NODE_DOWN_ERRORS:
+            client.disconnect()
+            raise
+        try:
+            self.idle.put_nowait(client)
+        except queue.Full:
+            client.disconnect()
+
+
+def is_outage(error: BaseException) -> bool:
+    """Whether an insert failed because ClickHouse is unavailable, so the same rows can succeed later.
+
+    Anything else, e.g. a value the column type cannot hold, fails again however often the batch is retried.
+    """
+    if isinstance(error, NODE_DOWN_ERRORS):
+        return True
+    return isinstance(error, ServerException) and error.code in UNAVAILABLE_CODES
+
+
+def split_by_shard(batch: ColumnBatch, shards: int) -> list[list[list[Any]]]:
+    """Split column arrays into one set per shard, hashing rows by user_id."""
+    columns = batch.columns()
+    if shards == 1:
+        return [columns]
+    rows_by_shard: list[list[int]] = [[] for _ in range(shards)]
+    for row, user_id in enumerate(batch.user_id):  # type: ignore[attr-defined]
+        rows_by_shard[shard_of(user_id, shards)].append(row)
+    return [[[column[row] for row in rows] for column in columns] for rows in rows_by_shard]
 
 
 class ClickHouseLoader:
     def __init__(self, config: ClickHouseSettings) -> None:
         self.config = config
+        self.shards = [[ClientPool(config, host, port) for host, port in replicas] for replicas in config.topology()]
+        self.executor = ThreadPoolExecutor(max_workers=len(self.shards), thread_name_prefix="clickhouse-shard")
         self.client = self.connect()
         self.init_database_and_tables()
 
     @backoff.on_exception(backoff.expo, Exception)
     def connect(self) -> Client:
+        """Connection for DDL, which is distributed with ON CLUSTER from the first node."""
+        host, port = self.config.topology()[0][0]
         return Client(
-            host=self.config.host,
-            port=self.config.port,
+            host=host,
+            port=port,
             user=self.config.user,
             password=self.config.password
         )
 
+    def on_cluster(self) -> str:
+        """Clause distributing DDL to every node of the configured cluster, empty for a single server."""
+        return f" ON CLUSTER {self.config.cluster}" if self.config.cluster else ""
+
+    def views_schema(self) -> str:
+        return f"user_id UUID, film_id UUID, number_seconds_viewing INTEGER, record_time DateTime, \
+            PROJECTION {FILM_PROJECTION} ({VIEWS_FILM_PROJECTION})"
+
+    def events_schema(self) -> str:
+        return f"user_id UUID, film_id UUID, event_type String, message JSON, record_time DateTime, \
+            INDEX {EVENT_TYPE_INDEX}, PROJECTION {FILM_PROJECTION} ({EVENTS_FILM_PROJECTION})"
+
+    def ttl(self) -> str:
+        """TTL expression of the configured retention, empty if data is kept forever on one volume."""
+        rules = []
+        if self.config.cold_after_days:
+            rules.append(
+                f"record_time + INTERVAL {self.config.cold_after_days} DAY TO VOLUME '{self.config.cold_volume}'"
+            )
+        if self.config.ttl_days:
+            rules.append(f"record_time + INTERVAL {self.config.ttl_days} DAY DELETE")
+        return ", ".join(rules)
+
+    def engine(self, family: str = "MergeTree") -> str:
+        """Table engine of the given MergeTree family, replicated between the replicas of a shard if configured.
+
+        The ZooKeeper path and replica name come from the `shard` and `replica` macros of every node.
+        """
+        if not self.config.replicated:
+            return f"{family}()"
+        return f"Replicated{family}('/clickhouse/tables/{{shard}}/{{database}}/{{table}}', '{{replica}}')"
+
+    def deduplication_setting(self) -> str:
+        """Setting that keeps recent insert tokens: per node for plain tables, shared through ZooKeeper otherwise."""
+        prefix = "replicated" if self.config.replicated else "non_replicated"
+        return f"{prefix}_deduplication_window = {self.config.deduplication_window}"
+
+    def create_table(self, table: str, schema: str) -> None:
+        """Create a raw table partitioned by month, so time-range scans and TTL deletes touch few parts."""
+        layout = "PARTITION BY toYYYYMM(record_time) ORDER BY (user_id, film_id)"
+        if ttl := self.ttl():
+            layout += f" TTL {ttl}"
+        if self.config.storage_policy:
+            layout += f" SETTINGS storage_policy = '{self.config.storage_policy}'"
+        self.client.execute(
+            f"CREATE TABLE IF NOT EXISTS {self.config.database}.{table}{self.on_cluster()} \
+                ({schema}) ENGINE = {self.engine()} {layout}",
+            settings={"allow_experimental_object_type": 1},
+        )
+
+    def create_film_daily(self, table: str) -> None:
+        self.client.execute(
+            f"CREATE TABLE IF NOT EXISTS {self.config.database}.{table}{self.on_cluster()} \
+                (film_id UUID, day Date, views SimpleAggregateFunction(sum, UInt64), \
+                    watch_seconds SimpleAggregateFunction(sum, Int64), viewers AggregateFunction(uniq, UUID)) \
+                    ENGINE = {self.engine('AggregatingMergeTree')} ORDER BY (film_id, day)"
+        )
+
+    def create_user_daily(self, table: str) -> None:
+        self.client.execute(
+            f"CREATE TABLE IF NOT EXISTS {self.config.database}.{table}{self.on_cluster()} \
+                (user_id UUID, day Date, views UInt64, watch_seconds Int64) \
+                    ENGINE = {self.engine('SummingMergeTree')} ORDER BY (user_id, day)"
+        )
+
+    def create_sessions(self, table: str) -> None:
+        self.client.execute(
+            f"CREATE TABLE IF NOT EXISTS {self.config.database}.{table}{self.on_cluster()} \
+                (user_id UUID, film_id UUID, session_start DateTime, session_end DateTime, \
+                    max_position Int32, heartbeats UInt32) ENGINE = {self.engine()} \
+                    PARTITION BY toYYYYMM(session_start) ORDER BY (user_id, film_id, session_start)"
+        )
+
+    def partition_key(self, table: str) -> str | None:
+        """Partition key of an existing table, None if there is no such table."""
+        rows = self.client.execute(
+            "SELECT partition_key FROM system.tables WHERE database = %(database)s AND name = %(table)s",
+            {"database": self.config.database, "table": table},
+        )
+        return rows[0][0] if rows else None
+
+    def engine_name(self, table: str) -> str | None:
+        """Engine of an existing table, None if there is no such table."""
+        rows = self.client.execute(
+            "SELECT engine FROM system.tables WHERE database = %(database)s AND name = %(table)s",
+            {"database": self.config.database, "table": table},
+        )
+        return rows[0][0] if rows else None
+
+    def needs_replication(self, table: str) -> bool:
+        """Whether an existing table is still plain MergeTree although replication is configured."""
+        engine = self.engine_name(table)
+        return self.config.replicated and engine is not None and not engine.startswith("Replicated")
+
     @backoff.on_exception(backoff.expo, Exception)
     def init_database_and_tables(self) -> None:
-        cluster_name = self.config.cluster
         database = self.config.database
 
-        self.client.execute(f"CREATE DATABASE IF NOT EXISTS {database} ON CLUSTER {cluster_name}")
+        self.client.execute(f"CREATE DATABASE IF NOT EXISTS {database}{self.on_cluster()}")
+        self.create_table(self.config.views_table_name, self.views_schema())
+        self.create_table(self.config.custom_events_table_name, self.events_schema())
+        for table in (self.config.views_table_name, self.config.custom_events_table_name):
+            self.keep_insert_tokens(table)
+            if not self.partition_key(table):
+                logger.warning("Table %s.%s has the old unpartitioned layout, run migrate_tables.py", database, table)
+        self.init_view_aggregates()
+        self.init_sessions()
+        for table in self.config.table_names():
+            if self.needs_replication(table):
+                logger.warning("Table %s.%s is not replicated, run migrate_tables.py", database, table)
+
+    @backoff.on_exception(backoff.expo, Exception)
+    def init_view_aggregates(self) -> None:
+        """Pre-aggregated view statistics, filled by materialized views on every insert into the views table.
+
+        Aggregate states have to be merged at read time, e.g.
+        `SELECT film_id, sum(watch_seconds), uniqMerge(viewers) FROM film_daily_views GROUP BY film_id`.
+        """
+        database = self.config.database
+        views_table = f"{database}.{self.config.views_table_name}"
+        film_daily_table = f"{database}.{self.config.film_daily_table_name}"
+        user_daily_table = f"{database}.{self.config.user_daily_table_name}"
+
+        self.create_film_daily(self.config.film_daily_table_name)
         self.client.execute(
-            f"CREATE TABLE IF NOT EXISTS {database}.{self.config.views_table_name} ON CLUSTER {cluster_name} \
-                (user_id UUID, film_id UUID, number_seconds_viewing INTEGER, record_time DateTime) \
-                    ENGINE = MergeTree() ORDER BY (user_id, film_id)"
+            f"CREATE MATERIALIZED VIEW IF NOT EXISTS {film_daily_table}_mv{self.on_cluster()} \
+                TO {film_daily_table} AS SELECT film_id, toDate(record_time) AS day, count() AS views, \
+                    sum(number_seconds_viewing) AS watch_seconds, uniqState(user_id) AS viewers \
+                    FROM {views_table} GROUP BY film_id, day"
         )
-        self.client.execute("SET allow_experimental_object_type = 1;")
+        self.create_user_daily(self.config.user_daily_table_name)
         self.client.execute(
-            f"CREATE TABLE IF NOT EXISTS {database}.{self.config.custom_events_table_name} ON CLUSTER {cluster_name} \
-                (user_id UUID, film_id UUID, event_type String, message JSON, record_time DateTime) \
-                    ENGINE = MergeTree() ORDER BY (user_id, film_id)"
+            f"CREATE MATERIALIZED VIEW IF NOT EXISTS {user_daily_table}_mv{self.on_cluster()} \
+                TO {user_daily_table} AS SELECT user_id, toDate(record_time) AS day, count() AS views, \
+                    sum(number_seconds_viewing) AS watch_seconds \
+                    FROM {views_table} GROUP BY user_id, day"
         )
 
     @backoff.on_exception(backoff.expo, Exception)
-    def load(self, message: FilmViewEventDTO) -> int | None:
-        """Метод для загрузки данных в Clickhouse."""
-        data = [message]
-        logging.error(data)
-        query = f"""
-            INSERT INTO shard.{self.config.views_table_name}
-            (user_id, film_id, number_seconds_viewing, record_time) VALUES"""
+    def init_sessions(self) -> None:
+        """Watch sessions assembled from view heartbeats by the ETL, see sessions.py."""
+        self.create_sessions(self.config.sessions_table_name)
+        self.keep_insert_tokens(self.config.sessions_table_name)
+
+    def keep_insert_tokens(self, table: str) -> None:
+        """Let a table drop repeated inserts carrying an already seen deduplication token."""
+        self.client.execute(
+            f"ALTER TABLE {self.config.database}.{table}{self.on_cluster()} \
+                MODIFY SETTING {self.deduplication_setting()}"
+        )
+
+    def insert(
+        self,
+        table: str,
+        batch: ColumnBatch,
+        settings: dict[str, Any] | None = None,
+        dedup_token: str | None = None,
+    ) -> int:
+        """Send a batch to every shard in parallel, one columnar INSERT per shard."""
+        query = f"INSERT INTO {self.config.database}.{table} ({', '.join(batch.column_names())}) VALUES"
+        parts = split_by_shard(batch, len(self.shards))
+        futures = []
+        for shard, columns in enumerate(parts):
+            if not columns or not columns[0]:
+                continue
+            shard_settings = dict(settings or {})
+            if dedup_token is not None:
+                shard_settings["insert_deduplication_token"] = f"{dedup_token}:{shard}"
+            futures.append(self.executor.submit(self.insert_shard, shard, query, columns, shard_settings))
+        return sum(future.result() for future in futures)
+
+    # Bounded, so an outage surfaces to the store, which spools the batch instead of blocking the consumer
+    @backoff.on_exception(backoff.expo, Exception, max_tries=5, giveup=lambda e: not is_outage(e))
+    def insert_shard(
+        self, shard: int, query: str, columns: list[list[Any]], settings: dict[str, Any] | None = None
+    ) -> int:
+        """Write to the first reachable replica of a shard."""
+        replicas = self.shards[shard]
+        for replica in replicas:
+            try:
+                with replica.acquire() as client:
+                    return client.execute(  # type: ignore[no-any-return]
+                        query, columns, columnar=True, settings=settings
+                    )
+            except NODE_DOWN_ERRORS as e:
+                logger.warning("ClickHouse node %s is unavailable, failing over: %s", replica, e)
+        raise NetworkError(f"No reachable replica for shard {shard}: {replicas}")
 
-        return self.client.execute(  # type: ignore[no-any-return]
-            query, ((row.user_id, row.film_id, row.number_seconds_viewing, row.record_time) for row in data)
+    def load(self, batch: ViewColumns, dedup_token: str | None = None) -> int:
+        """Метод для пакетной загрузки просмотров в Clickhouse."""
+        return self.insert(self.config.views_table_name, batch, dedup_token=dedup_token)
+
+    def load_events(self, batch: EventColumns, dedup_token: str | None = None) -> int:
+        """Метод для пакетной загрузки пользовательских событий в Clickhouse."""
+        return self.insert(
+            self.config.custom_events_table_name, batch, {"allow_experimental_object_type": 1}, dedup_token
         )
+
+    def load_sessions(self, batch: SessionColumns, dedup_token: str | None = None) -> int:
+        return self.insert(self.config.sessions_table_name, batch, dedup_token=dedup_token)
+
+    def close(self) -> None:
+        self.executor.shutdown()
+        self.client.disconnect()
@@ -1,56 +1,230 @@
+import socket
+
 from pydantic import Field
 from pydantic_settings import BaseSettings
 
+from topology import parse_topology
+
 VIEWS_TOPIC = "views"
 EVENTS_TOPIC = "events"
+DEAD_LETTER_TOPIC = "dead_letter"
 
 
 class KafkaSettings(BaseSettings):
-    bootstrap_servers: str = Field("kafka-node1:9092", env="KAFKA_BOOTSTRAP_SERVERS")  # type: ignore[call-arg]
+    bootstrap_servers: str = Field(default="kafka-node1:9092", validation_alias="KAFKA_BOOTSTRAP_SERVERS")
     auto_offset_reset: str = "earliest"
     group_id: str = "echo-messages-to-stdout"
+    client_id: str = Field(default=socket.gethostname(), validation_alias="KAFKA_CLIENT_ID")
     views_topic: str = VIEWS_TOPIC
     events_topic: str = EVENTS_TOPIC
     enable_auto_commit: bool = False
+    # Fetch sizes of the consumer; records returned per poll follow the adaptive batch size at runtime
+    fetch_min_bytes: int = 1
+    fetch_max_wait_ms: int = 500
+    max_partition_fetch_bytes: int = Field(default=8 * 1024**2, validation_alias="KAFKA_MAX_PARTITION_FETCH_BYTES")
+    fetch_max_bytes: int = Field(default=64 * 1024**2, validation_alias="KAFKA_FETCH_MAX_BYTES")
 
     class Config:
         env_file = ".env"
         env_file_encoding = "utf-8"
+        populate_by_name = True
 
 
 class ClickHouseSettings(BaseSettings):
-    host: str = Field("clickhouse-node1", env="CLICKHOUSE_HOST")  # type: ignore[call-arg]
+    host: str = Field(default="clickhouse-node1", validation_alias="CLICKHOUSE_HOST")
     port: int = 9000
-    cluster: str = Field("company_cluster", env="CLICKHOUSE_CLUSTER")  # type: ignore[call-arg]
-    database: str = Field("shard", env="CLICKHOUSE_DATABASE")  # type: ignore[call-arg]
-    user: str = Field("admin", env="CLICKHOUSE_USER")  # type: ignore[call-arg]
-    password: str = Field("qwerty", env="CLICKHOUSE_PASSWORD")  # type: ignore[call-arg]
+    # DDL is run ON CLUSTER on every node of it; empty for a single server
+    cluster: str = Field(default="company_cluster", validation_alias="CLICKHOUSE_CLUSTER")
+    database: str = Field(default="shard", validation_alias="CLICKHOUSE_DATABASE")
+    user: str = Field(default="admin", validation_alias="CLICKHOUSE_USER")
+    password: str = Field(default="qwerty", validation_alias="CLICKHOUSE_PASSWORD")
+    # Write targets: shards separated by ";", replicas of a shard by ",", e.g. "node1:9000,node2:9000;node3:9000".
+    # Empty means a single shard on host:port.
+    shards: str = Field(default="", validation_alias="CLICKHOUSE_SHARDS")
+    pool_size: int = 2
+    # Replicated* engines keep the replicas of a shard in sync through ZooKeeper, using the `shard` and `replica`
+    # macros of every node; plain MergeTree leaves rows written during a failover on the replica that took them
+    replicated: bool = Field(default=True, validation_alias="CLICKHOUSE_REPLICATED")
+    # HTTP interface of the same nodes, used by the bulk file loader
+    http_port: int = 8123
+    http_timeout: float = 300.0
+    # Recent insert tokens remembered per table to drop repeated batches
+    deduplication_window: int = 1000
+    # Retention of raw views and events: parts move to `cold_volume` after `cold_after_days` and are deleted
+    # after `ttl_days`; 0 disables either rule. The cold volume has to be part of the server's `storage_policy`.
+    ttl_days: int = Field(default=0, validation_alias="CLICKHOUSE_TTL_DAYS")
+    cold_after_days: int = Field(default=0, validation_alias="CLICKHOUSE_COLD_AFTER_DAYS")
+    cold_volume: str = "cold"
+    storage_policy: str = Field(default="", validation_alias="CLICKHOUSE_STORAGE_POLICY")
 
     views_table_name: str = VIEWS_TOPIC
     custom_events_table_name: str = EVENTS_TOPIC
+    film_daily_table_name: str = "film_daily_views"
+    user_daily_table_name: str = "user_daily_views"
+    sessions_table_name: str = "view_sessions"
 
     class Config:
         env_file = ".env"
         env_file_encoding = "utf-8"
+        populate_by_name = True
+
+    def table_names(self) -> list[str]:
+        return [
+            self.views_table_name,
+            self.custom_events_table_name,
+            self.film_daily_table_name,
+            self.user_daily_table_name,
+            self.sessions_table_name,
+        ]
+
+    def topology(self) -> list[list[tuple[str, int]]]:
+        """Replicas of every shard as (host, port), in failover order."""
+        return parse_topology(self.shards, self.host, self.port)
 
 
 class RedisSettings(BaseSettings):
-    host: str = Field("redis", env="REDIS_HOST")  # type: ignore[call-arg]
+    host: str = Field(default="redis", validation_alias="REDIS_HOST")
     port: int = 6379
     db: int = 0
 
 
-class ETLConfig(BaseSettings):
-    kafka: KafkaSettings
-    clickhouse: ClickHouseSettings
-    redis: RedisSettings
+class DeadLetterSettings(BaseSettings):
+    # "kafka" publishes rejected messages to `topic`, "file" appends them to `path` instead
+    backend: str = "kafka"
+    topic: str = DEAD_LETTER_TOPIC
+    path: str = "dead_letter.jsonl"
 
-    batch_size: int = 100
-    sleep_seconds: int = 5
+    class Config:
+        # DEAD_LETTER_BACKEND, DEAD_LETTER_PATH...
+        env_prefix = "DEAD_LETTER_"
 
 
-clickhouse_settings = ClickHouseSettings()  # type: ignore[call-arg]
-kafka_settings = KafkaSettings()  # type: ignore[call-arg]
-redis_settings = RedisSettings()  # type: ignore[call-arg]
+class SpoolSettings(BaseSettings):
+    # Directory of batches waiting for ClickHouse to come back, empty disables spooling
+    path: str = "spool"
+    max_bytes: int = 1024**3
+    segment_bytes: int = 64 * 1024**2
+    # Pause between attempts to replay the spool while ClickHouse is still failing
+    retry_seconds: float = 10.0
 
-config = ETLConfig(kafka=kafka_settings, clickhouse=clickhouse_settings, redis=redis_settings)
+    class Config:
+        # ETL_SPOOL_PATH, ETL_SPOOL_MAX_BYTES...; unprefixed, `path` would be read from $PATH
+        env_prefix = "ETL_SPOOL_"
+
+
+class TrendingSettings(BaseSettings):
+    # Keep a sliding-window top list of films and publish it to Redis for the UGC API
+    enabled: bool = Field(default=True, validation_alias="ETL_TRENDING")
+    size: int = 100
+    bucket_seconds: int = 60
+    window_buckets: int = 60
+    publish_seconds: float = 5.0
+    # Count-min sketch dimensions: estimates exceed true counts by at most e / width of the window total,
+    # with probability 1 - e^-depth
+    sketch_width: int = 2048
+    sketch_depth: int = 4
+    # Bits of the per-bucket filter that counts each (user, film) pair once
+    viewer_filter_bits: int = 2**20
+    key_prefix: str = "trending"
+
+    class Config:
+        # ETL_TRENDING_SIZE, ETL_TRENDING_BUCKET_SECONDS...; `enabled` is ETL_TRENDING
+        env_prefix = "ETL_TRENDING_"
+        populate_by_name = True
+
+
+class TuningSettings(BaseSettings):
+    # Adapt the batch size of every topic to insert latency, consumer lag and memory, within the bounds below
+    enabled: bool = Field(default=True, validation_alias="ETL_ADAPTIVE_BATCHES")
+    min_batch_size: int = 100
+    max_batch_size: int = 50_000
+    # Added while full batches store quickly and the backlog exceeds a batch
+    increase_step: int = 500
+    # Applied when storing a batch takes longer than `target_store_seconds` or RSS exceeds `max_rss_mb`
+    decrease_factor: float = 0.5
+    target_store_seconds: float = 1.0
+    max_rss_mb: int = 1024
+
+    class Config:
+        # ETL_MAX_BATCH_SIZE, ETL_MAX_RSS_MB...; `enabled` is ETL_ADAPTIVE_BATCHES
+        env_prefix = "ETL_"
+        populate_by_name = True
+
+
+class ProfilingSettings(BaseSettings):
+    # Sample the ETL's stacks and allocations for `seconds` after start, then write the reports to `path`
+    enabled: bool = Field(default=False, validation_alias="ETL_PROFILE")
+    seconds: float = 60.0
+    path: str = "profiles"
+    sample_interval_ms: float = 5.0
+    # Trace allocations with tracemalloc too, which makes the ETL several times slower during the window
+    memory: bool = True
+    memory_interval_seconds: float = 10.0
+    # Frames kept per allocation, enough to see which stage called into a library; more frames cost more
+    traceback_frames: int = 8
+    top_allocators: int = 10
+
+    class Config:
+        # ETL_PROFILE_SECONDS, ETL_PROFILE_PATH...; `enabled` is ETL_PROFILE
+        env_prefix = "ETL_PROFILE_"
+        populate_by_name = True
+
+
+class ETLConfig(BaseSettings):
+    kafka: KafkaSettings = Field(default_factory=KafkaSettings)
+    clickhouse: ClickHouseSettings = Field(default_factory=ClickHouseSettings)
+    redis: RedisSettings = Field(default_factory=RedisSettings)
+    dead_letter: DeadLetterSettings = Field(default_factory=DeadLetterSettings)
+    spool: SpoolSettings = Field(default_factory=SpoolSettings)
+    trending: TrendingSettings = Field(default_factory=TrendingSettings)
+    profiling: ProfilingSettings = Field(default_factory=ProfilingSettings)
+    tuning: TuningSettings = Field(default_factory=TuningSettings)
+
+    batch_size: int = 100
+    flush_interval_seconds: float = 0.5
+    sleep_seconds: int = 5
+    # "sync" runs fetch and load in turn, "pipelined" overlaps them in separate threads,
+    # "asyncio" overlaps them on one event loop
+    runtime: str = Field(default="sync", validation_alias="ETL_RUNTIME")
+    # Batches waiting for ClickHouse before the pipelined runtime pauses fetching
+    pipeline_queue_size: int = 4
+    # Keep one subscription and poll continuously; False restores the consume, flush and sleep cycle
+    streaming: bool = Field(default=True, validation_alias="ETL_STREAMING")
+    # Longest a poll waits for new messages; it returns earlier when a pending batch is due
+    poll_timeout_ms: int = 500
+    # Batches the asyncio runtime inserts concurrently
+    inflight_batches: int = 4
+    # Port of the Prometheus /metrics endpoint, 0 disables it
+    metrics_port: int = Field(default=8001, validation_alias="ETL_METRICS_PORT")
+    metrics_interval_seconds: float = 10.0
+    # Group view heartbeats into sessions ending after `session_gap_seconds` without a heartbeat
+    sessions: bool = Field(default=True, validation_alias="ETL_SESSIONS")
+    session_gap_seconds: int = 30 * 60
+    # Open sessions kept per partition, the least recently updated ones are closed early beyond it
+    session_state_limit: int = 100_000
+    # Keep the latest watch position of every (user, film) pair in Redis for "resume watching"
+    resume_positions: bool = Field(default=True, validation_alias="ETL_RESUME_POSITIONS")
+    resume_position_ttl_days: int = 180
+    # Consumer processes started on this host, each owning a share of the group's partitions
+    workers: int = Field(default=1, validation_alias="ETL_WORKERS")
+
+
+clickhouse_settings = ClickHouseSettings()
+kafka_settings = KafkaSettings()
+redis_settings = RedisSettings()
+dead_letter_settings = DeadLetterSettings()
+spool_settings = SpoolSettings()
+trending_settings = TrendingSettings()
+profiling_settings = ProfilingSettings()
+tuning_settings = TuningSettings()
+
+config = ETLConfig(
+    kafka=kafka_settings,
+    clickhouse=clickhouse_settings,
+    redis=redis_settings,
+    dead_letter=dead_letter_settings,
+    spool=spool_settings,
+    trending=trending_settings,
+    profiling=profiling_settings,
+    tuning=tuning_settings,
+)
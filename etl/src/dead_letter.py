@@ -0,0 +1,129 @@
+import base64
+import os
+from abc import ABC, abstractmethod
+from collections.abc import Iterator
+
+import backoff
+import orjson
+from kafka import KafkaProducer
+from kafka.consumer.fetcher import ConsumerRecord
+
+from config import DeadLetterSettings, KafkaSettings
+from transformer import RejectedMessage
+
+SOURCE_TOPIC_HEADER = "source_topic"
+SOURCE_PARTITION_HEADER = "source_partition"
+SOURCE_OFFSET_HEADER = "source_offset"
+SOURCE_TIMESTAMP_HEADER = "source_timestamp"
+ERROR_HEADER = "error"
+
+
+def source_record(
+    topic: str, partition: int, offset: int, timestamp: int, key: bytes | None, value: bytes | None
+) -> ConsumerRecord:
+    """Rebuild the original record so it can go through the transformer again."""
+    return ConsumerRecord(
+        topic=topic,
+        partition=partition,
+        offset=offset,
+        timestamp=timestamp,
+        timestamp_type=0,
+        key=key,
+        value=value,
+        headers=[],
+        checksum=None,
+        serialized_key_size=len(key) if key is not None else -1,
+        serialized_value_size=len(value) if value is not None else -1,
+        serialized_header_size=-1,
+    )
+
+
+class DeadLetterSink(ABC):
+    """Keeps messages the transformer rejected together with the reason."""
+
+    @abstractmethod
+    def publish(self, rejected: list[RejectedMessage]) -> None:
+        """Durably store a batch of rejected messages, blocking once per batch at most."""
+
+    def close(self) -> None:
+        pass
+
+
+class KafkaDeadLetterSink(DeadLetterSink):
+    def __init__(self, config: DeadLetterSettings, kafka: KafkaSettings) -> None:
+        self.config = config
+        self.kafka = kafka
+        self.producer = self.connect()
+
+    @backoff.on_exception(backoff.expo, Exception)
+    def connect(self) -> KafkaProducer:
+        return KafkaProducer(bootstrap_servers=self.kafka.bootstrap_servers, linger_ms=50, acks="all")
+
+    def publish(self, rejected: list[RejectedMessage]) -> None:
+        for item in rejected:
+            record = item.record
+            self.producer.send(
+                self.config.topic,
+                key=record.key,
+                value=record.value,
+                headers=[
+                    (SOURCE_TOPIC_HEADER, record.topic.encode()),
+                    (SOURCE_PARTITION_HEADER, str(record.partition).encode()),
+                    (SOURCE_OFFSET_HEADER, str(record.offset).encode()),
+                    (SOURCE_TIMESTAMP_HEADER, str(record.timestamp).encode()),
+                    (ERROR_HEADER, item.reason.encode()),
+                ],
+            )
+        self.producer.flush()
+
+    def close(self) -> None:
+        self.producer.close()
+
+
+class FileDeadLetterSink(DeadLetterSink):
+    """Local stand-in for the dead-letter topic: one JSON line per rejected message."""
+
+    def __init__(self, config: DeadLetterSettings) -> None:
+        self.path = config.path
+
+    def publish(self, rejected: list[RejectedMessage]) -> None:
+        lines = b"".join(
+            orjson.dumps(
+                {
+                    SOURCE_TOPIC_HEADER: item.record.topic,
+                    SOURCE_PARTITION_HEADER: item.record.partition,
+                    SOURCE_OFFSET_HEADER: item.record.offset,
+                    SOURCE_TIMESTAMP_HEADER: item.record.timestamp,
+                    "key": base64.b64encode(item.record.key).decode() if item.record.key is not None else None,
+                    "value": base64.b64encode(item.record.value).decode() if item.record.value is not None else None,
+                    ERROR_HEADER: item.reason,
+                },
+                option=orjson.OPT_APPEND_NEWLINE,
+            )
+            for item in rejected
+        )
+        with open(self.path, "ab") as file:
+            file.write(lines)
+            file.flush()
+            os.fsync(file.fileno())
+
+    @staticmethod
+    def read_path(path: str) -> Iterator[ConsumerRecord]:
+        """Yield messages stored in a dead-letter file as their original records."""
+        with open(path, "rb") as file:
+            for line in file:
+                entry = orjson.loads(line)
+                yield source_record(
+                    entry[SOURCE_TOPIC_HEADER],
+                    entry[SOURCE_PARTITION_HEADER],
+                    entry[SOURCE_OFFSET_HEADER],
+                    entry[SOURCE_TIMESTAMP_HEADER],
+                    base64.b64decode(entry["key"]) if entry["key"] is not None else None,
+                    base64.b64decode(entry["value"]) if entry["value"] is not None else None,
+                )
+
+
+def get_dead_letter_sink(config: DeadLetterSettings, kafka: KafkaSettings) -> DeadLetterSink:
+    if config.backend == "file":
+        return FileDeadLetterSink(config)
+    return KafkaDeadLetterSink(config, kafka)
@@ -0,0 +1,109 @@
+"""Offset ranges of batches that are being inserted but whose offsets are not committed yet.
+
+Every insert carries a deduplication token built from the partition and offset range it covers. If the process
+dies between the insert and the offset commit, the batch is consumed again after restart, but it might be cut at
+a different offset and get a different token. To prevent that, the range is recorded in Redis before the insert,
+and the consumer that picks the partition up next cuts its first batch at exactly the same offset, so ClickHouse
+recognises the repeated insert and drops it.
+"""
+
+import backoff
+import redis
+import redis.asyncio
+from kafka import TopicPartition
+
+from config import ETLConfig
+
+OffsetRange = tuple[int, int]
+
+# Ranges are only needed until the matching commit, which normally happens within seconds
+INFLIGHT_TTL_SECONDS = 7 * 24 * 3600
+
+
+def dedup_token(tp: TopicPartition, offsets: OffsetRange) -> str:
+    return f"{tp.topic}:{tp.partition}:{offsets[0]}-{offsets[1]}"
+
+
+def inflight_key(group_id: str, tp: TopicPartition) -> str:
+    return f"etl:inflight:{group_id}:{tp.topic}:{tp.partition}"
+
+
+def encode_ranges(ranges: list[OffsetRange]) -> str:
+    return ",".join(f"{first}-{last}" for first, last in ranges)
+
+
+def resumed_ranges(value: bytes, position: int) -> list[OffsetRange]:
+    """Decode recorded ranges, keeping them only if they start exactly where consumption resumes."""
+    ranges = []
+    for item in value.decode().split(","):
+        first, _, last = item.partition("-")
+        ranges.append((int(first), int(last)))
+    return ranges if ranges[0][0] == position else []
+
+
+class InflightRanges:
+    def __init__(self, config: ETLConfig) -> None:
+        self.group_id = config.kafka.group_id
+        self.redis = redis.Redis(host=config.redis.host, port=config.redis.port, db=config.redis.db)
+
+    def key(self, tp: TopicPartition) -> str:
+        return inflight_key(self.group_id, tp)
+
+    @backoff.on_exception(backoff.expo, redis.RedisError)
+    def save(self, ranges: dict[TopicPartition, list[OffsetRange]]) -> None:
+        """Record the consecutive ranges about to be inserted, one Redis round trip for the whole batch."""
+        pipeline = self.redis.pipeline(transaction=False)
+        for tp, tp_ranges in ranges.items():
+            pipeline.set(self.key(tp), encode_ranges(tp_ranges), ex=INFLIGHT_TTL_SECONDS)
+        pipeline.execute()
+
+    @backoff.on_exception(backoff.expo, redis.RedisError)
+    def unfinished(self, positions: dict[TopicPartition, int]) -> dict[TopicPartition, list[OffsetRange]]:
+        """Ranges that were inserted, or about to be, and start exactly where consumption resumes."""
+        partitions = list(positions)
+        if not partitions:
+            return {}
+        values: list[bytes | None] = self.redis.mget([self.key(tp) for tp in partitions])  # type: ignore[assignment]
+        unfinished = {}
+        for tp, value in zip(partitions, values):
+            if value is not None and (ranges := resumed_ranges(value, positions[tp])):
+                unfinished[tp] = ranges
+        return unfinished
+
+    def close(self) -> None:
+        self.redis.close()
+
+
+class AsyncInflightRanges:
+    """InflightRanges kept through redis.asyncio, for the asyncio runtime."""
+
+    def __init__(self, config: ETLConfig) -> None:
+        self.group_id = config.kafka.group_id
+        self.redis = redis.asyncio.Redis(host=config.redis.host, port=config.redis.port, db=config.redis.db)
+
+    def key(self, tp: TopicPartition) -> str:
+        return inflight_key(self.group_id, tp)
+
+    @backoff.on_exception(backoff.expo, redis.RedisError)
+    async def save(self, ranges: dict[TopicPartition, list[OffsetRange]]) -> None:
+        async with self.redis.pipeline(transaction=False) as pipeline:
+            for tp, tp_ranges in ranges.items():
+                pipeline.set(self.key(tp), encode_ranges(tp_ranges), ex=INFLIGHT_TTL_SECONDS)
+            await pipeline.execute()
+
+    @backoff.on_exception(backoff.expo, redis.RedisError)
+    async def unfinished(
+        self, positions: dict[TopicPartition, int]
+    ) -> dict[TopicPartition, list[OffsetRange]]:
+        partitions = list(positions)
+        if not partitions:
+            return {}
+        values = await self.redis.mget([self.key(tp) for tp in partitions])
+        unfinished = {}
+        for tp, value in zip(partitions, values):
+            if value is not None and (ranges := resumed_ranges(value, positions[tp])):
+                unfinished[tp] = ranges
+        return unfinished
+
+    async def close(self) -> None:
+        await self.redis.aclose()
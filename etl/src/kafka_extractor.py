@@ -1,20 +1,61 @@
 import logging
-from collections.abc import Generator
+from collections.abc import Callable, Generator
 
 import backoff
-from kafka import KafkaConsumer, TopicPartition
+from kafka import ConsumerRebalanceListener, KafkaConsumer, TopicPartition
 from kafka.consumer.fetcher import ConsumerRecord
+from kafka.errors import CommitFailedError, KafkaError
+from kafka.structs import OffsetAndMetadata
 
 from config import KafkaSettings
+from metrics import CHECKPOINT_SECONDS
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+class PartitionProgressListener(ConsumerRebalanceListener):
+    """Flushes pending work before partitions move to another worker and logs where owned ones resume."""
+
+    def __init__(
+        self,
+        extractor: "KafkaExtractor",
+        on_revoke: Callable[[], None] | None = None,
+        on_assign: Callable[[dict[TopicPartition, int]], None] | None = None,
+    ) -> None:
+        self.extractor = extractor
+        self.on_revoke = on_revoke
+        self.on_assign = on_assign
+
+    def on_partitions_revoked(self, revoked: set[TopicPartition]) -> None:
+        if revoked and self.on_revoke is not None:
+            self.on_revoke()
+        logger.info("Partitions revoked: %s", sorted(revoked))
+
+    def on_partitions_assigned(self, assigned: set[TopicPartition]) -> None:
+        positions = {tp: self.extractor.consumer.position(tp) for tp in sorted(assigned)}
+        for tp, position in positions.items():
+            logger.info(
+                "Partition %s:%s assigned to %s, resuming from offset %s",
+                tp.topic,
+                tp.partition,
+                self.extractor.config.client_id,
+                position,
+            )
+        if self.on_assign is not None:
+            self.on_assign(positions)
+
+
 class KafkaExtractor:
-    def __init__(self, config: KafkaSettings) -> None:
+    def __init__(
+        self,
+        config: KafkaSettings,
+        on_revoke: Callable[[], None] | None = None,
+        on_assign: Callable[[dict[TopicPartition, int]], None] | None = None,
+    ) -> None:
         self.config = config
         self.consumer = self.connect()
+        self.listener = PartitionProgressListener(self, on_revoke, on_assign)
 
     @backoff.on_exception(backoff.expo, Exception)
     def connect(self) -> KafkaConsumer:
@@ -22,33 +63,60 @@ class KafkaExtractor:
             bootstrap_servers=self.config.bootstrap_servers,
             auto_offset_reset=self.config.auto_offset_reset,
             group_id=self.config.group_id,
+            client_id=self.config.client_id,
             enable_auto_commit=False,
             consumer_timeout_ms=1000,
+            fetch_min_bytes=self.config.fetch_min_bytes,
+            fetch_max_wait_ms=self.config.fetch_max_wait_ms,
+            max_partition_fetch_bytes=self.config.max_partition_fetch_bytes,
+            fetch_max_bytes=self.config.fetch_max_bytes,
         )
 
-    def extract(self, from_timestamp: int = 0) -> Generator[ConsumerRecord, None, None]:
-        self.consumer.subscribe([self.config.views_topic])
-        self.consumer.poll(0)
-
-        # Get the list of partitions assigned
-        partitions = self.consumer.assignment()
-
-        # Convert timestamp to offset for each partition
-        for partition in partitions:
-            topic_partition = TopicPartition(partition.topic, partition.partition)
-
-            # Get the offset for the given timestamp with delta to next entrie
-            offsets = self.consumer.offsets_for_times({topic_partition: from_timestamp + 1})
+    def subscribe(self) -> None:
+        self.consumer.subscribe([self.config.views_topic, self.config.events_topic], listener=self.listener)
 
-            if offsets and topic_partition in offsets and offsets[topic_partition] is not None:
-                offset = offsets[topic_partition].offset
-                self.consumer.seek(topic_partition, offset)
-            else:
-                return
+    def extract(self) -> Generator[ConsumerRecord, None, None]:
+        """Yield messages starting from the consumer group's committed offsets.
 
+        The subscription is kept between calls, so repeated extraction does not trigger a group rebalance.
+        """
+        self.subscribe()
         try:
             yield from self.consumer
         except Exception as e:
             logger.error("Error while reading messages from Kafka: %s", e)
-        finally:
-            self.consumer.unsubscribe()
+
+    def poll(self, timeout_ms: int, max_records: int | None = None) -> list[ConsumerRecord]:
+        """Fetch whatever is available within `timeout_ms`, up to `max_records`, skipping paused partitions."""
+        fetched = self.consumer.poll(timeout_ms=timeout_ms, max_records=max_records)
+        return [record for records in fetched.values() for record in records]
+
+    def pause(self) -> None:
+        self.consumer.pause(*self.consumer.assignment())
+
+    def resume(self) -> None:
+        self.consumer.resume(*self.consumer.paused())
+
+    @backoff.on_exception(backoff.expo, KafkaError, max_tries=5)
+    def commit(self, offsets: dict[TopicPartition, int]) -> None:
+        """Commit the next offsets to consume for each partition of a stored batch."""
+        if not offsets:
+            return
+        try:
+            with CHECKPOINT_SECONDS.labels("commit").time():
+                self.consumer.commit({tp: OffsetAndMetadata(offset, None) for tp, offset in offsets.items()})
+        except CommitFailedError as e:
+            # Partitions were reassigned meanwhile; the new owner resumes from the previous commit
+            logger.warning("Offsets commit rejected after rebalance: %s", e)
+
+    def lag(self) -> dict[TopicPartition, int]:
+        """Messages left per assigned partition, from the high watermarks of the latest fetch responses."""
+        lag = {}
+        for tp in self.consumer.assignment():
+            highwater = self.consumer.highwater(tp)
+            if highwater is not None:
+                lag[tp] = highwater - self.consumer.position(tp)
+        return lag
+
+    def close(self) -> None:
+        self.consumer.close(autocommit=False)
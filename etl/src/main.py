@@ -1,57 +1,185 @@
 import logging
 import time
+from typing import TYPE_CHECKING
 
-import backoff
-import redis
+from kafka import TopicPartition
+from kafka.consumer.fetcher import ConsumerRecord
 
+from batcher import BatchAccumulator, FlushReport
 from clickhouse_loader import ClickHouseLoader
 from config import config
+from dead_letter import get_dead_letter_sink
+from inflight import InflightRanges
 from kafka_extractor import KafkaExtractor
+from metrics import CONSUMER_LAG, start_metrics_server
+from positions import ResumePositions
+from profiling import profiled
+from sessions import Sessionizer
+from spool import Spool
+from store import BatchStore
 from transformer import KafkaToClickHouseDataTransformer
+from trending import TrendingFilms
+from tuning import BatchSizer, current_rss
+
+if TYPE_CHECKING:
+    from async_etl import AsyncETL
 
 logging.basicConfig(level=logging.INFO)
 
 
 class ETL:
     def __init__(self) -> None:
-        self.extractor = KafkaExtractor(config.kafka)
+        self.extractor = KafkaExtractor(config.kafka, on_revoke=self.flush_all, on_assign=self.on_assign)
         self.transformer = KafkaToClickHouseDataTransformer()
         self.loader = ClickHouseLoader(config.clickhouse)
         self.batch_size = config.batch_size
         self.sleep_seconds = config.sleep_seconds
+        self.store = BatchStore(
+            config,
+            self.transformer,
+            self.loader,
+            get_dead_letter_sink(config.dead_letter, config.kafka),
+            InflightRanges(config),
+            Spool(config.spool) if config.spool.path else None,
+            Sessionizer(config) if config.sessions else None,
+            TrendingFilms(config) if config.trending.enabled else None,
+            ResumePositions(config) if config.resume_positions else None,
+        )
+        self.batches: dict[str, BatchAccumulator[ConsumerRecord]] = {
+            topic: BatchAccumulator(batch_size=self.batch_size, max_latency_seconds=config.flush_interval_seconds)
+            for topic in self.store.routes
+        }
+        self.sizers = (
+            {topic: BatchSizer(config.tuning, topic, self.batch_size) for topic in self.batches}
+            if config.tuning.enabled
+            else {}
+        )
+        for topic, sizer in self.sizers.items():
+            self.batches[topic].batch_size = sizer.size
+        self.lag_reported_at = 0.0
 
-    @backoff.on_exception(backoff.expo, Exception)
-    def save_last_processed_timestamp(self, timestamp: int = 0) -> None:
-        redis_client = redis.StrictRedis(host=config.redis.host, port=config.redis.port, db=config.redis.db)
-        redis_client.set("last_processed_timestamp", timestamp)
+    def on_assign(self, positions: dict[TopicPartition, int]) -> None:
+        """Make the first batches of new partitions end where their unfinished inserts ended."""
+        unfinished = self.store.resume(positions)
+        for topic, batch in self.batches.items():
+            batch.boundaries = {tp: ranges[-1][1] for tp, ranges in unfinished.items() if tp.topic == topic}
+        if unfinished:
+            logging.info(f"Repeating unfinished inserts: {unfinished}")
 
-    @backoff.on_exception(backoff.expo, Exception)
-    def get_last_processed_timestamp(self) -> int:
-        redis_client = redis.StrictRedis(host=config.redis.host, port=config.redis.port, db=config.redis.db)
-        last_processed_timestamp = redis_client.get("last_processed_timestamp")
-        return int(last_processed_timestamp) if last_processed_timestamp else 0  # type: ignore[arg-type]
+    def flush(self, topic: str) -> FlushReport | None:
+        """Store the accumulated batch of a topic, then commit the Kafka offsets it covers."""
+        batch = self.batches[topic].drain()
+        started = time.perf_counter()
+        report = self.store.store(topic, batch.rows) if batch.rows else None
+        self.extractor.commit(batch.offsets)
+        if batch.rows:
+            self.tune(topic, len(batch.rows), time.perf_counter() - started)
+        return report
 
-    def start(self) -> None:
+    def tune(self, topic: str, messages: int, seconds: float) -> None:
+        """Resize the batches of a topic after one of them took `seconds` to store."""
+        sizer = self.sizers.get(topic)
+        if sizer is None:
+            return
+        lag = sum(lag for tp, lag in self.extractor.lag().items() if tp.topic == topic)
+        self.batches[topic].batch_size = sizer.observe(messages, seconds, lag, current_rss())
+
+    def max_records(self) -> int | None:
+        """Records to fetch per poll, enough to fill the largest batch; the consumer default if sizes are fixed."""
+        if not self.sizers:
+            return None
+        return max(batch.batch_size for batch in self.batches.values())
+
+    def flush_all(self) -> None:
+        for topic in self.batches:
+            self.flush(topic)
+
+    def flush_due(self) -> None:
+        for topic, batch in self.batches.items():
+            if batch.is_due():
+                self.flush(topic)
+
+    def accept(self, message: ConsumerRecord) -> None:
+        batch = self.batches[message.topic]
+        batch.add(message)
+        batch.track(message.topic, message.partition, message.offset)
+
+    def poll_timeout_ms(self) -> int:
+        """Wait for messages at most until the earliest pending batch is due."""
+        waits = [wait for batch in self.batches.values() if (wait := batch.seconds_until_due()) is not None]
+        return min([config.poll_timeout_ms, *(int(wait * 1000) for wait in waits)])
+
+    def report_lag(self) -> None:
+        now = time.monotonic()
+        if now - self.lag_reported_at < config.metrics_interval_seconds:
+            return
+        self.lag_reported_at = now
+        for tp, lag in self.extractor.lag().items():
+            CONSUMER_LAG.labels(tp.topic, tp.partition).set(lag)
+
+    def stream(self) -> None:
+        """Keep one subscription and poll continuously, flushing every batch as soon as it is due."""
+        self.extractor.subscribe()
         try:
             while True:
-                last_processed_timestamp = self.get_last_processed_timestamp()
-                logging.info(f"Start ETL from last processed timestamp: {last_processed_timestamp}")
-
-                for message in self.extractor.extract(from_timestamp=last_processed_timestamp):
-                    transformed_data = self.transformer.transform(message)
-                    if transformed_data:
-                        # TODO: it should be a batch in production
-                        self.loader.load(transformed_data)
+                for message in self.extractor.poll(self.poll_timeout_ms(), self.max_records()):
+                    self.accept(message)
+                self.flush_due()
+                self.report_lag()
+        except Exception as e:
+            logging.exception(f"ETL process stopped with error: {e}")
+        finally:
+            logging.exception("ETL process completed")
 
-                    # Save last processed timestamp event if broken message
-                    self.save_last_processed_timestamp(message.timestamp)
+    def start(self) -> None:
+        if config.streaming:
+            self.stream()
+            return
+        try:
+            while True:
+                for message in self.extractor.extract():
+                    self.accept(message)
+                    self.flush_due()
+                    self.report_lag()
+                self.flush_all()
                 time.sleep(self.sleep_seconds)
         except Exception as e:
             logging.exception(f"ETL process stopped with error: {e}")
         finally:
             logging.exception("ETL process completed")
 
+    def close(self) -> None:
+        """Store what is already consumed and leave the consumer group."""
+        try:
+            self.flush_all()
+        finally:
+            self.extractor.close()
+            self.store.close()
+
+
+def create_etl() -> "ETL | AsyncETL":
+    """Build the ETL runtime selected by ETLConfig.runtime."""
+    if config.runtime == "asyncio":
+        from async_etl import AsyncETL
+
+        return AsyncETL()
+    if config.runtime == "pipelined":
+        from pipeline import PipelinedETL
+
+        return PipelinedETL()
+    return ETL()
+
 
 if __name__ == "__main__":
-    etl_process = ETL()
-    etl_process.start()
+    if config.workers > 1:
+        from workers import run_workers
+
+        run_workers(config.workers)
+    else:
+        start_metrics_server(config.metrics_port)
+        etl_process = create_etl()
+        try:
+            with profiled(config.profiling):
+                etl_process.start()
+        finally:
+            etl_process.close()
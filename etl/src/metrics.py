@@ -0,0 +1,33 @@
+"""Prometheus metrics of the ETL, served over HTTP in the text exposition format."""
+
+import logging
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+BATCH_BUCKETS = (1, 10, 100, 500, 1_000, 5_000, 10_000, 50_000, 100_000)
+
+MESSAGES = Counter("etl_messages", "Messages consumed and handed to the store", ["topic"])
+ROWS_INSERTED = Counter("etl_rows_inserted", "Rows inserted into ClickHouse", ["topic"])
+TRANSFORM_FAILURES = Counter("etl_transform_failures", "Messages rejected by the transformer", ["topic"])
+BATCH_ROWS = Histogram("etl_batch_rows", "Messages per flushed batch", ["topic"], buckets=BATCH_BUCKETS)
+INSERT_SECONDS = Histogram(
+    "etl_insert_seconds", "Duration of one ClickHouse insert", ["topic"], buckets=LATENCY_BUCKETS
+)
+CHECKPOINT_SECONDS = Histogram(
+    "etl_checkpoint_seconds",
+    "Duration of progress checkpoints: offset commits, in-flight range records and state kept in Redis",
+    ["kind"],
+    buckets=LATENCY_BUCKETS,
+)
+BATCH_SIZE = Gauge("etl_batch_size_target", "Messages a batch of the topic is flushed at", ["topic"])
+CONSUMER_LAG = Gauge("etl_consumer_lag", "Messages behind the partition's high watermark", ["topic", "partition"])
+PIPELINE_QUEUE = Gauge("etl_pipeline_queue_batches", "Batches waiting for the loader stage")
+SPOOL_BATCHES = Gauge("etl_spool_batches", "Batches spooled to disk while ClickHouse is unavailable")
+SPOOL_BYTES = Gauge("etl_spool_bytes", "Size of the on-disk spool")
+
+
+def start_metrics_server(port: int) -> None:
+    if port:
+        start_http_server(port)
+        logging.info(f"Serving ETL metrics on :{port}/metrics")
@@ -0,0 +1,112 @@
+"""Moves the ETL's tables to the managed layout of ClickHouseLoader in place.
+
+    python migrate_tables.py
+
+A raw table that is unpartitioned, or any table that is plain MergeTree while CLICKHOUSE_REPLICATED is on, is
+copied into a new table with the current layout and engine, on every node, and then swapped with it by EXCHANGE
+TABLES. Rows every node took on its own during failovers end up together on all replicas. The old data stays in
+`<table>_previous` until it is dropped by hand. Raw tables that are already partitioned get missing projections
+and indexes added and built for existing parts, and the configured TTL, if any.
+
+Stop the ETL consumers first: rows inserted into a table while it is being copied would not reach the new table.
+"""
+
+import logging
+from collections.abc import Callable
+from functools import partial
+
+from clickhouse_loader import (
+    EVENT_TYPE_INDEX,
+    EVENT_TYPE_INDEX_NAME,
+    EVENTS_FILM_PROJECTION,
+    FILM_PROJECTION,
+    VIEWS_FILM_PROJECTION,
+    ClickHouseLoader,
+)
+from config import config
+
+logging.basicConfig(level=logging.INFO)
+
+OBJECT_SETTINGS = {"allow_experimental_object_type": 1}
+
+
+def copy_on_every_node(loader: ClickHouseLoader, source: str, target: str) -> None:
+    """Plain MergeTree tables hold different rows on every node, so every node copies its own."""
+    database = loader.config.database
+    for replicas in loader.shards:
+        for replica in replicas:
+            with replica.acquire() as client:
+                client.execute(
+                    f"INSERT INTO {database}.{target} SELECT * FROM {database}.{source}", settings=OBJECT_SETTINGS
+                )
+            logging.info(f"Copied {source} to {target} on {replica}")
+
+
+def rebuild(loader: ClickHouseLoader, table: str, create: Callable[[str], None]) -> None:
+    database = loader.config.database
+    staging = f"{table}_rebuilt"
+    # Leftovers of an interrupted run would otherwise be copied twice
+    loader.client.execute(f"DROP TABLE IF EXISTS {database}.{staging}{loader.on_cluster()} SYNC")
+    create(staging)
+    copy_on_every_node(loader, table, staging)
+    loader.client.execute(f"EXCHANGE TABLES {database}.{table} AND {database}.{staging}{loader.on_cluster()}")
+    loader.client.execute(f"RENAME TABLE {database}.{staging} TO {database}.{table}_previous{loader.on_cluster()}")
+    loader.keep_insert_tokens(table)
+    logging.info(f"Table {table} rebuilt, the old data is kept in {table}_previous")
+
+
+def update_layout(loader: ClickHouseLoader, table: str) -> None:
+    """Add the projections and indexes a partitioned table may lack, and apply the configured TTL."""
+    database = loader.config.database
+    target = f"{database}.{table}{loader.on_cluster()}"
+    if table == loader.config.views_table_name:
+        projection = VIEWS_FILM_PROJECTION
+    else:
+        projection = EVENTS_FILM_PROJECTION
+        loader.client.execute(f"ALTER TABLE {target} ADD INDEX IF NOT EXISTS {EVENT_TYPE_INDEX}")
+        loader.client.execute(f"ALTER TABLE {target} MATERIALIZE INDEX {EVENT_TYPE_INDEX_NAME}")
+    loader.client.execute(f"ALTER TABLE {target} ADD PROJECTION IF NOT EXISTS {FILM_PROJECTION} ({projection})")
+    loader.client.execute(f"ALTER TABLE {target} MATERIALIZE PROJECTION {FILM_PROJECTION}")
+    if ttl := loader.ttl():
+        loader.client.execute(f"ALTER TABLE {target} MODIFY TTL {ttl}")
+    logging.info(f"Table {table} layout updated")
+
+
+def main() -> None:
+    loader = ClickHouseLoader(config.clickhouse)
+    settings = config.clickhouse
+    try:
+        raw = {
+            settings.views_table_name: loader.views_schema(),
+            settings.custom_events_table_name: loader.events_schema(),
+        }
+        derived: dict[str, Callable[[str], None]] = {
+            settings.film_daily_table_name: loader.create_film_daily,
+            settings.user_daily_table_name: loader.create_user_daily,
+            settings.sessions_table_name: loader.create_sessions,
+        }
+        stale = [
+            table
+            for table in settings.table_names()
+            if loader.needs_replication(table) or table in raw and not loader.partition_key(table)
+        ]
+        if {settings.views_table_name, settings.film_daily_table_name, settings.user_daily_table_name} & set(stale):
+            # Materialized views follow their tables through renames, so they are recreated on the new ones
+            for aggregate in (settings.film_daily_table_name, settings.user_daily_table_name):
+                loader.client.execute(
+                    f"DROP VIEW IF EXISTS {settings.database}.{aggregate}_mv{loader.on_cluster()}"
+                )
+        for table in settings.table_names():
+            if table in stale:
+                schema = raw.get(table)
+                create = derived[table] if schema is None else partial(loader.create_table, schema=schema)
+                rebuild(loader, table, create)
+            elif table in raw:
+                update_layout(loader, table)
+        loader.init_view_aggregates()
+    finally:
+        loader.close()
+
+
+if __name__ == "__main__":
+    main()
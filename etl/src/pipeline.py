@@ -0,0 +1,134 @@
+import logging
+import queue
+import threading
+import time
+from collections import deque
+
+from kafka import TopicPartition
+
+from batcher import Batch
+from config import config
+from main import ETL
+from metrics import PIPELINE_QUEUE
+
+PendingBatch = tuple[str, Batch]
+# Topic, messages and seconds of a stored batch, for the consumer thread to resize the topic's batches
+StoredBatch = tuple[str, int, float]
+
+
+class PipelinedETL(ETL):
+    """Fetches from Kafka while earlier batches are transformed and loaded in a separate thread.
+
+    Batches travel to the loader through a bounded queue. When it is full, the consumer pauses its partitions
+    and keeps polling only to stay in the group, so memory stays bounded while ClickHouse is slow. Offsets of
+    loaded batches come back through a second queue and are committed from the consumer thread, because the
+    Kafka consumer is not thread-safe.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.loads: queue.Queue[PendingBatch | None] = queue.Queue(maxsize=config.pipeline_queue_size)
+        self.commits: queue.Queue[dict[TopicPartition, int]] = queue.Queue()
+        self.stored: queue.Queue[StoredBatch] = queue.Queue()
+        self.pending: deque[PendingBatch] = deque()
+        self.paused = False
+        self.failure: Exception | None = None
+        self.loader_thread = threading.Thread(target=self.load_forever, name="etl-loader", daemon=True)
+
+    def load_forever(self) -> None:
+        while True:
+            item = self.loads.get()
+            try:
+                if item is None:
+                    return
+                # After a failure keep draining the queue, so nobody blocks on it, but commit nothing more
+                if self.failure is None:
+                    topic, batch = item
+                    if batch.rows:
+                        started = time.perf_counter()
+                        self.store.store(topic, batch.rows)
+                        self.stored.put((topic, len(batch.rows), time.perf_counter() - started))
+                    self.commits.put(batch.offsets)
+            except Exception as e:
+                logging.exception(f"ETL loader stage failed: {e}")
+                self.failure = e
+            finally:
+                self.loads.task_done()
+
+    def check_failure(self) -> None:
+        if self.failure is not None:
+            raise RuntimeError("ETL loader stage failed") from self.failure
+
+    def hand_over(self, topic: str) -> None:
+        batch = self.batches[topic].drain()
+        if batch.offsets:
+            self.pending.append((topic, batch))
+
+    def offer_pending(self) -> None:
+        """Move ready batches to the loader without blocking, pausing the consumer if it is behind."""
+        while self.pending:
+            try:
+                self.loads.put_nowait(self.pending[0])
+            except queue.Full:
+                if not self.paused:
+                    logging.info("ClickHouse is behind, pausing Kafka partitions")
+                    self.extractor.pause()
+                    self.paused = True
+                return
+            self.pending.popleft()
+
+        if self.paused and self.loads.qsize() <= self.loads.maxsize // 2:
+            logging.info("ClickHouse caught up, resuming Kafka partitions")
+            self.extractor.resume()
+            self.paused = False
+
+    def commit_loaded(self) -> None:
+        offsets: dict[TopicPartition, int] = {}
+        while True:
+            try:
+                offsets.update(self.commits.get_nowait())
+            except queue.Empty:
+                break
+        self.extractor.commit(offsets)
+        while True:
+            try:
+                self.tune(*self.stored.get_nowait())
+            except queue.Empty:
+                break
+
+    def flush_all(self) -> None:
+        """Load everything consumed so far and commit it, e.g. before partitions are revoked."""
+        for topic in self.batches:
+            self.hand_over(topic)
+        while self.pending:
+            self.loads.put(self.pending.popleft())
+        self.loads.join()
+        self.check_failure()
+        self.commit_loaded()
+
+    def start(self) -> None:
+        self.loader_thread.start()
+        self.extractor.subscribe()
+        try:
+            while True:
+                self.check_failure()
+                for message in self.extractor.poll(self.poll_timeout_ms(), self.max_records()):
+                    self.accept(message)
+
+                for topic, batch in self.batches.items():
+                    if batch.is_due():
+                        self.hand_over(topic)
+                self.offer_pending()
+                self.commit_loaded()
+                PIPELINE_QUEUE.set(self.loads.qsize() + len(self.pending))
+                self.report_lag()
+        except Exception as e:
+            logging.exception(f"ETL process stopped with error: {e}")
+        finally:
+            logging.exception("ETL process completed")
+
+    def close(self) -> None:
+        try:
+            super().close()
+        finally:
+            self.loads.put(None)
@@ -0,0 +1,70 @@
+"""Latest watch position of every (user, film) pair, kept in Redis for "resume watching".
+
+Each pair has its own key `resume:<user_id>:<film_id>` holding `<position>:<record time>`, so the UGC API answers
+with one GET. A batch is reduced to the last heartbeat of every pair and written in pipelines. The write is a
+compare-and-set on the record time: a replayed batch or a late partition never moves a position back in time.
+Keys expire `resume_position_ttl_days` after the last heartbeat.
+"""
+
+import logging
+from itertools import chain, islice
+from uuid import UUID
+
+import redis
+
+from config import ETLConfig
+from transformer import ViewColumns
+
+KEY_PREFIX = "resume"
+# Commands sent per pipeline round trip
+PIPELINE_SIZE = 5_000
+
+SET_IF_NEWER = """
+local current = redis.call('GET', KEYS[1])
+if current then
+    local updated = tonumber(string.match(current, ':(%d+)$'))
+    if updated and updated > tonumber(ARGV[2]) then
+        return 0
+    end
+end
+redis.call('SET', KEYS[1], ARGV[1] .. ':' .. ARGV[2], 'EX', ARGV[3])
+return 1
+"""
+
+
+class ResumePositions:
+    def __init__(self, config: ETLConfig) -> None:
+        self.ttl_seconds = config.resume_position_ttl_days * 24 * 60 * 60
+        self.redis = redis.Redis(host=config.redis.host, port=config.redis.port, db=config.redis.db)
+        self.set_if_newer = self.redis.register_script(SET_IF_NEWER)
+
+    def save(self, batches: list[ViewColumns]) -> None:
+        """Write the last position of every pair in the batches, in order of consumption."""
+        latest: dict[tuple[UUID, UUID], tuple[int, int]] = {}
+        rows = chain.from_iterable(
+            zip(views.user_id, views.film_id, views.number_seconds_viewing, views.record_time) for views in batches
+        )
+        for user_id, film_id, position, record_time in rows:
+            key = (user_id, film_id)
+            seen = latest.get(key)
+            # Heartbeats of a pair arrive in order within a partition; equal times keep the later one
+            if seen is None or record_time >= seen[1]:
+                latest[key] = (position, record_time)
+
+        pairs = iter(latest.items())
+        try:
+            while chunk := list(islice(pairs, PIPELINE_SIZE)):
+                pipeline = self.redis.pipeline(transaction=False)
+                for (user_id, film_id), (position, record_time) in chunk:
+                    self.set_if_newer(
+                        keys=[f"{KEY_PREFIX}:{user_id}:{film_id}"],
+                        args=[position, record_time, self.ttl_seconds],
+                        client=pipeline,
+                    )
+                pipeline.execute()
+        except redis.RedisError as e:
+            # The next heartbeat of a pair writes its position again, a few seconds later
+            logging.warning(f"Failed to save resume positions: {e}")
+
+    def close(self) -> None:
+        self.redis.close()
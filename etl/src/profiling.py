@@ -0,0 +1,171 @@
+"""Built-in profiling window of the ETL, switched on by ETL_PROFILE=true.
+
+For `seconds` after start a background thread samples the stacks of all other threads every `sample_interval_ms`
+and takes a tracemalloc snapshot every `memory_interval_seconds`. When the window closes it writes to `path`:
+
+    etl-<pid>-<start>.collapsed    stacks in the collapsed format of flamegraph.pl, inferno and speedscope
+    etl-<pid>-<start>-stages.txt   share of samples per stage, then the top allocation sites of every stage with
+                                   the memory they hold at the end and their growth since the first snapshot
+
+Sampling is wall-clock, so time a thread spends waiting shows up too, e.g. a consumer blocked in poll() counts
+towards "extract". A sample or an allocation belongs to the stage of the innermost frame from one of the stage's
+modules, so `uuid` called from the transformer counts as "transform". Sampling costs little; tracemalloc makes
+allocation-heavy code several times slower, so ETL_PROFILE_MEMORY=false leaves it out, and it is stopped with the
+window either way.
+"""
+
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from collections.abc import Iterator
+from contextlib import contextmanager
+from pathlib import Path
+from types import FrameType
+
+from config import ProfilingSettings
+
+# Path fragments of the modules every stage runs in, innermost match wins
+STAGES = (
+    ("extract", ("/kafka/", "/aiokafka/", "kafka_extractor.py")),
+    ("transform", ("transformer.py", "wire.py", "/orjson/")),
+    (
+        "load",
+        ("/clickhouse_driver/", "/asynch/", "clickhouse_loader.py", "async_loader.py", "bulk_loader.py", "spool.py"),
+    ),
+    ("state", ("/redis/", "inflight.py", "sessions.py", "trending.py", "positions.py")),
+    ("dead_letter", ("dead_letter.py",)),
+    # Batching, hand-over between threads and waiting for them
+    ("runtime", ("main.py", "store.py", "batcher.py", "pipeline.py", "async_etl.py", "workers.py")),
+)
+OTHER = "other"
+
+
+def stage_of(filenames: list[str]) -> str:
+    """Stage of a stack given innermost first."""
+    for filename in filenames:
+        for stage, fragments in STAGES:
+            if any(fragment in filename for fragment in fragments):
+                return stage
+    return OTHER
+
+
+def frame_label(frame: FrameType) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({'/'.join(Path(code.co_filename).parts[-2:])}:{code.co_firstlineno})"
+
+
+class Profiler(threading.Thread):
+    def __init__(self, settings: ProfilingSettings) -> None:
+        super().__init__(name="etl-profiler", daemon=True)
+        self.settings = settings
+        self.stopped = threading.Event()
+        self.started_at = int(time.time())
+        self.stacks: Counter[str] = Counter()
+        self.stages: Counter[str] = Counter()
+        self.first_snapshot: tracemalloc.Snapshot | None = None
+        self.snapshot: tracemalloc.Snapshot | None = None
+
+    def run(self) -> None:
+        logging.info(f"Profiling the ETL for {self.settings.seconds:.0f}s")
+        memory = self.settings.memory
+        if memory:
+            tracemalloc.start(self.settings.traceback_frames)
+        deadline = time.monotonic() + self.settings.seconds
+        snapshot_at = time.monotonic() if memory else float("inf")
+        try:
+            while not self.stopped.wait(self.settings.sample_interval_ms / 1000) and time.monotonic() < deadline:
+                self.sample()
+                if time.monotonic() >= snapshot_at:
+                    self.take_snapshot()
+                    snapshot_at += self.settings.memory_interval_seconds
+            if memory:
+                self.take_snapshot()
+        finally:
+            if memory:
+                tracemalloc.stop()
+        self.write()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.join()
+
+    def sample(self) -> None:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == self.ident:
+                continue
+            labels, filenames = [], []
+            current: FrameType | None = frame
+            while current is not None:
+                labels.append(frame_label(current))
+                filenames.append(current.f_code.co_filename)
+                current = current.f_back
+            labels.append(names.get(ident, str(ident)))
+            self.stacks[";".join(reversed(labels))] += 1
+            self.stages[stage_of(filenames)] += 1
+
+    def take_snapshot(self) -> None:
+        """Keep the first and the latest snapshot; grouping them is slow and waits for the end of the window."""
+        self.snapshot = tracemalloc.take_snapshot()
+        if self.first_snapshot is None:
+            self.first_snapshot = self.snapshot
+        current, peak = tracemalloc.get_traced_memory()
+        logging.info(f"Traced memory {current / 1024**2:.1f} MiB, peak {peak / 1024**2:.1f} MiB")
+
+    def allocators(self) -> dict[str, list[tuple[str, int, int]]]:
+        """Top allocation sites of every stage as (file:line, bytes held at the end, growth over the window)."""
+        if self.snapshot is None or self.first_snapshot is None:
+            return {}
+        held: dict[str, Counter[str]] = {}
+        growth: Counter[str] = Counter()
+        for difference in self.snapshot.compare_to(self.first_snapshot, "traceback"):
+            # tracemalloc lists frames oldest first
+            frames = list(reversed(difference.traceback))
+            stage = stage_of([frame.filename for frame in frames])
+            # Innermost frame of the stage's own modules, the line that asked for the memory
+            site = next((frame for frame in frames if stage_of([frame.filename]) == stage), frames[0])
+            location = f"{'/'.join(Path(site.filename).parts[-2:])}:{site.lineno}"
+            held.setdefault(stage, Counter())[location] += difference.size
+            growth[location] += difference.size_diff
+        top = self.settings.top_allocators
+        return {
+            stage: [(location, size, growth[location]) for location, size in counter.most_common(top)]
+            for stage, counter in held.items()
+        }
+
+    def write(self) -> None:
+        path = Path(self.settings.path)
+        path.mkdir(parents=True, exist_ok=True)
+        prefix = path / f"etl-{os.getpid()}-{self.started_at}"
+
+        collapsed = prefix.with_name(prefix.name + ".collapsed")
+        collapsed.write_text("".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common()))
+
+        samples = sum(self.stages.values()) or 1
+        lines = ["Samples by stage"]
+        lines += [f"  {stage:<12} {count:>8} {count / samples:>7.1%}" for stage, count in self.stages.most_common()]
+        for stage, sites in self.allocators().items():
+            lines.append(f"Top allocators of {stage}")
+            for location, size, grown in sites:
+                lines.append(f"  {size / 1024:>10.1f} KiB held {grown / 1024:>+10.1f} KiB  {location}")
+        report = prefix.with_name(prefix.name + "-stages.txt")
+        report.write_text("\n".join(lines) + "\n")
+        logging.info(f"Profile written to {collapsed} and {report}")
+
+
+@contextmanager
+def profiled(settings: ProfilingSettings) -> Iterator[None]:
+    """Run the profiling window alongside the block if profiling is enabled; the window ends with the block."""
+    if not settings.enabled:
+        yield
+        return
+    profiler = Profiler(settings)
+    profiler.start()
+    try:
+        yield
+    finally:
+        profiler.stop()
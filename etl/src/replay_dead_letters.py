@@ -0,0 +1,148 @@
+"""Re-runs dead-lettered messages through the transformer and loader once the cause is fixed.
+
+    python replay_dead_letters.py [--batch-size 10000]
+
+Only the messages present when the replay starts are processed; whatever is rejected again goes back to the
+dead letters and waits for the next run. Replayed rows carry deduplication tokens prefixed with `dead-letter:`, so they
+never collide with the tokens of live inserts of the same offsets.
+
+Only the raw tables are loaded. Sessions, trending films and resume positions are not rebuilt: views that ClickHouse
+refused were fed to them when they were dead-lettered, and views the transformer rejected stay out of them.
+"""
+
+import argparse
+import logging
+import os
+from collections import defaultdict
+from collections.abc import Iterable
+
+from kafka import KafkaConsumer, TopicPartition
+from kafka.consumer.fetcher import ConsumerRecord
+from kafka.structs import OffsetAndMetadata
+
+from clickhouse_loader import ClickHouseLoader
+from config import ETLConfig, config
+from dead_letter import (
+    SOURCE_OFFSET_HEADER,
+    SOURCE_PARTITION_HEADER,
+    SOURCE_TIMESTAMP_HEADER,
+    SOURCE_TOPIC_HEADER,
+    FileDeadLetterSink,
+    get_dead_letter_sink,
+    source_record,
+)
+from store import BatchStore
+from transformer import KafkaToClickHouseDataTransformer
+
+logging.basicConfig(level=logging.INFO)
+
+TOKEN_PREFIX = "dead-letter:"
+
+
+def store_by_topic(store: BatchStore, records: Iterable[ConsumerRecord]) -> int:
+    by_topic: dict[str, list[ConsumerRecord]] = defaultdict(list)
+    for record in records:
+        by_topic[record.topic].append(record)
+
+    replayed = 0
+    for topic, topic_records in by_topic.items():
+        if topic not in store.routes:
+            logging.warning(f"Skipped {len(topic_records)} dead letters from unknown topic {topic}")
+            continue
+        store.store(topic, topic_records)
+        replayed += len(topic_records)
+    return replayed
+
+
+def from_dead_letter(record: ConsumerRecord) -> ConsumerRecord:
+    headers = {name: value.decode() for name, value in record.headers}
+    return source_record(
+        headers[SOURCE_TOPIC_HEADER],
+        int(headers[SOURCE_PARTITION_HEADER]),
+        int(headers[SOURCE_OFFSET_HEADER]),
+        int(headers[SOURCE_TIMESTAMP_HEADER]),
+        record.key,
+        record.value,
+    )
+
+
+def replay_topic(store: BatchStore, config: ETLConfig, batch_size: int) -> int:
+    consumer = KafkaConsumer(
+        bootstrap_servers=config.kafka.bootstrap_servers,
+        group_id=f"{config.kafka.group_id}-dead-letter-replay",
+        auto_offset_reset="earliest",
+        enable_auto_commit=False,
+    )
+    try:
+        partitions = [
+            TopicPartition(config.dead_letter.topic, partition)
+            for partition in consumer.partitions_for_topic(config.dead_letter.topic) or ()
+        ]
+        consumer.assign(partitions)
+        end_offsets = consumer.end_offsets(partitions)
+
+        replayed = 0
+        while any(consumer.position(tp) < end_offsets[tp] for tp in partitions):
+            records: list[ConsumerRecord] = []
+            offsets: dict[TopicPartition, OffsetAndMetadata] = {}
+            for tp, polled in consumer.poll(timeout_ms=1000, max_records=batch_size).items():
+                polled = [record for record in polled if record.offset < end_offsets[tp]]
+                if polled:
+                    records.extend(from_dead_letter(record) for record in polled)
+                    offsets[tp] = OffsetAndMetadata(polled[-1].offset + 1, None)
+            replayed += store_by_topic(store, records)
+            if offsets:
+                consumer.commit(offsets)
+        return replayed
+    finally:
+        consumer.close(autocommit=False)
+
+
+def replay_file(store: BatchStore, path: str, batch_size: int) -> int:
+    replaying_path = f"{path}.replay"
+    if os.path.exists(replaying_path):
+        # An earlier replay stopped midway; its batches are cut the same way again, so the rows it already
+        # inserted are deduplicated. The current file waits for the next run.
+        logging.info(f"Resuming the interrupted replay of {replaying_path}")
+    elif os.path.exists(path):
+        # Move the file aside so messages rejected again are appended to a fresh one
+        os.replace(path, replaying_path)
+    else:
+        return 0
+
+    replayed = 0
+    records: list[ConsumerRecord] = []
+    for record in FileDeadLetterSink.read_path(replaying_path):
+        records.append(record)
+        if len(records) >= batch_size:
+            replayed += store_by_topic(store, records)
+            records = []
+    replayed += store_by_topic(store, records)
+    os.remove(replaying_path)
+    return replayed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Replay dead-lettered messages into ClickHouse")
+    parser.add_argument("--batch-size", type=int, default=10_000)
+    args = parser.parse_args()
+
+    store = BatchStore(
+        config,
+        KafkaToClickHouseDataTransformer(),
+        ClickHouseLoader(config.clickhouse),
+        get_dead_letter_sink(config.dead_letter, config.kafka),
+        token_prefix=TOKEN_PREFIX,
+    )
+    try:
+        if config.dead_letter.backend == "file":
+            replayed = replay_file(store, config.dead_letter.path, args.batch_size)
+        else:
+            replayed = replay_topic(store, config, args.batch_size)
+    finally:
+        store.close()
+    logging.info(f"Replayed {replayed} dead-lettered messages")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""Groups view heartbeats into watch sessions while they are consumed.
+
+A session of a `(user_id, film_id)` pair lasts while its heartbeats are less than `session_gap_seconds` apart.
+It is emitted as one `view_sessions` row once a later heartbeat of the pair starts a new session, once the
+partition's event time moves more than the gap past its last heartbeat, or when the partition holds more than
+`session_state_limit` open sessions, in which case the least recently updated ones are closed early.
+
+Kafka keys heartbeats by user and film, so all heartbeats of a pair land in one partition and every partition's
+sessions are independent. Their state is checkpointed to a Redis hash per partition together with the next offset
+it covers, before the batch's Kafka offsets are committed. A consumer that picks the partition up restores the
+state and skips the heartbeats it already contains, so a repeated batch is neither counted twice nor lost.
+"""
+
+import struct
+from dataclasses import dataclass, field
+from uuid import UUID
+
+import backoff
+import redis
+from kafka import TopicPartition
+
+from config import ETLConfig
+from transformer import SessionColumns, ViewColumns
+
+SessionKey = tuple[UUID, UUID]
+
+# start, end, max position, heartbeats
+SESSION = struct.Struct(">IIiI")
+OFFSET_FIELD = b"offset"
+WATERMARK_FIELD = b"watermark"
+
+
+@dataclass(slots=True)
+class Session:
+    start: int
+    end: int
+    max_position: int
+    heartbeats: int
+
+
+@dataclass
+class PartitionSessions:
+    # Next offset whose heartbeat is not part of the state yet
+    offset: int = 0
+    # Latest heartbeat time seen in the partition
+    watermark: int = 0
+    # Open sessions, least recently updated first
+    open: dict[SessionKey, Session] = field(default_factory=dict)
+    changed: set[SessionKey] = field(default_factory=set)
+    closed: set[SessionKey] = field(default_factory=set)
+
+
+class Sessionizer:
+    def __init__(self, config: ETLConfig) -> None:
+        self.group_id = config.kafka.group_id
+        self.gap_seconds = config.session_gap_seconds
+        self.state_limit = config.session_state_limit
+        self.redis = redis.Redis(host=config.redis.host, port=config.redis.port, db=config.redis.db)
+        self.partitions: dict[TopicPartition, PartitionSessions] = {}
+
+    def key(self, tp: TopicPartition) -> str:
+        return f"etl:sessions:{self.group_id}:{tp.topic}:{tp.partition}"
+
+    @backoff.on_exception(backoff.expo, redis.RedisError)
+    def restore(self, partitions: list[TopicPartition]) -> None:
+        """Load the checkpointed sessions of the assigned partitions, dropping the state of all others."""
+        pipeline = self.redis.pipeline(transaction=False)
+        for tp in partitions:
+            pipeline.hgetall(self.key(tp))
+        self.partitions = {}
+        for tp, fields in zip(partitions, pipeline.execute()):
+            state = PartitionSessions(
+                offset=int(fields.pop(OFFSET_FIELD, 0)), watermark=int(fields.pop(WATERMARK_FIELD, 0))
+            )
+            sessions = [
+                ((UUID(bytes=name[:16]), UUID(bytes=name[16:])), Session(*SESSION.unpack(value)))
+                for name, value in fields.items()
+            ]
+            state.open = dict(sorted(sessions, key=lambda item: item[1].end))
+            self.partitions[tp] = state
+
+    def resume_offset(self, tp: TopicPartition) -> int:
+        """Offset from which the partition's heartbeats are new to the session state."""
+        state = self.partitions.get(tp)
+        return state.offset if state is not None else 0
+
+    def add(self, tp: TopicPartition, next_offset: int, views: ViewColumns) -> SessionColumns:
+        """Apply a chunk of a partition's heartbeats and return the sessions that closed."""
+        state = self.partitions.setdefault(tp, PartitionSessions())
+        ended = SessionColumns()
+        rows = zip(views.user_id, views.film_id, views.number_seconds_viewing, views.record_time)
+        for user_id, film_id, position, record_time in rows:
+            key = (user_id, film_id)
+            session = state.open.pop(key, None)
+            if session is not None and record_time - session.end > self.gap_seconds:
+                self.emit(state, key, session, ended)
+                session = None
+            if session is None:
+                session = Session(record_time, record_time, position, 1)
+            else:
+                session.end = max(session.end, record_time)
+                session.max_position = max(session.max_position, position)
+                session.heartbeats += 1
+            # Re-inserting keeps the open sessions ordered by their last update
+            state.open[key] = session
+            state.changed.add(key)
+            state.closed.discard(key)
+            state.watermark = max(state.watermark, record_time)
+
+        cutoff = state.watermark - self.gap_seconds
+        while state.open:
+            key, session = next(iter(state.open.items()))
+            if session.end >= cutoff and len(state.open) <= self.state_limit:
+                break
+            del state.open[key]
+            self.emit(state, key, session, ended)
+        state.offset = next_offset
+        return ended
+
+    def emit(self, state: PartitionSessions, key: SessionKey, session: Session, ended: SessionColumns) -> None:
+        ended.user_id.append(key[0])
+        ended.film_id.append(key[1])
+        ended.session_start.append(session.start)
+        ended.session_end.append(session.end)
+        ended.max_position.append(session.max_position)
+        ended.heartbeats.append(session.heartbeats)
+        state.changed.discard(key)
+        state.closed.add(key)
+
+    @backoff.on_exception(backoff.expo, redis.RedisError)
+    def checkpoint(self) -> None:
+        """Write the sessions changed since the last checkpoint, atomically with the offset they reach."""
+        pipeline = self.redis.pipeline(transaction=True)
+        written = []
+        for tp, state in self.partitions.items():
+            if not state.changed and not state.closed:
+                continue
+            if state.closed:
+                names = [user_id.bytes + film_id.bytes for user_id, film_id in state.closed]
+                pipeline.hdel(self.key(tp), *names)  # type: ignore[arg-type]
+            fields = {OFFSET_FIELD: str(state.offset).encode(), WATERMARK_FIELD: str(state.watermark).encode()}
+            for user_id, film_id in state.changed:
+                session = state.open[(user_id, film_id)]
+                fields[user_id.bytes + film_id.bytes] = SESSION.pack(
+                    session.start, session.end, session.max_position, session.heartbeats
+                )
+            pipeline.hset(self.key(tp), mapping=fields)
+            written.append(state)
+        pipeline.execute()
+        for state in written:
+            state.changed.clear()
+            state.closed.clear()
+
+    def close(self) -> None:
+        self.redis.close()
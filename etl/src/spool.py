@@ -0,0 +1,123 @@
+"""Write-ahead spool for batches that could not be inserted into ClickHouse.
+
+While ClickHouse is down the store appends failed batches to local segment files and keeps consuming, so Kafka
+offsets move on and the consumer does not stall inside an endless retry. Once inserts work again the segments
+are replayed oldest first and deleted. Every spooled batch keeps its deduplication token, so a segment that was
+only partly replayed before a crash can safely be replayed again from the start.
+"""
+
+import logging
+import os
+import struct
+from collections.abc import Callable, Iterator
+from pathlib import Path
+from typing import Any, BinaryIO
+from uuid import UUID
+
+import orjson
+
+from config import SpoolSettings
+from metrics import SPOOL_BATCHES, SPOOL_BYTES
+from transformer import ColumnBatch
+
+# Length prefix of every record in a segment
+FRAME = struct.Struct(">I")
+SEGMENT_SUFFIX = ".seg"
+
+SpooledBatch = tuple[str, list[list[Any]], str | None]
+
+
+class Spool:
+    """Append-only segment files of (topic, columns, dedup token) records, bounded by `max_bytes` in total.
+
+    Records are JSON, with UUID columns written as strings and their positions listed in the record, so they are
+    read back as UUID objects.
+    """
+
+    def __init__(self, settings: SpoolSettings) -> None:
+        self.settings = settings
+        self.path = Path(settings.path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.segments = sorted(self.path.glob(f"*{SEGMENT_SUFFIX}"))
+        self.size = sum(segment.stat().st_size for segment in self.segments)
+        self.batches = sum(1 for segment in self.segments for _ in self.read_segment(segment))
+        self.current: BinaryIO | None = None
+        self.report()
+        if self.batches:
+            logging.warning(f"Found {self.batches} spooled batches ({self.size} bytes) in {self.path}")
+
+    def __len__(self) -> int:
+        return self.batches
+
+    def report(self) -> None:
+        SPOOL_BYTES.set(self.size)
+        SPOOL_BATCHES.set(self.batches)
+
+    def open_segment(self) -> BinaryIO:
+        sequence = int(self.segments[-1].stem) + 1 if self.segments else 0
+        segment = self.path / f"{sequence:012d}{SEGMENT_SUFFIX}"
+        self.segments.append(segment)
+        return segment.open("ab")
+
+    def append(self, topic: str, columns: ColumnBatch, dedup_token: str | None) -> bool:
+        """Durably store a batch; False if that would exceed the size cap."""
+        uuid_columns = columns.uuid_columns()
+        values = [
+            [str(value) for value in column] if index in uuid_columns else column
+            for index, column in enumerate(columns.columns())
+        ]
+        payload = orjson.dumps([topic, values, dedup_token, uuid_columns])
+        frame = FRAME.pack(len(payload)) + payload
+        if self.size + len(frame) > self.settings.max_bytes:
+            return False
+        if self.current is None or self.current.tell() >= self.settings.segment_bytes:
+            self.close()
+            self.current = self.open_segment()
+        self.current.write(frame)
+        self.current.flush()
+        os.fsync(self.current.fileno())
+        self.size += len(frame)
+        self.batches += 1
+        self.report()
+        return True
+
+    @staticmethod
+    def read_segment(segment: Path) -> Iterator[SpooledBatch]:
+        with segment.open("rb") as file:
+            while header := file.read(FRAME.size):
+                (length,) = FRAME.unpack(header)
+                payload = file.read(length)
+                if len(payload) < length:
+                    # The process died in the middle of this append, so its offsets were never committed either
+                    logging.warning(f"Skipping a torn record at the end of {segment}")
+                    return
+                topic, columns, dedup_token, uuid_columns = orjson.loads(payload)
+                for index in uuid_columns:
+                    columns[index] = [UUID(value) for value in columns[index]]
+                yield topic, columns, dedup_token
+
+    def drain(self, load: Callable[[str, list[list[Any]], str | None], Any]) -> int:
+        """Load spooled batches oldest first, deleting every segment once all of it is loaded.
+
+        Stops at the first failing load and leaves its segment in place.
+        """
+        self.close()
+        drained = 0
+        while self.segments:
+            segment = self.segments[0]
+            batches = 0
+            for topic, columns, dedup_token in self.read_segment(segment):
+                load(topic, columns, dedup_token)
+                batches += 1
+            self.size -= segment.stat().st_size
+            self.batches -= batches
+            segment.unlink()
+            self.segments.pop(0)
+            drained += batches
+            self.report()
+        return drained
+
+    def close(self) -> None:
+        if self.current is not None:
+            self.current.close()
+            self.current = None
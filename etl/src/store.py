@@ -0,0 +1,300 @@
+import logging
+import time
+from collections import defaultdict
+from collections.abc import Callable
+from dataclasses import dataclass
+from typing import Any
+
+from kafka import TopicPartition
+from kafka.consumer.fetcher import ConsumerRecord
+
+from batcher import FlushReport
+from clickhouse_loader import ClickHouseLoader, is_outage
+from config import ETLConfig
+from dead_letter import DeadLetterSink
+from inflight import InflightRanges, OffsetRange, dedup_token
+from metrics import BATCH_ROWS, CHECKPOINT_SECONDS, INSERT_SECONDS, MESSAGES, ROWS_INSERTED, TRANSFORM_FAILURES
+from positions import ResumePositions
+from sessions import Sessionizer
+from spool import Spool
+from transformer import (
+    ColumnBatch,
+    EventColumns,
+    KafkaToClickHouseDataTransformer,
+    RejectedMessage,
+    SessionColumns,
+    TransformResult,
+    ViewColumns,
+    rejection_reason,
+)
+from trending import TrendingFilms
+
+# Spool key of session inserts, which come from the views topic but go to a table of their own
+SESSIONS = "sessions"
+
+
+@dataclass
+class Route:
+    """Transform and load path of a single topic."""
+
+    transform: Callable[[list[ConsumerRecord]], TransformResult[Any]]
+    load: Callable[[Any, str | None], Any]
+    columns: type[ColumnBatch]
+
+
+def split_at(records: list[ConsumerRecord], cuts: list[int]) -> list[list[ConsumerRecord]]:
+    """Split a partition's records after each of the `cuts` offsets."""
+    chunks: list[list[ConsumerRecord]] = [[]]
+    pending = iter(sorted(cuts))
+    cut = next(pending, None)
+    for record in records:
+        while cut is not None and record.offset > cut:
+            if chunks[-1]:
+                chunks.append([])
+            cut = next(pending, None)
+        chunks[-1].append(record)
+    return [chunk for chunk in chunks if chunk]
+
+
+def partition_chunks(
+    records: list[ConsumerRecord], replay_cuts: dict[TopicPartition, list[int]]
+) -> list[tuple[TopicPartition, list[ConsumerRecord]]]:
+    """Group records by partition, cutting them where unfinished inserts ended; the cuts are used up."""
+    by_partition: dict[TopicPartition, list[ConsumerRecord]] = defaultdict(list)
+    for record in records:
+        by_partition[TopicPartition(record.topic, record.partition)].append(record)
+    return [
+        (tp, chunk)
+        for tp, partition_records in by_partition.items()
+        for chunk in split_at(partition_records, replay_cuts.pop(tp, []))
+    ]
+
+
+def offset_ranges(chunks: list[tuple[TopicPartition, list[ConsumerRecord]]]) -> dict[TopicPartition, list[OffsetRange]]:
+    ranges: dict[TopicPartition, list[OffsetRange]] = defaultdict(list)
+    for tp, chunk in chunks:
+        ranges[tp].append((chunk[0].offset, chunk[-1].offset))
+    return ranges
+
+
+def account(
+    topic: str, records: list[ConsumerRecord], rows: int, rejected: list[RejectedMessage], started: float
+) -> FlushReport | None:
+    """Record metrics of a stored batch and report its throughput."""
+    MESSAGES.labels(topic).inc(len(records))
+    BATCH_ROWS.labels(topic).observe(len(records))
+    ROWS_INSERTED.labels(topic).inc(rows)
+    if rejected:
+        TRANSFORM_FAILURES.labels(topic).inc(len(rejected))
+        logging.warning(f"Sent {len(rejected)} of {len(records)} {topic} messages to dead letters")
+    if not rows:
+        return None
+    report = FlushReport(rows=rows, seconds=time.perf_counter() - started)
+    logging.debug(
+        f"Flushed {report.rows} {topic} rows in {report.seconds:.3f}s ({report.rows_per_second:.0f} rows/s)"
+    )
+    return report
+
+
+def transformed_records(chunk: list[ConsumerRecord], result: TransformResult) -> list[ConsumerRecord]:
+    """Records of a chunk that made it into the transformed columns."""
+    if not result.rejected:
+        return chunk
+    failed = {item.record.offset for item in result.rejected}
+    return [record for record in chunk if record.offset not in failed]
+
+
+def refused(
+    topic: str, columns: ColumnBatch, records: list[ConsumerRecord] | None, error: Exception
+) -> list[RejectedMessage]:
+    """Dead letters of a batch ClickHouse rejected for its data; without source records, as for sessions, none."""
+    if records is None:
+        logging.error(f"ClickHouse rejected {len(columns)} {topic} rows, dropping them: {error}")
+        return []
+    logging.error(f"ClickHouse rejected {len(columns)} {topic} rows, sending them to dead letters: {error}")
+    return [RejectedMessage(record, rejection_reason(error)) for record in records]
+
+
+class BatchStore:
+    """Transforms a batch of consumed records, loads the good rows and dead-letters the rest.
+
+    Rows are inserted per partition with a deduplication token made of the partition's offset range, so
+    inserting the same range again after a crash or a replay does not duplicate rows. With a spool, batches that
+    fail to insert are written to disk and loaded later instead of holding up the consumer.
+    """
+
+    def __init__(
+        self,
+        config: ETLConfig,
+        transformer: KafkaToClickHouseDataTransformer,
+        loader: ClickHouseLoader,
+        dead_letters: DeadLetterSink,
+        inflight: InflightRanges | None = None,
+        spool: Spool | None = None,
+        sessionizer: Sessionizer | None = None,
+        trending: TrendingFilms | None = None,
+        positions: ResumePositions | None = None,
+        token_prefix: str = "",
+    ) -> None:
+        self.transformer = transformer
+        self.loader = loader
+        self.dead_letters = dead_letters
+        self.inflight = inflight
+        self.routes: dict[str, Route] = {
+            config.kafka.views_topic: Route(transformer.transform, loader.load, ViewColumns),
+            config.kafka.events_topic: Route(transformer.transform_events, loader.load_events, EventColumns),
+        }
+        # Insert path and columns of every kind of spooled batch
+        self.tables: dict[str, tuple[Callable[[Any, str | None], Any], type[ColumnBatch]]] = {
+            **{topic: (route.load, route.columns) for topic, route in self.routes.items()},
+            SESSIONS: (loader.load_sessions, SessionColumns),
+        }
+        self.spool = spool
+        self.sessionizer = sessionizer
+        self.trending = trending
+        self.positions = positions
+        # Set for inserts of records already consumed once, so their tokens differ from the live ones
+        self.token_prefix = token_prefix
+        self.views_topic = config.kafka.views_topic
+        self.spool_retry_seconds = config.spool.retry_seconds
+        self.spool_retry_at = 0.0
+        # Last offsets of unfinished inserts per partition, to cut the replayed records the same way
+        self.replay_cuts: dict[TopicPartition, list[int]] = {}
+
+    def resume(self, positions: dict[TopicPartition, int]) -> dict[TopicPartition, list[OffsetRange]]:
+        """Find unfinished inserts of newly assigned partitions; their batches have to end at the same offsets."""
+        unfinished = self.inflight.unfinished(positions) if self.inflight is not None else {}
+        self.replay_cuts = {tp: [last for _, last in ranges] for tp, ranges in unfinished.items()}
+        if self.sessionizer is not None:
+            self.sessionizer.restore([tp for tp in positions if tp.topic == self.views_topic])
+        return unfinished
+
+    def load(
+        self, topic: str, columns: ColumnBatch, token: str, records: list[ConsumerRecord] | None
+    ) -> list[RejectedMessage]:
+        """Insert a batch, or spool it when ClickHouse is unavailable or older batches are still spooled.
+
+        A batch ClickHouse rejects for its data would fail again on every retry, so its `records` are returned
+        for the dead letters instead; without source records, as for sessions, it is only logged.
+        """
+        insert, _ = self.tables[topic]
+        if self.spool is not None and len(self.spool) and not self.drain_spool():
+            # Nothing may overtake spooled batches, the rows of one partition have to arrive in offset order
+            self.park(topic, columns, token)
+            return []
+        try:
+            insert(columns, token)
+        except Exception as e:
+            if not is_outage(e):
+                return refused(topic, columns, records, e)
+            if self.spool is None:
+                raise
+            logging.error(f"ClickHouse insert failed, spooling {len(columns)} {topic} rows: {e}")
+            self.park(topic, columns, token)
+        return []
+
+    def drain_spool(self) -> bool:
+        assert self.spool is not None
+        if time.monotonic() < self.spool_retry_at:
+            return False
+
+        def load(topic: str, columns: list[list[Any]], token: str | None) -> None:
+            insert, batch = self.tables[topic]
+            try:
+                insert(batch(*columns), token)
+            except Exception as e:
+                if is_outage(e):
+                    raise
+                # The source messages are committed already; the spool must not stay blocked behind this batch
+                logging.error(f"ClickHouse rejected a spooled {topic} batch {token}, dropping it: {e}")
+
+        try:
+            drained = self.spool.drain(load)
+        except Exception as e:
+            self.spool_retry_at = time.monotonic() + self.spool_retry_seconds
+            logging.warning(f"ClickHouse is still failing, {len(self.spool)} batches stay spooled: {e}")
+            return False
+        if drained:
+            logging.info(f"Loaded {drained} spooled batches")
+        return True
+
+    def park(self, topic: str, columns: ColumnBatch, token: str) -> None:
+        assert self.spool is not None
+        while not self.spool.append(topic, columns, token):
+            # Stop consuming rather than drop data; Kafka keeps the messages until there is room again
+            logging.error(f"Spool is full ({self.spool.size} bytes), waiting for ClickHouse")
+            time.sleep(self.spool_retry_seconds)
+            self.drain_spool()
+
+    def store(self, topic: str, records: list[ConsumerRecord]) -> FlushReport | None:
+        route = self.routes[topic]
+        chunks = partition_chunks(records, self.replay_cuts)
+        started = time.perf_counter()
+        if self.inflight is not None:
+            with CHECKPOINT_SECONDS.labels("inflight").time():
+                self.inflight.save(offset_ranges(chunks))
+
+        rows = 0
+        rejected: list[RejectedMessage] = []
+        views: list[ViewColumns] = []
+        for tp, chunk in chunks:
+            result = route.transform(chunk)
+            rejected.extend(result.rejected)
+            if len(result.columns):
+                transformed = transformed_records(chunk, result)
+                token = self.token_prefix + dedup_token(tp, (chunk[0].offset, chunk[-1].offset))
+                with INSERT_SECONDS.labels(topic).time():
+                    refused = self.load(topic, result.columns, token, transformed)
+                if refused:
+                    # Only the raw rows wait in the dead letters: the replay inserts them without sessions, trending
+                    # or resume positions, so these still take the views now
+                    rejected.extend(refused)
+                else:
+                    rows += len(result.columns)
+            if self.sessionizer is not None and topic == self.views_topic:
+                self.sessionize(tp, chunk, result.columns)
+            if self.trending is not None and topic == self.views_topic:
+                self.trending.add(result.columns)
+            if self.positions is not None and topic == self.views_topic:
+                views.append(result.columns)
+
+        if self.sessionizer is not None and topic == self.views_topic:
+            with CHECKPOINT_SECONDS.labels("sessions").time():
+                self.sessionizer.checkpoint()
+        if self.trending is not None and topic == self.views_topic:
+            self.trending.publish_due()
+        if self.positions is not None and views:
+            with CHECKPOINT_SECONDS.labels("positions").time():
+                self.positions.save(views)
+        if rejected:
+            self.dead_letters.publish(rejected)
+        return account(topic, records, rows, rejected, started)
+
+    def sessionize(self, tp: TopicPartition, chunk: list[ConsumerRecord], views: ViewColumns) -> None:
+        """Feed a chunk to the sessionizer, except heartbeats its restored state already covers."""
+        assert self.sessionizer is not None
+        resume_at = self.sessionizer.resume_offset(tp)
+        if chunk[-1].offset < resume_at:
+            return
+        if chunk[0].offset < resume_at:
+            views = self.transformer.transform([record for record in chunk if record.offset >= resume_at]).columns
+        ended = self.sessionizer.add(tp, chunk[-1].offset + 1, views)
+        if len(ended):
+            token = f"{self.token_prefix}{dedup_token(tp, (chunk[0].offset, chunk[-1].offset))}:{SESSIONS}"
+            with INSERT_SECONDS.labels(self.loader.config.sessions_table_name).time():
+                # Through the spool like the views, so an outage does not stop consuming
+                self.load(SESSIONS, ended, token, None)
+
+    def close(self) -> None:
+        self.dead_letters.close()
+        self.loader.close()
+        if self.inflight is not None:
+            self.inflight.close()
+        if self.spool is not None:
+            self.spool.close()
+        if self.sessionizer is not None:
+            self.sessionizer.close()
+        if self.trending is not None:
+            self.trending.close()
+        if self.positions is not None:
+            self.positions.close()
@@ -1,35 +1,168 @@
-import logging
-from datetime import datetime
+from dataclasses import dataclass, field, fields
+from typing import Any, Generic, TypeVar
 from uuid import UUID
 
+import orjson
 from kafka.consumer.fetcher import ConsumerRecord
-from pydantic import BaseModel
 
+from wire import decode_event, decode_key, decode_view, is_binary
 
-class FilmViewEventDTO(BaseModel):
-    user_id: UUID
-    film_id: UUID
-    number_seconds_viewing: int
-    record_time: datetime
+
+class ColumnBatch:
+    """Rows of one ClickHouse table stored column by column, in the table's column order."""
+
+    def __len__(self) -> int:
+        return len(getattr(self, fields(self)[0].name))  # type: ignore[arg-type]
+
+    @classmethod
+    def column_names(cls) -> list[str]:
+        return [column.name for column in fields(cls)]  # type: ignore[arg-type]
+
+    def columns(self) -> list[list[Any]]:
+        return [getattr(self, name) for name in self.column_names()]
+
+    @classmethod
+    def uuid_columns(cls) -> list[int]:
+        """Positions of the UUID columns, which have to be serialized explicitly outside ClickHouse."""
+        columns = fields(cls)  # type: ignore[arg-type]
+        return [index for index, column in enumerate(columns) if column.type == list[UUID]]
+
+
+@dataclass
+class ViewColumns(ColumnBatch):
+    user_id: list[UUID] = field(default_factory=list)
+    film_id: list[UUID] = field(default_factory=list)
+    number_seconds_viewing: list[int] = field(default_factory=list)
+    # Unix seconds, clickhouse_driver writes raw integers to DateTime without conversion
+    record_time: list[int] = field(default_factory=list)
+
+
+@dataclass
+class EventColumns(ColumnBatch):
+    user_id: list[UUID] = field(default_factory=list)
+    film_id: list[UUID] = field(default_factory=list)
+    event_type: list[str] = field(default_factory=list)
+    # JSON text of the event payload, sent to ClickHouse as is
+    message: list[str] = field(default_factory=list)
+    record_time: list[int] = field(default_factory=list)
+
+
+@dataclass
+class SessionColumns(ColumnBatch):
+    user_id: list[UUID] = field(default_factory=list)
+    film_id: list[UUID] = field(default_factory=list)
+    session_start: list[int] = field(default_factory=list)
+    session_end: list[int] = field(default_factory=list)
+    # Furthest playback position reached in the session, in seconds
+    max_position: list[int] = field(default_factory=list)
+    heartbeats: list[int] = field(default_factory=list)
+
+
+C = TypeVar("C", bound=ColumnBatch)
+
+INT32_MAX = 2**31 - 1
+UINT32_MAX = 2**32 - 1
+
+
+@dataclass(frozen=True)
+class RejectedMessage:
+    record: ConsumerRecord
+    reason: str
+
+
+@dataclass
+class TransformResult(Generic[C]):
+    columns: C
+    rejected: list[RejectedMessage] = field(default_factory=list)
+
+
+def rejection_reason(error: Exception) -> str:
+    return f"{type(error).__name__}: {error}"
+
+
+def check_range(name: str, value: int, low: int, high: int) -> int:
+    """Return `value`, raising ValueError if the ClickHouse column it goes to cannot hold it.
+
+    clickhouse_driver would fail the whole insert on it, or silently wrap it around.
+    """
+    if not low <= value <= high:
+        raise ValueError(f"{name} {value} is out of range [{low}, {high}]")
+    return value
+
+
+def record_time(timestamp_ms: int) -> int:
+    """Unix seconds of a timestamp in ms, checked against the range of DateTime."""
+    return check_range("record_time", timestamp_ms // 1000, 0, UINT32_MAX)
 
 
 class KafkaToClickHouseDataTransformer:
-    def transform(self, message: ConsumerRecord) -> FilmViewEventDTO | None:
-        result = None
-        try:
-            if message.key is None:
-                logging.warning("Key is None. Skipping transformation.")
-                return None
-
-            key_str = message.key.decode("utf-8")
-            user_id, film_id = key_str.split(":")
-            number_seconds_viewing = int(message.value)
-            record_time = datetime.fromtimestamp(message.timestamp / 1000)
-            result = FilmViewEventDTO(
-                user_id=user_id, film_id=film_id, number_seconds_viewing=number_seconds_viewing, record_time=record_time
-            )
-        except ValueError as ve:
-            logging.error(f"ValueError during transformation: {ve}")
-        except Exception as e:
-            logging.exception(f"Error during transformation: {e}")
+    def transform(self, messages: list[ConsumerRecord]) -> TransformResult[ViewColumns]:
+        """Turn view messages into insert-ready columns.
+
+        Accepts the binary format of wire.py and the legacy `user_id:film_id` -> `seconds` text messages.
+        """
+        result = TransformResult(ViewColumns())
+        columns = result.columns
+        user_ids, film_ids = columns.user_id.append, columns.film_id.append
+        seconds, record_times = columns.number_seconds_viewing.append, columns.record_time.append
+
+        for message in messages:
+            try:
+                if is_binary(message.key):
+                    user_uuid, film_uuid = decode_key(message.key)
+                    timestamp_ms, number_seconds_viewing = decode_view(message.value)
+                else:
+                    user_id, film_id = message.key.split(b":")
+                    user_uuid, film_uuid = UUID(user_id.decode()), UUID(film_id.decode())
+                    number_seconds_viewing = int(message.value)
+                    timestamp_ms = message.timestamp
+                check_range("number_seconds_viewing", number_seconds_viewing, 0, INT32_MAX)
+                timestamp = record_time(timestamp_ms)
+            except (AttributeError, TypeError, ValueError) as e:
+                result.rejected.append(RejectedMessage(message, rejection_reason(e)))
+                continue
+            user_ids(user_uuid)
+            film_ids(film_uuid)
+            seconds(number_seconds_viewing)
+            record_times(timestamp)
+        return result
+
+    def transform_events(self, messages: list[ConsumerRecord]) -> TransformResult[EventColumns]:
+        """Turn event messages, binary or legacy `user_id:film_id:event_type` -> JSON, into insert-ready columns."""
+        result = TransformResult(EventColumns())
+        columns = result.columns
+
+        for message in messages:
+            try:
+                if is_binary(message.key):
+                    user_uuid, film_uuid = decode_key(message.key)
+                    timestamp_ms, event_code, payload = decode_event(message.value)
+                    event_type = str(check_range("event_type", event_code, 0, UINT32_MAX))
+                else:
+                    user_id, film_id, event_type = message.key.decode().split(":")
+                    user_uuid, film_uuid = UUID(user_id), UUID(film_id)
+                    timestamp_ms, payload = message.timestamp, message.value or b""
+                    if not event_type:
+                        raise ValueError("Empty event_type")
+                timestamp = record_time(timestamp_ms)
+            except (AttributeError, TypeError, ValueError) as e:
+                result.rejected.append(RejectedMessage(message, rejection_reason(e)))
+                continue
+            columns.user_id.append(user_uuid)
+            columns.film_id.append(film_uuid)
+            columns.event_type.append(event_type)
+            columns.message.append(self.event_payload(payload))
+            columns.record_time.append(timestamp)
         return result
+
+    @staticmethod
+    def event_payload(value: bytes) -> str:
+        """Return the event value as JSON object text, wrapping anything that is not an object."""
+        text = value.decode("utf-8", "replace")
+        try:
+            if isinstance(orjson.loads(value), dict):
+                # Pass the original text through without re-encoding it
+                return text
+        except orjson.JSONDecodeError:
+            pass
+        return orjson.dumps({"value": text}).decode("utf-8")
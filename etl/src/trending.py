@@ -0,0 +1,207 @@
+"""Sliding-window top list of films by viewers and watch seconds, published to Redis for the UGC API.
+
+Event time is split into buckets of `bucket_seconds`, and the window is the last `window_buckets` of them. Every
+bucket counts films in two count-min sketches, one for viewers and one for watch seconds, and the window keeps
+their sum, so a bucket leaving the window is subtracted from it. Memory does not depend on the number of films or
+users. A viewer is a (user, film) pair seen in a bucket, counted once per bucket by a bit filter, so `viewers` is the
+number of viewer-buckets (viewer-minutes with the default buckets): a user watching for the whole window counts once
+per bucket, not once. Watch seconds sum `number_seconds_viewing` like the film_daily_views aggregate does.
+
+Candidates for the top list are kept in a dict bounded to twice the list size. A film enters it when its window
+estimate beats the smallest candidate, and the list is taken from it with a heap.
+
+A consumer only sees the films of its own partitions. It publishes its list to `<prefix>:<metric>:<consumer>` and
+merges the lists of all live consumers into `<prefix>:<metric>` with ZUNIONSTORE, which the API reads with one
+ZRANGE. Lists are published as batches of heartbeats are stored and expire after the window length, so the last
+list stays readable while traffic pauses and every count it holds would have left the window by then. Sketches are
+not checkpointed: after a restart or rebalance a consumer's counts start from the heartbeats it consumes from then
+on, while the list its predecessor published stays in the merge until it expires.
+"""
+
+import heapq
+import logging
+import os
+import time
+from array import array
+from collections import deque
+from dataclasses import dataclass, field
+from uuid import UUID
+
+import redis
+
+from config import ETLConfig
+from transformer import ViewColumns
+
+METRICS = ("viewers", "watch_seconds")
+
+
+class CountMinSketch:
+    def __init__(self, width: int, depth: int) -> None:
+        self.width = width
+        self.depth = depth
+        self.table = array("q", bytes(8 * width * depth))
+
+    def cells(self, key: int) -> list[int]:
+        """Positions of a key in the flat table, one per row."""
+        return [row * self.width + hash((row, key)) % self.width for row in range(self.depth)]
+
+    def add(self, cells: list[int], count: int) -> None:
+        for cell in cells:
+            self.table[cell] += count
+
+    def estimate(self, cells: list[int]) -> int:
+        return min(self.table[cell] for cell in cells)
+
+    def subtract(self, other: "CountMinSketch") -> None:
+        table = self.table
+        for cell, count in enumerate(other.table):
+            if count:
+                table[cell] -= count
+
+
+@dataclass
+class Bucket:
+    index: int
+    sketches: dict[str, CountMinSketch]
+    seen: bytearray = field(repr=False)
+
+
+class TrendingFilms:
+    def __init__(self, config: ETLConfig) -> None:
+        settings = config.trending
+        self.size = settings.size
+        self.bucket_seconds = settings.bucket_seconds
+        self.window_buckets = settings.window_buckets
+        self.publish_seconds = settings.publish_seconds
+        self.width = settings.sketch_width
+        self.depth = settings.sketch_depth
+        self.filter_bits = settings.viewer_filter_bits
+        self.prefix = settings.key_prefix
+        self.consumer = f"{config.kafka.client_id}:{os.getpid()}"
+        # Lists are only published while heartbeats arrive; they stay valid until their buckets left the window
+        self.ttl_seconds = self.bucket_seconds * self.window_buckets
+        self.redis = redis.Redis(host=config.redis.host, port=config.redis.port, db=config.redis.db)
+        self.buckets: deque[Bucket] = deque()
+        self.window = {metric: CountMinSketch(self.width, self.depth) for metric in METRICS}
+        self.candidates: dict[str, dict[int, int]] = {metric: {} for metric in METRICS}
+        self.published_at = 0.0
+
+    def key(self, metric: str, consumer: str | None = None) -> str:
+        return f"{self.prefix}:{metric}:{consumer}" if consumer else f"{self.prefix}:{metric}"
+
+    def bucket(self, index: int) -> Bucket | None:
+        """Bucket of an event time bucket index, opening it if it is newer than the window; None if too old."""
+        if not self.buckets or index > self.buckets[-1].index:
+            self.buckets.append(
+                Bucket(
+                    index,
+                    {metric: CountMinSketch(self.width, self.depth) for metric in METRICS},
+                    bytearray(self.filter_bits // 8),
+                )
+            )
+            while self.buckets[0].index <= index - self.window_buckets:
+                expired = self.buckets.popleft()
+                for metric, sketch in expired.sketches.items():
+                    self.window[metric].subtract(sketch)
+            return self.buckets[-1]
+        for bucket in reversed(self.buckets):
+            if bucket.index == index:
+                return bucket
+            if bucket.index < index:
+                # A gap in event time left no bucket for it; late heartbeats this rare are not worth one
+                return None
+        return None
+
+    def add(self, views: ViewColumns) -> None:
+        """Count a batch of heartbeats, summed per bucket and film first so each film touches the sketches once."""
+        counts: dict[tuple[int, int], list[int]] = {}
+        buckets: dict[int, Bucket | None] = {}
+        rows = zip(views.user_id, views.film_id, views.number_seconds_viewing, views.record_time)
+        for user_id, film_id, seconds, record_time in rows:
+            index = record_time // self.bucket_seconds
+            if index not in buckets:
+                buckets[index] = self.bucket(index)
+            bucket = buckets[index]
+            if bucket is None:
+                continue
+            film = film_id.int
+            total = counts.setdefault((index, film), [0, 0])
+            bit = hash((user_id.int, film)) % self.filter_bits
+            byte, mask = bit >> 3, 1 << (bit & 7)
+            if not bucket.seen[byte] & mask:
+                bucket.seen[byte] |= mask
+                total[0] += 1
+            total[1] += seconds
+
+        touched: dict[int, list[int]] = {}
+        oldest = self.buckets[-1].index - self.window_buckets if self.buckets else 0
+        for (index, film), totals in counts.items():
+            bucket = buckets[index]
+            # A batch spanning more than the window may have expired buckets it opened itself
+            if bucket is None or bucket.index <= oldest:
+                continue
+            cells = touched.setdefault(film, self.window[METRICS[0]].cells(film))
+            for metric, count in zip(METRICS, totals):
+                bucket.sketches[metric].add(cells, count)
+                self.window[metric].add(cells, count)
+        for metric in METRICS:
+            self.offer(metric, {film: self.window[metric].estimate(cells) for film, cells in touched.items()})
+
+    def offer(self, metric: str, estimates: dict[int, int]) -> None:
+        """Let films into the candidates of a metric in place of smaller ones once it is full."""
+        candidates = self.candidates[metric]
+        # Window counts only grow while a batch is added, so the smallest candidate stays so until it is updated
+        smallest: int | None = None
+        for film, estimate in estimates.items():
+            if film in candidates or len(candidates) < 2 * self.size:
+                candidates[film] = estimate
+                if film == smallest:
+                    smallest = None
+                continue
+            if smallest is None:
+                smallest = min(candidates, key=candidates.__getitem__)
+            if estimate > candidates[smallest]:
+                del candidates[smallest]
+                candidates[film] = estimate
+                smallest = None
+
+    def top(self, metric: str) -> list[tuple[int, int]]:
+        """Current top list, with the estimates of candidates refreshed for buckets that left the window."""
+        sketch, candidates = self.window[metric], self.candidates[metric]
+        for film in candidates:
+            candidates[film] = sketch.estimate(sketch.cells(film))
+        return heapq.nlargest(self.size, candidates.items(), key=lambda item: item[1])
+
+    def publish_due(self) -> None:
+        if time.monotonic() - self.published_at >= self.publish_seconds:
+            self.publish()
+
+    def publish(self) -> None:
+        self.published_at = time.monotonic()
+        try:
+            now = time.time()
+            consumers_key = f"{self.prefix}:consumers"
+            pipeline = self.redis.pipeline(transaction=True)
+            for metric in METRICS:
+                own = self.key(metric, self.consumer)
+                pipeline.delete(own)
+                top = {str(UUID(int=film)): score for film, score in self.top(metric) if score > 0}
+                if top:
+                    pipeline.zadd(own, top)
+                pipeline.expire(own, self.ttl_seconds)
+            pipeline.zadd(consumers_key, {self.consumer: now})
+            pipeline.zremrangebyscore(consumers_key, 0, now - self.ttl_seconds)
+            pipeline.zrange(consumers_key, 0, -1)
+            consumers = [consumer.decode() for consumer in pipeline.execute()[-1]]
+
+            pipeline = self.redis.pipeline(transaction=True)
+            for metric in METRICS:
+                pipeline.zunionstore(self.key(metric), [self.key(metric, consumer) for consumer in consumers])
+                pipeline.expire(self.key(metric), self.ttl_seconds)
+            pipeline.execute()
+        except redis.RedisError as e:
+            # The list is refreshed every few seconds, a missed publication is not worth holding up the batch
+            logging.warning(f"Failed to publish trending films: {e}")
+
+    def close(self) -> None:
+        self.redis.close()
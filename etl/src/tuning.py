@@ -0,0 +1,56 @@
+"""Adaptive batch size of every topic, switched off by ETL_ADAPTIVE_BATCHES=false.
+
+After each stored batch the size of its topic is adjusted additive-increase, multiplicative-decrease:
+
+    shrink by `decrease_factor`  storing took longer than `target_store_seconds` or RSS is above `max_rss_mb`
+    grow by `increase_step`      the batch was full, stored in time, and the topic lags by more than a batch
+    keep                         otherwise, e.g. the consumer keeps up and batches are cut by the flush interval
+
+Larger batches mean fewer inserts and parts in ClickHouse while the consumer is behind; smaller ones bring insert
+latency and memory back down as soon as ClickHouse slows or the process grows. The size is bounded by
+`min_batch_size` and `max_batch_size`, and the records fetched per poll follow the largest one.
+"""
+
+import logging
+import os
+import resource
+
+from config import TuningSettings
+from metrics import BATCH_SIZE
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+def current_rss() -> int:
+    """Resident set size of the process in bytes, the peak one where /proc is not available."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * PAGE_SIZE
+    except OSError:
+        # ru_maxrss is in KiB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class BatchSizer:
+    def __init__(self, settings: TuningSettings, topic: str, batch_size: int) -> None:
+        self.settings = settings
+        self.topic = topic
+        self.size = min(max(batch_size, settings.min_batch_size), settings.max_batch_size)
+        BATCH_SIZE.labels(topic).set(self.size)
+
+    def observe(self, messages: int, seconds: float, lag: int, rss: int) -> int:
+        """Adjust the size after storing `messages` in `seconds` with `lag` messages left, and return it."""
+        settings = self.settings
+        size = self.size
+        if seconds > settings.target_store_seconds or rss > settings.max_rss_mb * 1024**2:
+            size = max(settings.min_batch_size, int(size * settings.decrease_factor))
+        elif messages >= size and lag > size:
+            size = min(settings.max_batch_size, size + settings.increase_step)
+        if size != self.size:
+            logging.debug(
+                f"Batch size of {self.topic}: {self.size} -> {size} "
+                f"({messages} messages stored in {seconds:.3f}s, lag {lag}, RSS {rss / 1024**2:.0f} MiB)"
+            )
+            self.size = size
+            BATCH_SIZE.labels(self.topic).set(size)
+        return size
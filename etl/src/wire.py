@@ -0,0 +1,99 @@
+"""Binary wire format of view and event messages.
+
+The same module lives in ugc/src/storage/wire.py (producer) and etl/src/wire.py (consumer); keep both copies
+identical, tests/test_shared_modules.py in the ETL checks it.
+
+    key   = user_id (16 bytes) + film_id (16 bytes)
+    view  = version byte, timestamp in ms (8 bytes, big-endian), varint seconds watched
+    event = version byte, timestamp in ms (8 bytes, big-endian), varint event type, JSON payload up to the end
+
+The version byte has its high bit set. Legacy messages have `user_id:film_id[:event_type]` text keys, at least 73
+bytes long, and their values may be any UTF-8 text, so a consumer tells the formats apart by the length of the key
+rather than by the first byte of the value.
+"""
+
+import struct
+from uuid import UUID
+
+VERSION = 1
+BINARY_MARKER = 0x80
+VERSION_BYTE = bytes([BINARY_MARKER | VERSION])
+KEY_SIZE = 32
+HEADER = struct.Struct(">BQ")
+
+
+def is_binary(key: bytes | None) -> bool:
+    """Whether a message with this key is in the binary format; its value is checked when it is decoded."""
+    return key is not None and len(key) == KEY_SIZE
+
+
+def write_varint(value: int, out: bytearray) -> None:
+    if value < 0:
+        raise ValueError(f"Negative varint {value}")
+    while value > 0x7F:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def read_varint(data: bytes, position: int) -> tuple[int, int]:
+    """Return the varint at `position` and the position after it."""
+    value = shift = 0
+    while True:
+        try:
+            byte = data[position]
+        except IndexError:
+            raise ValueError("Truncated varint") from None
+        position += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+
+def read_header(value: bytes) -> int:
+    """Check the version and return the timestamp in ms."""
+    try:
+        version, timestamp_ms = HEADER.unpack_from(value)
+    except struct.error as e:
+        raise ValueError(f"Truncated header: {e}") from None
+    if version != VERSION_BYTE[0]:
+        raise ValueError(f"Unsupported wire format version {version & ~BINARY_MARKER}")
+    return timestamp_ms  # type: ignore[no-any-return]
+
+
+def encode_key(user_id: UUID, film_id: UUID) -> bytes:
+    return user_id.bytes + film_id.bytes
+
+
+def decode_key(key: bytes) -> tuple[UUID, UUID]:
+    if len(key) != KEY_SIZE:
+        raise ValueError(f"Binary key must be {KEY_SIZE} bytes, got {len(key)}")
+    return UUID(bytes=key[:16]), UUID(bytes=key[16:])
+
+
+def encode_view(timestamp_ms: int, seconds: int) -> bytes:
+    out = bytearray(HEADER.pack(VERSION_BYTE[0], timestamp_ms))
+    write_varint(seconds, out)
+    return bytes(out)
+
+
+def decode_view(value: bytes) -> tuple[int, int]:
+    """Return (timestamp in ms, seconds watched)."""
+    timestamp_ms = read_header(value)
+    seconds, _ = read_varint(value, HEADER.size)
+    return timestamp_ms, seconds
+
+
+def encode_event(timestamp_ms: int, event_type: int, payload: bytes) -> bytes:
+    out = bytearray(HEADER.pack(VERSION_BYTE[0], timestamp_ms))
+    write_varint(event_type, out)
+    out += payload
+    return bytes(out)
+
+
+def decode_event(value: bytes) -> tuple[int, int, bytes]:
+    """Return (timestamp in ms, event type, JSON payload)."""
+    timestamp_ms = read_header(value)
+    event_type, position = read_varint(value, HEADER.size)
+    return timestamp_ms, event_type, value[position:]
@@ -0,0 +1,75 @@
+"""Runs several ETL consumers on one host.
+
+Every worker is a separate process with its own Kafka consumer and ClickHouse connection. All of them,
+including workers started on other hosts, join the same consumer group, so Kafka spreads the partitions of the
+views and events topics between them and each partition's progress is tracked by its own committed offset.
+Throughput therefore grows with workers only up to the number of topic partitions.
+"""
+
+import logging
+import multiprocessing
+import signal
+import time
+from multiprocessing.process import BaseProcess
+from types import FrameType
+
+from config import config
+
+logging.basicConfig(level=logging.INFO)
+
+SUPERVISE_INTERVAL_SECONDS = 5
+
+
+def run_worker(index: int) -> None:
+    from main import create_etl
+    from metrics import start_metrics_server
+    from profiling import profiled
+
+    def stop(signum: int, frame: FrameType | None) -> None:
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    config.kafka.client_id = f"{config.kafka.client_id}-{index}"
+    if config.spool.path:
+        config.spool.path = f"{config.spool.path}/{index}"
+    # Each worker exposes its own metrics, scrape ports metrics_port .. metrics_port + workers - 1
+    start_metrics_server(config.metrics_port + index if config.metrics_port else 0)
+    etl_process = create_etl()
+    try:
+        with profiled(config.profiling):
+            etl_process.start()
+    finally:
+        etl_process.close()
+
+
+def run_workers(count: int) -> None:
+    """Start `count` worker processes and restart the ones that die until the supervisor is stopped."""
+    context = multiprocessing.get_context("spawn")
+    workers: dict[int, BaseProcess] = {}
+    stopping = False
+
+    def stop(signum: int, frame: FrameType | None) -> None:
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    try:
+        while not stopping:
+            for index in range(count):
+                worker = workers.get(index)
+                if worker is not None and worker.is_alive():
+                    continue
+                if worker is not None:
+                    logging.error(f"ETL worker {index} exited with code {worker.exitcode}, restarting")
+                worker = context.Process(target=run_worker, args=(index,), name=f"etl-worker-{index}")
+                worker.start()
+                workers[index] = worker
+            time.sleep(SUPERVISE_INTERVAL_SECONDS)
+    finally:
+        for worker in workers.values():
+            worker.terminate()
+        for worker in workers.values():
+            worker.join()
+        logging.info("ETL workers stopped")
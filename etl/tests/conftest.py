@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The ETL runs from etl/src with flat imports
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
@@ -0,0 +1,90 @@
+import asyncio
+from uuid import uuid4
+
+from asynch.errors import NetworkError, ServerException
+
+from async_etl import AsyncBatchStore
+from config import ETLConfig, SpoolSettings
+from dead_letter import source_record
+from spool import Spool
+from transformer import KafkaToClickHouseDataTransformer
+from wire import encode_key, encode_view
+
+TYPE_MISMATCH = 53
+
+
+class FailingLoader:
+    """Async loader whose inserts fail with `error` until it is cleared."""
+
+    def __init__(self, error: Exception | None) -> None:
+        self.error = error
+        self.loaded: list[str | None] = []
+
+    async def load(self, batch, dedup_token=None):
+        if self.error is not None:
+            raise self.error
+        self.loaded.append(dedup_token)
+
+    load_events = load
+
+
+class RecordingSink:
+    def __init__(self) -> None:
+        self.published: list = []
+
+    def publish(self, rejected) -> None:
+        self.published.extend(rejected)
+
+
+class MemoryInflight:
+    async def save(self, ranges) -> None:
+        pass
+
+
+def views(config: ETLConfig) -> list:
+    key = encode_key(uuid4(), uuid4())
+    return [
+        source_record(config.kafka.views_topic, 0, offset, 0, key, encode_view(1_700_000_000_000, offset))
+        for offset in range(3)
+    ]
+
+
+def batch_store(config: ETLConfig, loader: FailingLoader, sink: RecordingSink, spool=None) -> AsyncBatchStore:
+    return AsyncBatchStore(
+        config,
+        KafkaToClickHouseDataTransformer(),
+        loader,  # type: ignore[arg-type]
+        sink,  # type: ignore[arg-type]
+        MemoryInflight(),  # type: ignore[arg-type]
+        spool,
+    )
+
+
+def test_refused_batches_are_dead_lettered():
+    config = ETLConfig()
+    sink = RecordingSink()
+    store = batch_store(config, FailingLoader(ServerException("Type mismatch", TYPE_MISMATCH)), sink)
+
+    asyncio.run(store.store(config.kafka.views_topic, views(config)))
+
+    assert [item.record.offset for item in sink.published] == [0, 1, 2]
+    assert sink.published[0].reason.startswith("ServerException")
+
+
+def test_batches_are_spooled_during_an_outage(tmp_path):
+    config = ETLConfig()
+    spool = Spool(SpoolSettings(path=str(tmp_path)))
+    loader, sink = FailingLoader(NetworkError("Connection refused")), RecordingSink()
+    store = batch_store(config, loader, sink, spool)
+
+    async def outage_and_recovery() -> None:
+        await store.store(config.kafka.views_topic, views(config))
+        assert len(spool) == 1
+        assert not sink.published
+
+        loader.error = None
+        await store.store(config.kafka.views_topic, views(config))
+        assert len(spool) == 0
+        assert len(loader.loaded) == 2
+
+    asyncio.run(outage_and_recovery())
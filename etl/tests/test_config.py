@@ -0,0 +1,107 @@
+import pytest
+
+from config import ETLConfig
+
+
+def test_spool_reads_its_own_variables(monkeypatch):
+    monkeypatch.setenv("PATH", "/usr/local/bin:/usr/bin")
+    monkeypatch.setenv("ETL_SPOOL_PATH", "/var/lib/etl/spool")
+    monkeypatch.setenv("ETL_SPOOL_MAX_BYTES", "1048576")
+
+    config = ETLConfig()
+
+    assert config.spool.path == "/var/lib/etl/spool"
+    assert config.spool.max_bytes == 1048576
+
+
+def test_spool_path_does_not_follow_path(monkeypatch):
+    monkeypatch.setenv("PATH", "/usr/local/bin:/usr/bin")
+    monkeypatch.delenv("ETL_SPOOL_PATH", raising=False)
+
+    assert ETLConfig().spool.path == "spool"
+
+
+def test_dead_letters_read_their_own_variables(monkeypatch):
+    monkeypatch.setenv("PATH", "/usr/local/bin:/usr/bin")
+    monkeypatch.setenv("BACKEND", "kafka")
+    monkeypatch.setenv("DEAD_LETTER_BACKEND", "file")
+    monkeypatch.setenv("DEAD_LETTER_PATH", "/var/lib/etl/dead_letter.jsonl")
+
+    config = ETLConfig()
+
+    assert config.dead_letter.backend == "file"
+    assert config.dead_letter.path == "/var/lib/etl/dead_letter.jsonl"
+    assert config.dead_letter.topic == "dead_letter"
+
+
+def test_profiling_reads_its_own_variables(monkeypatch):
+    monkeypatch.setenv("PATH", "/usr/local/bin:/usr/bin")
+    monkeypatch.setenv("ENABLED", "false")
+    monkeypatch.setenv("ETL_PROFILE", "true")
+    monkeypatch.setenv("ETL_PROFILE_SECONDS", "15")
+    monkeypatch.setenv("ETL_PROFILE_PATH", "/tmp/profiles")
+    monkeypatch.setenv("ETL_PROFILE_MEMORY", "false")
+
+    profiling = ETLConfig().profiling
+
+    assert profiling.enabled
+    assert profiling.seconds == 15
+    assert profiling.path == "/tmp/profiles"
+    assert not profiling.memory
+
+
+def test_trending_switch_reads_its_own_variable(monkeypatch):
+    monkeypatch.setenv("ENABLED", "true")
+    monkeypatch.setenv("ETL_TRENDING", "false")
+
+    assert not ETLConfig().trending.enabled
+
+
+def test_tuning_reads_its_own_variables(monkeypatch):
+    monkeypatch.setenv("ENABLED", "true")
+    monkeypatch.setenv("ETL_ADAPTIVE_BATCHES", "false")
+    monkeypatch.setenv("ETL_MAX_BATCH_SIZE", "20000")
+    monkeypatch.setenv("ETL_MAX_RSS_MB", "512")
+
+    tuning = ETLConfig().tuning
+
+    assert not tuning.enabled
+    assert tuning.max_batch_size == 20000
+    assert tuning.max_rss_mb == 512
+
+
+@pytest.mark.parametrize("runtime", ["sync", "pipelined", "asyncio"])
+def test_runtime_is_selected_by_etl_runtime(monkeypatch, runtime):
+    monkeypatch.setenv("ETL_RUNTIME", runtime)
+    monkeypatch.setenv("ETL_STREAMING", "false")
+
+    config = ETLConfig()
+
+    assert config.runtime == runtime
+    assert not config.streaming
+
+
+def test_clickhouse_and_kafka_read_their_own_variables(monkeypatch):
+    monkeypatch.setenv("USER", "root")
+    monkeypatch.setenv("HOST", "localhost")
+    monkeypatch.setenv("CLICKHOUSE_HOST", "clickhouse-node2")
+    monkeypatch.setenv("CLICKHOUSE_SHARDS", "clickhouse-node1:9000,clickhouse-node2:9000")
+    monkeypatch.setenv("CLICKHOUSE_REPLICATED", "false")
+    monkeypatch.setenv("KAFKA_BOOTSTRAP_SERVERS", "kafka-node2:9092")
+    monkeypatch.setenv("KAFKA_FETCH_MAX_BYTES", "1048576")
+
+    config = ETLConfig()
+
+    assert config.clickhouse.host == "clickhouse-node2"
+    assert config.clickhouse.user == "admin"
+    assert config.clickhouse.topology() == [[("clickhouse-node1", 9000), ("clickhouse-node2", 9000)]]
+    assert not config.clickhouse.replicated
+    assert config.kafka.bootstrap_servers == "kafka-node2:9092"
+    assert config.kafka.fetch_max_bytes == 1048576
+
+
+def test_workers_are_set_by_etl_workers(monkeypatch):
+    monkeypatch.setenv("WORKERS", "5")
+    monkeypatch.setenv("ETL_WORKERS", "3")
+
+    assert ETLConfig().workers == 3
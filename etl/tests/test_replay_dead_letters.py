@@ -0,0 +1,44 @@
+import os
+
+import pytest
+
+from config import DeadLetterSettings
+from dead_letter import FileDeadLetterSink, source_record
+from replay_dead_letters import replay_file
+from transformer import RejectedMessage
+
+
+class RecordingStore:
+    def __init__(self, fail_after: int | None = None) -> None:
+        self.routes = {"views": None}
+        self.stored: list[int] = []
+        self.fail_after = fail_after
+
+    def store(self, topic, records):
+        if self.fail_after is not None and len(self.stored) >= self.fail_after:
+            raise ConnectionError("ClickHouse went away")
+        self.stored.extend(record.offset for record in records)
+
+
+def dead_letter(path: str, offsets: range) -> None:
+    sink = FileDeadLetterSink(DeadLetterSettings(path=path))
+    sink.publish([RejectedMessage(source_record("views", 0, offset, 0, b"key", b"1"), "error") for offset in offsets])
+
+
+def test_replay_file_resumes_an_interrupted_replay_before_rotating(tmp_path):
+    path = str(tmp_path / "dead_letters.jsonl")
+    dead_letter(path, range(4))
+
+    with pytest.raises(ConnectionError):
+        replay_file(RecordingStore(fail_after=2), path, batch_size=2)  # type: ignore[arg-type]
+    # Rejected again while the replay was running
+    dead_letter(path, range(10, 12))
+
+    store = RecordingStore()
+    assert replay_file(store, path, batch_size=2) == 4  # type: ignore[arg-type]
+    assert store.stored == [0, 1, 2, 3]
+    assert not os.path.exists(f"{path}.replay")
+
+    assert replay_file(store, path, batch_size=2) == 2  # type: ignore[arg-type]
+    assert store.stored[4:] == [10, 11]
+    assert not os.path.exists(path)
@@ -0,0 +1,43 @@
+"""The wire format and the cluster topology are shared with the UGC API, which keeps its own copies of the modules."""
+
+from pathlib import Path
+from uuid import UUID, uuid4
+
+import pytest
+
+import topology
+import wire
+
+SRC = Path(__file__).parents[1] / "src"
+UGC_SRC = Path(__file__).parents[2] / "ugc" / "src"
+SHARED = [("wire.py", "storage/wire.py"), ("topology.py", "core/topology.py")]
+
+
+@pytest.mark.parametrize("etl_path, ugc_path", SHARED)
+def test_ugc_copies_are_identical(etl_path, ugc_path):
+    if not UGC_SRC.exists():
+        pytest.skip("UGC sources are not next to the ETL")
+    assert (UGC_SRC / ugc_path).read_bytes() == (SRC / etl_path).read_bytes()
+
+
+def test_wire_round_trip():
+    user_id, film_id = uuid4(), uuid4()
+    assert wire.decode_key(wire.encode_key(user_id, film_id)) == (user_id, film_id)
+    assert wire.decode_view(wire.encode_view(1_700_000_000_000, 300)) == (1_700_000_000_000, 300)
+    event = wire.encode_event(1_700_000_000_000, 2**20, b'{"rating": 10}')
+    key = wire.encode_key(user_id, film_id)
+    assert wire.is_binary(key) and not wire.is_binary(f"{user_id}:{film_id}".encode())
+    assert wire.decode_event(event) == (1_700_000_000_000, 2**20, b'{"rating": 10}')
+
+
+def test_parse_topology():
+    assert topology.parse_topology("", "clickhouse-node1", 9000) == [[("clickhouse-node1", 9000)]]
+    assert topology.parse_topology("node1:9001, node2;node3", "ignored", 9000) == [
+        [("node1", 9001), ("node2", 9000)],
+        [("node3", 9000)],
+    ]
+
+
+def test_shard_of():
+    assert topology.shard_of(UUID(int=7), 1) == 0
+    assert topology.shard_of(UUID(int=7), 3) == 1
@@ -0,0 +1,39 @@
+from uuid import UUID, uuid4
+
+from clickhouse_loader import split_by_shard
+from config import SpoolSettings
+from spool import Spool
+from transformer import EventColumns, ViewColumns
+
+
+def spool_at(tmp_path) -> Spool:
+    return Spool(SpoolSettings(path=str(tmp_path)))
+
+
+def test_append_and_read_segment_keep_uuid_columns(tmp_path):
+    views = ViewColumns([uuid4(), uuid4()], [uuid4(), uuid4()], [10, 20], [1_700_000_000, 1_700_000_005])
+    events = EventColumns([uuid4()], [uuid4()], ["3"], ['{"rating": 10}'], [1_700_000_000])
+    spool = spool_at(tmp_path)
+    assert spool.append("views", views, "views:0:0-1")
+    assert spool.append("events", events, None)
+    spool.close()
+
+    [segment] = spool.segments
+    read = list(Spool.read_segment(segment))
+
+    assert read == [("views", views.columns(), "views:0:0-1"), ("events", events.columns(), None)]
+    assert all(isinstance(value, UUID) for _, columns, _ in read for column in columns[:2] for value in column)
+    # Spooled batches are split by user_id again when they are loaded
+    assert sum(len(columns[0]) for columns in split_by_shard(ViewColumns(*read[0][1]), 3)) == 2
+
+
+def test_drain_loads_oldest_first_and_removes_segments(tmp_path):
+    spool = spool_at(tmp_path)
+    for offset in range(3):
+        spool.append("views", ViewColumns([uuid4()], [uuid4()], [offset], [1_700_000_000]), f"views:0:{offset}")
+    loaded = []
+
+    assert spool.drain(lambda topic, columns, token: loaded.append(token)) == 3
+
+    assert loaded == ["views:0:0", "views:0:1", "views:0:2"]
+    assert len(spool) == 0 and not list(tmp_path.glob("*.seg"))
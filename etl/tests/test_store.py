@@ -0,0 +1,76 @@
+from uuid import uuid4
+
+from clickhouse_driver.errors import ErrorCodes, ServerException
+
+from config import ETLConfig
+from dead_letter import source_record
+from store import BatchStore
+from transformer import KafkaToClickHouseDataTransformer
+from wire import encode_key, encode_view
+
+
+class RejectingLoader:
+    """Loader whose inserts ClickHouse refuses for their data."""
+
+    def __init__(self, config: ETLConfig) -> None:
+        self.config = config.clickhouse
+
+    def load(self, batch, dedup_token=None):
+        raise ServerException("Type mismatch", ErrorCodes.TYPE_MISMATCH)
+
+    load_events = load_sessions = load
+
+    def close(self) -> None:
+        pass
+
+
+class RecordingSink:
+    def __init__(self) -> None:
+        self.published: list = []
+
+    def publish(self, rejected) -> None:
+        self.published.extend(rejected)
+
+
+class RecordingTrending:
+    def __init__(self) -> None:
+        self.views = 0
+
+    def add(self, views) -> None:
+        self.views += len(views)
+
+    def publish_due(self) -> None:
+        pass
+
+
+class RecordingPositions:
+    def __init__(self) -> None:
+        self.views = 0
+
+    def save(self, batches) -> None:
+        self.views += sum(len(views) for views in batches)
+
+
+def test_refused_views_are_dead_lettered_and_still_reach_the_derived_state():
+    config = ETLConfig()
+    sink, trending, positions = RecordingSink(), RecordingTrending(), RecordingPositions()
+    store = BatchStore(
+        config,
+        KafkaToClickHouseDataTransformer(),
+        RejectingLoader(config),  # type: ignore[arg-type]
+        sink,  # type: ignore[arg-type]
+        trending=trending,  # type: ignore[arg-type]
+        positions=positions,  # type: ignore[arg-type]
+    )
+    key = encode_key(uuid4(), uuid4())
+    records = [
+        source_record(config.kafka.views_topic, 0, offset, 0, key, encode_view(1_700_000_000_000, offset))
+        for offset in range(3)
+    ]
+
+    store.store(config.kafka.views_topic, records)
+
+    assert [item.record.offset for item in sink.published] == [0, 1, 2]
+    assert sink.published[0].reason.startswith("ServerException")
+    assert trending.views == 3
+    assert positions.views == 3
@@ -0,0 +1,50 @@
+from uuid import uuid4
+
+from dead_letter import source_record
+from transformer import INT32_MAX, UINT32_MAX, KafkaToClickHouseDataTransformer
+from wire import encode_event, encode_key, encode_view
+
+TIMESTAMP_MS = 1_700_000_000_000
+
+
+def test_transform_rejects_seconds_outside_int32():
+    key = encode_key(uuid4(), uuid4())
+    messages = [
+        source_record("views", 0, 0, 0, key, encode_view(TIMESTAMP_MS, 60)),
+        source_record("views", 0, 1, 0, key, encode_view(TIMESTAMP_MS, INT32_MAX + 1)),
+        source_record("views", 0, 2, TIMESTAMP_MS, b"%s:%s" % (str(uuid4()).encode(), str(uuid4()).encode()), b"-5"),
+        source_record("views", 0, 3, 0, key, encode_view(UINT32_MAX * 1000 + 1000, 60)),
+    ]
+
+    result = KafkaToClickHouseDataTransformer().transform(messages)
+
+    assert result.columns.number_seconds_viewing == [60]
+    assert result.columns.record_time == [TIMESTAMP_MS // 1000]
+    assert [item.record.offset for item in result.rejected] == [1, 2, 3]
+    assert result.rejected[0].reason.startswith("ValueError: number_seconds_viewing")
+
+
+def test_transform_events_rejects_event_values_out_of_range():
+    key = encode_key(uuid4(), uuid4())
+    legacy_key = f"{uuid4()}:{uuid4()}:".encode()
+    messages = [
+        source_record("events", 0, 0, 0, key, encode_event(TIMESTAMP_MS, 3, b'{"rating": 10}')),
+        source_record("events", 0, 1, 0, key, encode_event(TIMESTAMP_MS, UINT32_MAX + 1, b"{}")),
+        source_record("events", 0, 2, TIMESTAMP_MS, legacy_key, b"{}"),
+        source_record("events", 0, 3, -1000, legacy_key + b"like_film", b"{}"),
+    ]
+
+    result = KafkaToClickHouseDataTransformer().transform_events(messages)
+
+    assert result.columns.event_type == ["3"]
+    assert [item.record.offset for item in result.rejected] == [1, 2, 3]
+
+
+def test_legacy_events_may_start_with_any_utf8():
+    key = f"{uuid4()}:{uuid4()}:comment".encode()
+    message = source_record("events", 0, 0, TIMESTAMP_MS, key, "«Отличный фильм»".encode())
+
+    result = KafkaToClickHouseDataTransformer().transform_events([message])
+
+    assert not result.rejected
+    assert result.columns.event_type == ["comment"]
@@ -0,0 +1,22 @@
+from uuid import uuid4
+
+from config import ETLConfig
+from transformer import ViewColumns
+from trending import TrendingFilms
+
+
+def test_viewers_are_counted_once_per_bucket():
+    trending = TrendingFilms(ETLConfig())
+    user_id, film_id = uuid4(), uuid4()
+    # Two heartbeats in the first minute, one in the second
+    trending.add(ViewColumns([user_id] * 3, [film_id] * 3, [10, 20, 30], [0, 30, 60]))
+
+    assert trending.top("viewers") == [(film_id.int, 2)]
+    assert trending.top("watch_seconds") == [(film_id.int, 60)]
+
+
+def test_published_lists_outlive_a_pause_in_traffic():
+    config = ETLConfig()
+
+    # Nothing publishes while no heartbeats arrive, so the lists must not expire before their window does
+    assert TrendingFilms(config).ttl_seconds == config.trending.bucket_seconds * config.trending.window_buckets
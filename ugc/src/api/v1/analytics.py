@@ -0,0 +1,73 @@
+import asyncio
+from collections.abc import Awaitable
+from datetime import date, timedelta
+from http import HTTPStatus
+from uuid import UUID
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from core.logger import logger
+from services.analytics_service import AnalyticsService, get_analytics_service
+from storage.warehouse import WarehouseUnavailable
+
+router = APIRouter()
+
+MAX_DAYS = 366
+
+
+async def from_warehouse(result: Awaitable):
+    """Answer 504 if the warehouse is too slow and 503 if it is unreachable"""
+    try:
+        return await result
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=HTTPStatus.GATEWAY_TIMEOUT, detail="Warehouse query timed out")
+    except WarehouseUnavailable as e:
+        logger.error(e)
+        raise HTTPException(status_code=HTTPStatus.SERVICE_UNAVAILABLE, detail="Warehouse is unavailable")
+
+
+@router.get(
+    "/history",
+    summary="Watch history",
+    status_code=HTTPStatus.OK,
+    description="Films the current user watched, most recent first, with the position reached in each",
+)
+async def watch_history(
+    request: Request,
+    limit: int = Query(20, ge=1, le=100),
+    analytics: AnalyticsService = Depends(get_analytics_service),
+):
+    return await from_warehouse(analytics.get_watch_history(UUID(request.state.user_id), limit))
+
+
+@router.get(
+    "/films/{film_id}/watch_time",
+    summary="Film watch time",
+    status_code=HTTPStatus.OK,
+    description="Views, viewers and watch seconds of a film over all time",
+)
+async def film_watch_time(
+    film_id: UUID,
+    analytics: AnalyticsService = Depends(get_analytics_service),
+):
+    return await from_warehouse(analytics.get_film_watch_time(film_id))
+
+
+@router.get(
+    "/films/{film_id}/daily_views",
+    summary="Film views per day",
+    status_code=HTTPStatus.OK,
+    description="Views, viewers and watch seconds of a film per day, the last 30 days by default",
+)
+async def film_daily_views(
+    film_id: UUID,
+    date_from: date | None = None,
+    date_to: date | None = None,
+    analytics: AnalyticsService = Depends(get_analytics_service),
+):
+    date_to = date_to or date.today()
+    date_from = date_from or date_to - timedelta(days=29)
+    if date_from > date_to:
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail="date_from is after date_to")
+    if (date_to - date_from).days >= MAX_DAYS:
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail=f"At most {MAX_DAYS} days per request")
+    return await from_warehouse(analytics.get_film_daily_views(film_id, date_from, date_to))
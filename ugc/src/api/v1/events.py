@@ -1,6 +1,9 @@
 from http import HTTPStatus
+from uuid import UUID
 
-from fastapi import APIRouter, Depends, Request
+from fastapi import APIRouter, Depends, HTTPException, Request
+from core.config import redis_settings
+from storage.cache import RedisCache, get_cache
 from storage.mq import QueueProducer, get_producer
 
 from models.kafka import ViewMessage, EventMessage
@@ -44,3 +47,21 @@ async def load_event_in_mq(
         user_id=request.state.user_id,
         event_type=msg.event_type,
     )
+
+
+@router.get(
+    "/resume_position",
+    summary="Get resume position",
+    status_code=HTTPStatus.OK,
+    description="Last watched position of the current user in a film, kept by the ETL from view messages",
+)
+async def get_resume_position(
+    request: Request,
+    film_id: UUID,
+    cache: RedisCache = Depends(get_cache),
+):
+    value = await cache.get(f"{redis_settings.resume_prefix}:{UUID(request.state.user_id)}:{film_id}")
+    if value is None:
+        raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail="No position for this film")
+    position, updated_at = value.split(":")
+    return {"film_id": film_id, "position": int(position), "updated_at": int(updated_at)}
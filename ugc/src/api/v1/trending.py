@@ -0,0 +1,29 @@
+from enum import Enum
+from http import HTTPStatus
+
+from fastapi import APIRouter, Depends, Query
+from services.trending_service import TrendingService, get_trending_service
+
+router = APIRouter()
+
+
+class TrendingMetric(str, Enum):
+    viewers = "viewers"
+    watch_seconds = "watch_seconds"
+
+
+@router.get(
+    "/films",
+    summary="Trending films",
+    status_code=HTTPStatus.OK,
+    description=(
+        "Films with the most viewers or watch seconds over the last hour, refreshed every few seconds. "
+        "Viewers are viewer-minutes: a user counts once for every minute of the hour they watched in"
+    ),
+)
+async def trending_films(
+    by: TrendingMetric = TrendingMetric.viewers,
+    limit: int = Query(10, ge=1, le=100),
+    trending: TrendingService = Depends(get_trending_service),
+):
+    return await trending.get_trending_films(by.value, limit)
@@ -3,6 +3,8 @@ from pathlib import Path
 
 from pydantic import BaseSettings
 
+from core.topology import parse_topology
+
 env_path = Path("..") / ".env"
 env_file = env_path
 
@@ -35,9 +37,47 @@ class MongoSettings(BaseSettings):
 
 class KafkaSettings(BaseSettings):
     bootstrap_servers: str = os.getenv("KAFKA_BOOTSTRAP_SERVERS", "kafka-node1:9092")
+    # "binary" (storage/wire.py) or the legacy "text" messages
+    wire_format: str = os.getenv("KAFKA_WIRE_FORMAT", "binary")
+
+
+class RedisSettings(BaseSettings):
+    host: str = os.getenv("REDIS_HOST", "redis")
+    port: int = int(os.getenv("REDIS_PORT", 6379))
+    db: int = 0
+    # Keys written by the ETL, see etl/src/trending.py and etl/src/positions.py
+    trending_prefix: str = "trending"
+    resume_prefix: str = "resume"
+
+
+class ClickHouseSettings(BaseSettings):
+    host: str = os.getenv("CLICKHOUSE_HOST", "clickhouse-node1")
+    port: int = int(os.getenv("CLICKHOUSE_PORT", 9000))
+    # Same topology as the ETL writes to: shards separated by ";", replicas of a shard by ",".
+    # Empty means a single shard on host:port.
+    shards: str = os.getenv("CLICKHOUSE_SHARDS", "")
+    database: str = os.getenv("CLICKHOUSE_DATABASE", "shard")
+    user: str = os.getenv("CLICKHOUSE_USER", "admin")
+    password: str = os.getenv("CLICKHOUSE_PASSWORD", "qwerty")
+    # Connections per replica, opened on first use
+    pool_size: int = 4
+    # Seconds a request waits for the warehouse before answering 504; ClickHouse stops the query as well
+    query_timeout: float = float(os.getenv("ANALYTICS_QUERY_TIMEOUT", 3))
+    # Seconds a result is served from memory, and how many results are kept
+    cache_ttl: float = float(os.getenv("ANALYTICS_CACHE_TTL", 60))
+    cache_size: int = 10_000
+    # Tables written by the ETL, see etl/src/clickhouse_loader.py
+    views_table: str = "views"
+    film_daily_table: str = "film_daily_views"
+
+    def topology(self) -> list[list[tuple[str, int]]]:
+        """Replicas of every shard as (host, port), in failover order"""
+        return parse_topology(self.shards, self.host, self.port)
 
 
 settings = Settings()
 auth_jwt_settings = AuthjwtSettings()
 mongo_settings = MongoSettings()
 kafka_settings = KafkaSettings()
+redis_settings = RedisSettings()
+clickhouse_settings = ClickHouseSettings()
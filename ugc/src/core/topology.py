@@ -0,0 +1,27 @@
+"""Layout of the ClickHouse cluster the ETL writes to and the UGC API reads from.
+
+The same module lives in etl/src/topology.py (writer) and ugc/src/core/topology.py (reader); keep both copies
+identical, tests/test_shared_modules.py in the ETL checks it.
+
+    CLICKHOUSE_SHARDS = "node1:9000,node2:9000;node3:9000,node4:9000"
+
+Shards are separated by ";" and the replicas of a shard by ","; a missing port means the default one. Rows are
+split between shards by user_id, so both sides have to agree on `shard_of`.
+"""
+
+from uuid import UUID
+
+
+def parse_topology(shards: str, host: str, port: int) -> list[list[tuple[str, int]]]:
+    """Replicas of every shard as (host, port), in failover order; empty `shards` means a single host:port."""
+    if not shards:
+        return [[(host, port)]]
+    topology = []
+    for shard in shards.split(";"):
+        nodes = (node.strip().partition(":") for node in shard.split(","))
+        topology.append([(name, int(node_port or port)) for name, _, node_port in nodes])
+    return topology
+
+
+def shard_of(user_id: UUID, shards: int) -> int:
+    return user_id.int % shards
@@ -13,14 +13,14 @@ from fastapi.responses import ORJSONResponse
 from opentelemetry import trace
 from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
 
-from core.config import auth_jwt_settings, settings, mongo_settings, kafka_settings
+from core.config import auth_jwt_settings, settings, mongo_settings, kafka_settings, redis_settings, clickhouse_settings
 from services.tracer import configure_tracer
 
-from storage import mq, nosql
+from storage import cache, mq, nosql, warehouse
 from storage.mq import KafkaProducer
 from core.logger import logger
 
-from api.v1 import events, interactions
+from api.v1 import analytics, events, interactions, trending
 
 
 @AuthJWT.load_config
@@ -33,14 +33,18 @@ async def lifespan(application: FastAPI):
 
     # init
     mq.queue_producer = KafkaProducer(bootstrap_servers=kafka_settings.bootstrap_servers)
-    nosql.nosql = nosql.MongoDBConnector(
+    mongo = nosql.nosql = nosql.MongoDBConnector(
         db_name=mongo_settings.db, collection_name=mongo_settings.collection, hosts=mongo_settings.hosts
     )
+    redis = cache.cache = cache.RedisCache(host=redis_settings.host, port=redis_settings.port, db=redis_settings.db)
+    clickhouse = warehouse.warehouse = warehouse.ClickHouseWarehouse(clickhouse_settings)
     await mq.queue_producer.start()
 
     yield
 
-    nosql.nosql.client.close()
+    mongo.client.close()
+    await redis.close()
+    await clickhouse.close()
     await mq.queue_producer.stop()
 
 
@@ -116,3 +120,5 @@ if settings.jaeger_enabled:
 
 app.include_router(events.router, prefix="/api/v1/events")
 app.include_router(interactions.router, prefix="/api/v1/interactions")
+app.include_router(trending.router, prefix="/api/v1/trending")
+app.include_router(analytics.router, prefix="/api/v1/analytics")
@@ -0,0 +1,77 @@
+from collections import defaultdict
+from datetime import date
+from functools import lru_cache
+from uuid import UUID
+
+from fastapi import Depends
+
+from core.config import clickhouse_settings
+from storage.warehouse import ClickHouseWarehouse, get_warehouse
+
+
+class AnalyticsService:
+    """
+    Статистика просмотров из ClickHouse, куда ETL загружает сообщения о просмотрах (etl/src/clickhouse_loader.py).
+
+    views: число сообщений о просмотре (heartbeat), которые плеер присылает во время просмотра.
+    watch_seconds: сумма позиций просмотра из этих сообщений, как в агрегате film_daily_views.
+    viewers: число разных пользователей.
+
+    Строки разложены по шардам по user_id: запросы о пользователе идут на его шард, остальные - на все шарды,
+    и частичные агрегаты шардов складываются здесь. Пользователи шардов не пересекаются, поэтому viewers тоже
+    складываются.
+    """
+
+    def __init__(self, warehouse: ClickHouseWarehouse):
+        self.warehouse = warehouse
+        database = clickhouse_settings.database
+        self.views_table = f"{database}.{clickhouse_settings.views_table}"
+        self.film_daily_table = f"{database}.{clickhouse_settings.film_daily_table}"
+
+    async def get_watch_history(self, user_id: UUID, limit: int) -> list[dict]:
+        """Фильмы, которые смотрел пользователь, начиная с последнего, с позицией, на которой он остановился"""
+        rows = await self.warehouse.query(
+            f"SELECT film_id, max(record_time) AS last_watched, "
+            f"argMax(number_seconds_viewing, record_time) AS position "
+            f"FROM {self.views_table} WHERE user_id = %(user_id)s "
+            f"GROUP BY film_id ORDER BY last_watched DESC LIMIT %(limit)s",
+            {"user_id": user_id, "limit": limit},
+            user_id=user_id,
+        )
+        return [
+            {"film_id": film_id, "last_watched": last_watched, "position": position}
+            for film_id, last_watched, position in rows
+        ]
+
+    async def get_film_watch_time(self, film_id: UUID) -> dict:
+        """Просмотры, зрители и секунды просмотра фильма за всё время"""
+        rows = await self.warehouse.query(
+            f"SELECT sum(views), sum(watch_seconds), uniqMerge(viewers) "
+            f"FROM {self.film_daily_table} WHERE film_id = %(film_id)s",
+            {"film_id": film_id},
+        )
+        totals = [sum(column) for column in zip(*rows)] or [0, 0, 0]
+        return {"film_id": film_id, "views": totals[0], "watch_seconds": totals[1], "viewers": totals[2]}
+
+    async def get_film_daily_views(self, film_id: UUID, date_from: date, date_to: date) -> list[dict]:
+        """Просмотры, зрители и секунды просмотра фильма по дням, только дни с просмотрами"""
+        rows = await self.warehouse.query(
+            f"SELECT day, sum(views), sum(watch_seconds), uniqMerge(viewers) "
+            f"FROM {self.film_daily_table} "
+            f"WHERE film_id = %(film_id)s AND day BETWEEN %(date_from)s AND %(date_to)s GROUP BY day",
+            {"film_id": film_id, "date_from": date_from, "date_to": date_to},
+        )
+        days: dict[date, list[int]] = defaultdict(lambda: [0, 0, 0])
+        for day, *counts in rows:
+            days[day] = [total + count for total, count in zip(days[day], counts)]
+        return [
+            {"day": day, "views": views, "watch_seconds": watch_seconds, "viewers": viewers}
+            for day, (views, watch_seconds, viewers) in sorted(days.items())
+        ]
+
+
+@lru_cache()
+def get_analytics_service(
+    warehouse: ClickHouseWarehouse = Depends(get_warehouse),
+) -> AnalyticsService:
+    return AnalyticsService(warehouse=warehouse)
@@ -0,0 +1,31 @@
+from functools import lru_cache
+
+from fastapi import Depends
+
+from core.config import redis_settings
+from storage.cache import RedisCache, get_cache
+
+
+class TrendingService:
+    """
+    Фильмы, набирающие популярность: топ за последний час, который ETL считает по потоку просмотров
+    и публикует в Redis (etl/src/trending.py).
+
+    viewers: число зритель-минут фильма за окно: зритель считается один раз в каждой минуте, в которую он смотрел,
+    поэтому смотревший весь час засчитывается 60 раз.
+    watch_seconds: сумма секунд просмотра фильма за окно.
+    """
+
+    def __init__(self, cache: RedisCache):
+        self.cache = cache
+
+    async def get_trending_films(self, by: str, limit: int) -> list[dict]:
+        top = await self.cache.get_top(f"{redis_settings.trending_prefix}:{by}", limit)
+        return [{"film_id": film_id, by: int(score)} for film_id, score in top]
+
+
+@lru_cache()
+def get_trending_service(
+    cache: RedisCache = Depends(get_cache),
+) -> TrendingService:
+    return TrendingService(cache=cache)
@@ -0,0 +1,44 @@
+from abc import ABC, abstractmethod
+
+from redis.asyncio import Redis
+
+
+class Cache(ABC):
+    @abstractmethod
+    async def get(self, key: str):
+        pass
+
+    @abstractmethod
+    async def get_top(self, key: str, limit: int):
+        pass
+
+    @abstractmethod
+    async def close(self):
+        pass
+
+
+class RedisCache(Cache):
+    def __init__(self, host: str, port: int, db: int):
+        self.client = Redis(host=host, port=port, db=db, decode_responses=True)
+
+    async def get(self, key: str) -> str | None:
+        value: str | None = await self.client.get(key)
+        return value
+
+    async def get_top(self, key: str, limit: int) -> list[tuple[str, float]]:
+        """Members of a sorted set with the highest scores, highest first"""
+        members: list[tuple[str, float]] = await self.client.zrange(key, 0, limit - 1, desc=True, withscores=True)
+        return members
+
+    async def close(self):
+        await self.client.aclose()
+
+
+# Created in the application lifespan
+cache: RedisCache | None = None
+
+
+async def get_cache() -> RedisCache:
+    if cache is None:
+        raise RuntimeError("Redis cache is not initialized")
+    return cache
@@ -1,8 +1,13 @@
+import time
 from typing import Type
+from uuid import UUID
 
 from aiokafka import AIOKafkaProducer
 from abc import ABC, abstractmethod
 
+from core.config import kafka_settings
+from storage import wire
+
 
 class QueueProducer(ABC):
     @abstractmethod
@@ -14,13 +19,39 @@ class QueueProducer(ABC):
         pass
 
 
+def binary_key(user_id, film_id):
+    """Raw UUID key, or None if an id is not a UUID and the message has to keep the text format."""
+    try:
+        return wire.encode_key(UUID(str(user_id)), UUID(str(film_id)))
+    except ValueError:
+        return None
+
+
 class KafkaProducer(AIOKafkaProducer, QueueProducer):
+    """Sends messages in the binary format of storage/wire.py, or as legacy text if KAFKA_WIRE_FORMAT=text.
+
+    Messages the binary format cannot carry are sent as text, so the ETL dead-letters them as before.
+    """
+
+    binary = kafka_settings.wire_format == "binary"
+
     async def send_view(self, user_id, film_id, value):
-        await self.send(topic="views", value=str.encode(value), key=str.encode(f"{user_id}:{film_id}"))
+        key = binary_key(user_id, film_id) if self.binary and value.isascii() and value.isdigit() else None
+        if key is not None:
+            await self.send(topic="views", value=wire.encode_view(time.time_ns() // 1_000_000, int(value)), key=key)
+        else:
+            await self.send(topic="views", value=str.encode(value), key=str.encode(f"{user_id}:{film_id}"))
         return True
 
     async def send_event(self, user_id, film_id, value, event_type):
-        await self.send(topic="events", value=str.encode(value), key=str.encode(f"{user_id}:{film_id}:{event_type}"))
+        key = binary_key(user_id, film_id) if self.binary and event_type >= 0 else None
+        if key is not None:
+            message = wire.encode_event(time.time_ns() // 1_000_000, event_type, str.encode(value))
+            await self.send(topic="events", value=message, key=key)
+        else:
+            await self.send(
+                topic="events", value=str.encode(value), key=str.encode(f"{user_id}:{film_id}:{event_type}")
+            )
         return True
 
 
@@ -81,8 +81,11 @@ class MongoDBConnector(NoSqlDb):
         return await self.collection.aggregate(pipeline).to_list(length=None)
 
 
-nosql = MongoDBConnector
+# Created in the application lifespan
+nosql: MongoDBConnector | None = None
 
 
 async def get_nosql() -> MongoDBConnector:
+    if nosql is None:
+        raise RuntimeError("MongoDB connector is not initialized")
     return nosql
@@ -0,0 +1,157 @@
+import asyncio
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from collections.abc import Callable, Coroutine
+from functools import partial
+from typing import Any
+from uuid import UUID
+
+from asynch.pool import Pool
+
+from core.config import ClickHouseSettings
+from core.logger import logger
+from core.topology import shard_of
+
+# Errors meaning the node itself is unreachable, so the query can go to another replica
+NODE_DOWN_ERRORS = (EOFError, OSError)
+
+
+class WarehouseUnavailable(Exception):
+    pass
+
+
+class ResultCache:
+    """
+    Results of read queries kept for `ttl` seconds, keyed by query and parameters.
+
+    Concurrent requests for a result that is not cached yet wait for the same query instead of sending their own.
+    Failed queries are not cached.
+    """
+
+    def __init__(self, ttl: float, size: int):
+        self.ttl = ttl
+        self.size = size
+        self.results: OrderedDict[tuple, tuple[float, list[tuple]]] = OrderedDict()
+        self.pending: dict[tuple, asyncio.Task] = {}
+
+    @staticmethod
+    def key(query: str, params: dict[str, Any]) -> tuple:
+        return query, tuple(sorted((name, str(value)) for name, value in params.items()))
+
+    async def get_or_run(self, key: tuple, run: Callable[[], Coroutine[Any, Any, list[tuple]]]) -> list[tuple]:
+        cached = self.results.get(key)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+        task = self.pending.get(key)
+        if task is None:
+            task = asyncio.create_task(run())
+            self.pending[key] = task
+            task.add_done_callback(partial(self.done, key))
+        # shield: a request that is cancelled must not cancel the query for the others waiting for it
+        return await asyncio.shield(task)
+
+    def done(self, key: tuple, task: asyncio.Task) -> None:
+        del self.pending[key]
+        if task.cancelled() or task.exception() is not None:
+            return
+        self.results[key] = (time.monotonic() + self.ttl, task.result())
+        self.results.move_to_end(key)
+        while len(self.results) > self.size:
+            self.results.popitem(last=False)
+
+
+class Warehouse(ABC):
+    @abstractmethod
+    async def query(self, query: str, params: dict[str, Any], user_id: UUID | None = None):
+        pass
+
+    @abstractmethod
+    async def close(self):
+        pass
+
+
+class ClickHouseWarehouse(Warehouse):
+    """
+    Read queries against the ClickHouse shards the ETL writes to, over pooled asynch connections.
+
+    Rows are split between shards by user_id, so a query about one user goes to that user's shard only and any
+    other query to every shard, returning their rows together; per-shard aggregates are combined by the caller.
+    Every shard is read from its first reachable replica.
+    """
+
+    def __init__(self, settings: ClickHouseSettings):
+        self.settings = settings
+        loop = asyncio.get_running_loop()
+        # asynch pools hold `minsize` connections and open them on first acquire
+        self.shards = [
+            [
+                Pool(
+                    minsize=settings.pool_size,
+                    maxsize=settings.pool_size,
+                    loop=loop,
+                    host=host,
+                    port=port,
+                    database=settings.database,
+                    user=settings.user,
+                    password=settings.password,
+                )
+                for host, port in replicas
+            ]
+            for replicas in settings.topology()
+        ]
+        self.cache = ResultCache(settings.cache_ttl, settings.cache_size)
+
+    async def query(self, query: str, params: dict[str, Any], user_id: UUID | None = None) -> list[tuple]:
+        """
+        Rows of a parameterized query (`%(name)s` placeholders), served from the cache while fresh.
+
+        Raises asyncio.TimeoutError after `query_timeout` seconds and WarehouseUnavailable if a shard has no
+        reachable replica.
+        """
+        shards = [shard_of(user_id, len(self.shards))] if user_id is not None else range(len(self.shards))
+        key = self.cache.key(query, {**params, "__shards": list(shards)})
+
+        async def run() -> list[tuple]:
+            parts = await asyncio.wait_for(
+                asyncio.gather(*(self.query_shard(shard, query, params) for shard in shards)),
+                timeout=self.settings.query_timeout,
+            )
+            return [row for rows in parts for row in rows]
+
+        return await self.cache.get_or_run(key, run)
+
+    async def query_shard(self, shard: int, query: str, params: dict[str, Any]) -> list[tuple]:
+        for replica in self.shards[shard]:
+            try:
+                async with replica.acquire() as connection:
+                    try:
+                        async with connection.cursor() as cursor:
+                            cursor.set_settings({"max_execution_time": self.settings.query_timeout})
+                            await cursor.execute(query, params)
+                            rows: list[tuple] = await cursor.fetchall()
+                            return rows
+                    except (asyncio.CancelledError, *NODE_DOWN_ERRORS):
+                        # A query cut off midway leaves unread data on the socket; closing it makes the pooled
+                        # connection reconnect on its next use
+                        await connection.close()
+                        raise
+            except NODE_DOWN_ERRORS as e:
+                logger.warning(f"ClickHouse shard {shard} replica is unavailable, failing over: {e}")
+        raise WarehouseUnavailable(f"No reachable replica for shard {shard}")
+
+    async def close(self):
+        for replicas in self.shards:
+            for pool in replicas:
+                pool.close()
+                await pool.wait_closed()
+
+
+# Created in the application lifespan, which needs the running loop
+warehouse: ClickHouseWarehouse | None = None
+
+
+async def get_warehouse() -> ClickHouseWarehouse:
+    if warehouse is None:
+        raise RuntimeError("ClickHouse warehouse is not initialized")
+    return warehouse
@@ -1,3 +1,5 @@
+import base64
+import json
 import os
 import uuid
 
@@ -12,9 +14,9 @@ from httpx import AsyncClient
 from typing import AsyncGenerator
 
 
-from core.config import mongo_settings
+from core.config import mongo_settings, redis_settings
 
-from storage import mq, nosql
+from storage import cache, mq, nosql
 from main import app
 
 
@@ -26,10 +28,12 @@ async def fastapi_app() -> FastAPI:
     )
     collection = nosql.nosql.db[mongo_settings.collection]
     collection.delete_many({})
+    cache.cache = cache.RedisCache(host=redis_settings.host, port=redis_settings.port, db=redis_settings.db)
 
     yield app
 
     nosql.nosql.client.close()
+    await cache.cache.close()
     await mq.queue_producer.stop()
 
 
@@ -60,3 +64,10 @@ async def access_token():
     )
     if not logout.status_code != 200:
         raise Exception("Tokens was not banned!")
+
+
+@pytest.fixture(scope="session")
+def user_id(access_token) -> str:
+    """Subject of the access token, the user the API sees"""
+    payload = access_token.split(".")[1]
+    return json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))["sub"]
@@ -0,0 +1,98 @@
+import asyncio
+import uuid
+
+import pytest
+import pytest_asyncio
+
+from core.config import ClickHouseSettings
+from storage import warehouse
+
+pytestmark = pytest.mark.asyncio(scope="module")
+
+
+class FakeShards:
+    """Stands in for the ClickHouse replicas: answers every shard query with `rows` after `delay` seconds"""
+
+    def __init__(self):
+        self.rows = []
+        self.delay = 0.0
+        self.unavailable = False
+        self.queries = 0
+
+    async def query_shard(self, shard, query, params):
+        self.queries += 1
+        await asyncio.sleep(self.delay)
+        if self.unavailable:
+            raise warehouse.WarehouseUnavailable(f"No reachable replica for shard {shard}")
+        return self.rows
+
+
+@pytest_asyncio.fixture(scope="module")
+async def shards():
+    fake = FakeShards()
+    clickhouse = warehouse.ClickHouseWarehouse(ClickHouseSettings(query_timeout=0.5, cache_ttl=60))
+    clickhouse.query_shard = fake.query_shard
+    warehouse.warehouse = clickhouse
+
+    yield fake
+
+    await clickhouse.close()
+    warehouse.warehouse = None
+
+
+class TestAnalytics:
+
+    headers = {"X-Request-Id": "123"}
+
+    async def test_film_watch_time_is_cached(self, async_client, access_token, shards):
+        film_id = str(uuid.uuid4())
+        shards.rows = [(3, 540, 2)]
+        headers = {**self.headers, "Cookie": f"access_token={access_token}; HttpOnly; Path=/"}
+
+        # Concurrent requests wait for the same query, later ones are served from the cache
+        responses = await asyncio.gather(
+            *(async_client.get(f"api/v1/analytics/films/{film_id}/watch_time", headers=headers) for _ in range(3))
+        )
+        responses.append(await async_client.get(f"api/v1/analytics/films/{film_id}/watch_time", headers=headers))
+
+        assert [response.status_code for response in responses] == [200] * 4
+        assert all(
+            response.json() == {"film_id": film_id, "views": 3, "watch_seconds": 540, "viewers": 2}
+            for response in responses
+        )
+        assert shards.queries == 1
+
+    async def test_film_watch_time_timeout(self, async_client, access_token, shards):
+        film_id = str(uuid.uuid4())
+        shards.queries = 0
+        shards.delay = 1.0
+        headers = {**self.headers, "Cookie": f"access_token={access_token}; HttpOnly; Path=/"}
+
+        response = await async_client.get(f"api/v1/analytics/films/{film_id}/watch_time", headers=headers)
+        assert response.status_code == 504
+
+        # A failed query is not cached
+        shards.delay = 0.0
+        shards.rows = [(1, 60, 1)]
+        response = await async_client.get(f"api/v1/analytics/films/{film_id}/watch_time", headers=headers)
+        assert response.status_code == 200
+        assert response.json()["views"] == 1
+        assert shards.queries == 2
+
+    async def test_film_watch_time_unavailable(self, async_client, access_token, shards):
+        shards.unavailable = True
+        headers = {**self.headers, "Cookie": f"access_token={access_token}; HttpOnly; Path=/"}
+
+        response = await async_client.get(f"api/v1/analytics/films/{uuid.uuid4()}/watch_time", headers=headers)
+        assert response.status_code == 503
+        shards.unavailable = False
+
+    async def test_film_daily_views_range(self, async_client, access_token, shards):
+        headers = {**self.headers, "Cookie": f"access_token={access_token}; HttpOnly; Path=/"}
+
+        response = await async_client.get(
+            f"api/v1/analytics/films/{uuid.uuid4()}/daily_views",
+            headers=headers,
+            params={"date_from": "2024-02-01", "date_to": "2024-01-01"},
+        )
+        assert response.status_code == 400
@@ -0,0 +1,34 @@
+import uuid
+
+import pytest
+
+from core.config import redis_settings
+from storage import cache
+
+pytestmark = pytest.mark.asyncio(scope="module")
+
+
+class TestResumePosition:
+
+    film_id = str(uuid.uuid4())
+
+    async def test_resume_position(self, async_client, access_token, user_id):
+        # Kept by the ETL as "position:updated_at" per user and film
+        key = f"{redis_settings.resume_prefix}:{uuid.UUID(user_id)}:{self.film_id}"
+        await cache.cache.client.set(key, "1260:1700000000")
+
+        response = await async_client.get(
+            "api/v1/events/resume_position",
+            headers={"X-Request-Id": "123", "Cookie": f"access_token={access_token}; HttpOnly; Path=/"},
+            params={"film_id": self.film_id},
+        )
+        assert response.status_code == 200
+        assert response.json() == {"film_id": self.film_id, "position": 1260, "updated_at": 1700000000}
+
+    async def test_resume_position_not_found(self, async_client, access_token):
+        response = await async_client.get(
+            "api/v1/events/resume_position",
+            headers={"X-Request-Id": "123", "Cookie": f"access_token={access_token}; HttpOnly; Path=/"},
+            params={"film_id": str(uuid.uuid4())},
+        )
+        assert response.status_code == 404
@@ -0,0 +1,41 @@
+import uuid
+
+import pytest
+
+from core.config import redis_settings
+from storage import cache
+
+pytestmark = pytest.mark.asyncio(scope="module")
+
+
+class TestTrending:
+
+    film_id = [str(uuid.uuid4()) for i in range(3)]
+
+    async def test_trending_films(self, async_client, access_token):
+        # Published by the ETL as sorted sets of film ids scored by the metric
+        key = f"{redis_settings.trending_prefix}:viewers"
+        await cache.cache.client.delete(key)
+        await cache.cache.client.zadd(key, {film_id: score for film_id, score in zip(self.film_id, [5, 30, 12])})
+
+        response = await async_client.get(
+            "api/v1/trending/films",
+            headers={"X-Request-Id": "123", "Cookie": f"access_token={access_token}; HttpOnly; Path=/"},
+            params={"by": "viewers", "limit": 2},
+        )
+        assert response.status_code == 200
+        assert response.json() == [
+            {"film_id": self.film_id[1], "viewers": 30},
+            {"film_id": self.film_id[2], "viewers": 12},
+        ]
+
+    async def test_trending_films_empty(self, async_client, access_token):
+        await cache.cache.client.delete(f"{redis_settings.trending_prefix}:watch_seconds")
+
+        response = await async_client.get(
+            "api/v1/trending/films",
+            headers={"X-Request-Id": "123", "Cookie": f"access_token={access_token}; HttpOnly; Path=/"},
+            params={"by": "watch_seconds"},
+        )
+        assert response.status_code == 200
+        assert response.json() == []